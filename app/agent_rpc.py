@@ -0,0 +1,136 @@
+import base64
+import hashlib
+import json
+import os
+import threading
+
+from preflight import Preflight
+
+from tracing import tracer
+
+AGENT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'python', 'agent.py')
+
+with open(AGENT_PATH, 'r') as _file_handle:
+    AGENT_SOURCE = _file_handle.read()
+
+AGENT_HASH = hashlib.sha1(AGENT_SOURCE).hexdigest()[:16]
+
+
+class AgentError(Exception):
+    """ Base error class for AgentClient """
+
+    def __init__(self, message, base=None):
+        super(AgentError, self).__init__(message)
+        self.base_exception = base
+
+
+class AgentClient(object):
+    """ Talks to the deploy agent of a server, a long lived process keeping the host state in memory.
+
+    The agent is installed in `~/.deploy/.agent`, versioned by its content hash, and listens on a unix socket
+    next to it. A single relay program, executed on a channel of the server transport, carries every request
+    of a run to the agent and starts the agent first if it does not run. Requests then cost a single round trip
+    on the open channel, without opening a channel nor spawning a shell on the server.
+
+    """
+    DIRECTORY = '~/.deploy/.agent/%s' % AGENT_HASH
+
+    def __init__(self, server):
+        self.server = server
+        self.channel = None
+        self._reader = None
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    @property
+    def path(self):
+        return '%s/agent.py' % AgentClient.DIRECTORY
+
+    def get_command(self, install):
+        """ Builds the command starting the relay, installing the agent first if required. """
+        path = Preflight.quote_path(self.path)
+        command = ''
+        if install:
+            command = 'mkdir -p %s && echo %s | base64 -d > %s.$$ && mv %s.$$ %s && ' % (
+                Preflight.quote_path(AgentClient.DIRECTORY), base64.b64encode(AGENT_SOURCE), path, path, path)
+        return command + 'exec "$(command -v python3 || command -v python)" %s relay' % path
+
+    def _open(self, install):
+        self.close()
+        self.channel = self.server.ssh_client.get_transport().open_session()
+        self.channel.exec_command(self.get_command(install))
+        self._reader = self.channel.makefile('rb')
+
+    def connect(self):
+        """ Starts the relay, and the agent if it does not run, installing it unless it is known to be installed.
+
+        Raises:
+            AgentError: If the agent could not be reached.
+
+        """
+        installed = self.server.facts.get('agent') == AGENT_HASH
+        try:
+            self._open(install=not installed)
+            try:
+                self.call('hello')
+            except AgentError:
+                if not installed:
+                    raise
+                # The cached facts were wrong, the agent is installed again
+                self._open(install=True)
+                self.call('hello')
+        except IOError, e:
+            self.close()
+            raise AgentError('Could not start the agent relay.\n\t> %s' % e, base=e)
+        except AgentError:
+            self.close()
+            raise
+
+        self.server.facts['agent'] = AGENT_HASH
+
+    def call(self, method, label=None, **params):
+        """ Sends a request to the agent and waits for its response.
+
+        Args:
+            method (string): The agent method.
+            label (Optional[str]): The name of the request in the trace. Defaults to the method.
+            **params: The method parameters.
+
+        Returns:
+            object: The value returned by the agent.
+
+        Raises:
+            AgentError: If the agent could not be reached, or if the request failed.
+
+        """
+        if self.channel is None:
+            raise AgentError('The agent is not connected.')
+
+        with self._lock:
+            self._next_id += 1
+            request = {'id': self._next_id, 'method': method, 'params': params}
+            with tracer.span(label or method, 'remote', host=self.server.address, agent=True):
+                try:
+                    self.channel.sendall(json.dumps(request) + '\n')
+                    line = self._reader.readline()
+                except IOError, e:
+                    raise AgentError('The connection to the agent was lost.\n\t> %s' % e, base=e)
+
+        if not line:
+            raise AgentError('The agent closed the connection.%s' % (
+                '\n\t> %s' % self.channel.recv_stderr(4096).rstrip() if self.channel.recv_stderr_ready() else ''))
+
+        try:
+            response = json.loads(line)
+        except ValueError, e:
+            raise AgentError('Invalid agent response "%s".' % line.rstrip(), base=e)
+
+        if 'error' in response:
+            raise AgentError('The agent could not %s.\n\t> %s' % (method, response['error']))
+        return response['result']
+
+    def close(self):
+        if self.channel is not None:
+            self.channel.close()
+        self.channel = None
+        self._reader = None
@@ -0,0 +1,61 @@
+#!/bin/bash
+
+# Print the installed packages among the given ones, one per line
+function _dpkg_installed {
+    dpkg-query -W -f='${Package} ${Status}\n' "$@" 2>/dev/null | grep " install ok installed$" | cut -d' ' -f1
+}
+
+function _rpm_installed {
+    rpm -q --qf '%{NAME}\n' "$@" 2>/dev/null | grep -v " is not installed$"
+}
+
+function _pacman_installed {
+    pacman -Q "$@" 2>/dev/null | cut -d' ' -f1
+}
+
+function _brew_installed {
+    brew list --versions "$@" 2>/dev/null | cut -d' ' -f1
+}
+
+# Print the given packages that are not installed, one per line, using a single package manager query
+function missing_packages {
+    local pm="$1"
+    shift
+
+    local installed=""
+    if [ "$pm" == "apt-get" ]; then
+        installed=$(_dpkg_installed "$@")
+    elif [ "$pm" == "yum" ] || [ "$pm" == "zypper" ]; then
+        installed=$(_rpm_installed "$@")
+    elif [ "$pm" == "pacman" ]; then
+        installed=$(_pacman_installed "$@")
+    elif [ "$pm" == "brew" ]; then
+        installed=$(_brew_installed "$@")
+    fi
+
+    local pkg
+    for pkg in "$@"; do
+        echo "$installed" | grep -qx -- "$pkg" || echo "$pkg"
+    done
+}
+
+# Install all the given packages in a single package manager transaction
+function install_packages {
+    local pm="$1"
+    shift
+
+    if [ "$pm" == "apt-get" ]; then
+        DEBIAN_FRONTEND=noninteractive apt-get install -y "$@"
+    elif [ "$pm" == "yum" ]; then
+        yum install -y "$@"
+    elif [ "$pm" == "pacman" ]; then
+        pacman -S --noconfirm --needed "$@"
+    elif [ "$pm" == "zypper" ]; then
+        zypper --non-interactive install "$@"
+    elif [ "$pm" == "brew" ]; then
+        brew install "$@"
+    else
+        echo "Unsupported package manager \"$pm\"" >&2
+        return 1
+    fi
+}
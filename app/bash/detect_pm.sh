@@ -42,11 +42,9 @@ function PM_detect {
 
       if [[ -z "$_PM" ]]; then
         echo "[ERROR]: No supported package manager installed on system"
-        exit 1
+        return 1
       fi
   fi
 
   echo "$_PM"
-}
-
-PM_detect
\ No newline at end of file
+}
\ No newline at end of file
@@ -0,0 +1,478 @@
+import gzip
+import hashlib
+import json
+import os
+import pipes
+import subprocess
+import tarfile
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from channels import Command, STDOUT
+from facts import FactsCache
+from preflight import Preflight
+from terminal import Terminal
+
+from server import ServerError
+
+from transfer import ChunkedUpload, TransferError, TransferStats
+
+
+class BuildError(Exception):
+    """ Base error class for RemoteBuild and LocalBuild """
+
+    def __init__(self, message, base=None):
+        super(BuildError, self).__init__(message)
+        self.base_exception = base
+
+
+class BuildStats(object):
+    """ What running the build did """
+
+    def __init__(self):
+        self.outputs = 0
+        self.skipped = False
+
+
+class RemoteBuild(object):
+    """ Builds the project on the remote server, with the build command of its preset.
+
+    The build runs in a persistent work tree, `~/.deploy/<project>/src`, updated in place from the bare
+    repository with its own index, so incremental compilers and the outputs of the previous build are kept
+    between deploys. The build command finds the project directory in `$DEPLOY_APP_DIR`, where presets
+    keep their caches warm.
+
+    The hash of the build inputs, the source tree and the build command, is stored along with the manifest
+    of the build outputs once a build succeeded. When the inputs did not change, the build is skipped
+    altogether and the outputs of the last build are shipped again. The state is removed before a build
+    starts, so the outputs a failed build left half written are never mistaken for those of the last one.
+
+    """
+    WORK_TREE = 'src'
+    INDEX_FILE = 'build.index'
+    STATE_FILE = 'build.json'
+    OUTPUTS_MARKER = '__DEPLOY_BUILD_OUTPUTS__'
+
+    def __init__(self, server, app_directory, bare_repo_directory, command, outputs):
+        self.server = server
+        self.app_directory = app_directory.rstrip('/')
+        self.bare_repo_directory = bare_repo_directory
+        self.command = command
+        self.outputs = [output.strip('/') for output in outputs]
+        self.manifest = None
+
+    @property
+    def work_tree(self):
+        return '%s/%s' % (self.app_directory, RemoteBuild.WORK_TREE)
+
+    @property
+    def state_path(self):
+        return '%s/%s' % (self.app_directory, RemoteBuild.STATE_FILE)
+
+    def get_inputs_hash(self, repository, sha):
+        """ Hashes everything the build depends on.
+
+        Args:
+            repository (Repo): The local repository.
+            sha (string): The commit to build.
+
+        Returns:
+            string: The hash.
+
+        """
+        digest = hashlib.sha1()
+        digest.update('%s\0%s\0' % (repository.commit(sha).tree.hexsha, self.command))
+        for output in self.outputs:
+            digest.update('%s\0' % output)
+        return digest.hexdigest()
+
+    def _get_last_build(self):
+        """ Gets the state of the last successful build, gathered by the preflight.
+
+        Returns:
+            dict: The inputs hash and the outputs manifest, or None.
+
+        """
+        content = self.server.facts['contents'].get(self.state_path)
+        if not content:
+            return None
+
+        try:
+            return json.loads(content)
+        except ValueError:
+            return None
+
+    def get_script(self, sha):
+        """ Builds the remote program forgetting the last build, updating the work tree, building, and listing
+            the build outputs. """
+        lines = [
+            'set -e -o pipefail',
+            'cd %s' % Preflight.quote_path(self.app_directory),
+            'rm -f %s' % RemoteBuild.STATE_FILE,
+            'export DEPLOY_APP_DIR="$PWD"',
+            'mkdir -p %s' % RemoteBuild.WORK_TREE,
+            'GIT_DIR=%s GIT_WORK_TREE="$PWD/%s" GIT_INDEX_FILE="$PWD/%s" git read-tree --reset -u %s'
+            % (Preflight.quote_path(self.bare_repo_directory), RemoteBuild.WORK_TREE, RemoteBuild.INDEX_FILE, sha),
+            'cd %s' % RemoteBuild.WORK_TREE,
+            '( %s ) < /dev/null' % self.command,
+            'echo %s' % RemoteBuild.OUTPUTS_MARKER,
+        ]
+
+        # Every output file is listed as "<sha1> <octal mode> <path>"
+        for output in self.outputs:
+            lines.extend([
+                'if [ -e %s ]; then' % pipes.quote(output),
+                '    find %s -type f | while IFS= read -r _file; do' % pipes.quote(output),
+                '        echo "$(sha1sum < "$_file" | cut -c1-40) $(stat -c %a "$_file") $_file"',
+                '    done',
+                'fi',
+            ])
+
+        return '\n'.join(lines)
+
+    def run(self, repository, sha):
+        """ Builds the commit, unless its inputs were already built by the last successful build.
+
+        Once run, `manifest` holds the build outputs, relative to the work tree, in the DeltaSync manifest
+        format.
+
+        Args:
+            repository (Repo): The local repository.
+            sha (string): The commit to build, already pushed to the bare repository.
+
+        Returns:
+            BuildStats: What running the build did.
+
+        Raises:
+            BuildError: If the build failed.
+
+        """
+        stats = BuildStats()
+        inputs = self.get_inputs_hash(repository, sha)
+
+        last_build = self._get_last_build()
+        if last_build is not None and last_build.get('inputs') == inputs:
+            self.manifest = last_build['outputs']
+            stats.skipped = True
+            stats.outputs = len(self.manifest)
+            return stats
+
+        command = Command('bash -c %s' % pipes.quote(self.get_script(sha)), label='build', keep_output=False)
+        manifest = {}
+        listing = False
+        # The work tree outputs no longer match the recorded state once the build starts
+        self.server.facts['contents'].pop(self.state_path, None)
+        try:
+            for stream, line in self.server.stream(command):
+                if listing and stream == STDOUT:
+                    digest, mode, path = line.split(' ', 2)
+                    manifest[path] = {'sha1': digest, 'mode': int(mode, 8)}
+                elif stream == STDOUT and line == RemoteBuild.OUTPUTS_MARKER:
+                    listing = True
+                else:
+                    Terminal.print_output(stream, line)
+        except IOError, e:
+            raise BuildError('An error occurred with the ssh connection.\n\t> %s' % e, base=e)
+
+        if not command.ok:
+            raise BuildError('The build failed with exit status %s.' % command.status)
+
+        missing = [output for output in self.outputs if not any(path == output or path.startswith(output + '/')
+                                                                for path in manifest)]
+        if missing:
+            raise BuildError('The build did not produce "%s".' % '", "'.join(missing))
+
+        try:
+            self.server.write_file(self.state_path, json.dumps({'inputs': inputs, 'outputs': manifest},
+                                                               sort_keys=True))
+        except ServerError, e:
+            raise BuildError('Could not record the build.\n\t> %s' % e, base=e)
+
+        self.manifest = manifest
+        stats.outputs = len(manifest)
+        return stats
+
+
+class Artifact(object):
+    """ The packaged outputs of a local build: a compressed tar, along with the manifest of its files """
+    ARTIFACTS_DIR = 'artifacts'
+    SHIPPED_FILE = 'shipped'
+    UPLOAD_FILE = 'artifact.tar'
+    DECOMPRESS_COMMANDS = {'zstd': 'zstd -dc', 'gzip': 'gzip -dc'}
+
+    def __init__(self, key, path, compression, manifest, cached=False):
+        self.key = key
+        self.path = path
+        self.compression = compression
+        self.manifest = manifest
+        self.cached = cached
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path)
+
+    @staticmethod
+    def get_shipped_path(app_directory):
+        """ Gets the remote file holding the key of the last artifact shipped to the server. """
+        return '%s/%s/%s' % (app_directory.rstrip('/'), Artifact.ARTIFACTS_DIR, Artifact.SHIPPED_FILE)
+
+    def get_remote_directory(self, app_directory):
+        return '%s/%s/%s' % (app_directory.rstrip('/'), Artifact.ARTIFACTS_DIR, self.key)
+
+    @staticmethod
+    def get_upload_path(app_directory):
+        """ Gets the remote file an artifact is uploaded to, when it is not streamed. """
+        return '%s/%s' % (app_directory.rstrip('/'), Artifact.UPLOAD_FILE)
+
+    def get_script(self, app_directory, uploaded=False):
+        """ Builds the remote program extracting the artifact, streamed on its standard input or uploaded. """
+        incoming = '%s/%s.tmp' % (Artifact.ARTIFACTS_DIR, self.key)
+        decompress = Artifact.DECOMPRESS_COMMANDS[self.compression]
+        if uploaded:
+            decompress = '%s %s' % (decompress, Artifact.UPLOAD_FILE)
+        lines = [
+            'set -e -o pipefail',
+            'cd %s' % Preflight.quote_path(app_directory),
+            # Previous artifacts are already hardlinked in the object store
+            'rm -rf %s && mkdir -p %s' % (Artifact.ARTIFACTS_DIR, incoming),
+            '%s | tar -x -C %s' % (decompress, incoming),
+            'mv %s %s/%s' % (incoming, Artifact.ARTIFACTS_DIR, self.key),
+        ]
+        if uploaded:
+            lines.append('rm -f %s' % Artifact.UPLOAD_FILE)
+        lines.append('echo %s > %s/%s' % (self.key, Artifact.ARTIFACTS_DIR, Artifact.SHIPPED_FILE))
+        return '\n'.join(lines)
+
+    def is_shipped(self, server, app_directory):
+        """ Tells if the server already has the artifact, from the contents gathered by the preflight. """
+        return server.facts['contents'].get(Artifact.get_shipped_path(app_directory)) == self.key
+
+    def _stream(self, server, app_directory):
+        """ Streams the artifact to the server over a single channel, extracting it on the fly.
+
+        Raises:
+            IOError: If the connection dropped while streaming.
+            BuildError: If the artifact could not be extracted.
+
+        """
+        stats = TransferStats()
+        start_time = time.time()
+        with open(self.path, 'rb') as file_handle:
+            command = server.execute('bash -c %s' % pipes.quote(self.get_script(app_directory)),
+                                     stdin=file_handle, label='ship artifact')
+
+        if not command.ok:
+            raise BuildError('Could not extract the artifact.\n\t> %s' % (command.err.rstrip() or command.status))
+
+        stats.size = stats.bytes_sent = command.bytes_in
+        stats.duration = time.time() - start_time
+        return stats
+
+    def _upload(self, server, app_directory):
+        """ Uploads the artifact with a ChunkedUpload, which checks its sha1 remotely, then extracts it. """
+        try:
+            stats = ChunkedUpload(server, self.path, Artifact.get_upload_path(app_directory)).run()
+            status, out, err = server.run_script(self.get_script(app_directory, uploaded=True),
+                                                 label='extract artifact')
+        except TransferError, e:
+            raise BuildError('Could not ship the artifact.\n\t> %s' % e, base=e)
+        except ServerError, e:
+            raise BuildError('Could not extract the artifact.\n\t> %s' % e, base=e)
+
+        if status != 0:
+            raise BuildError('Could not extract the artifact.\n\t> %s' % (err.rstrip() or status))
+        return stats
+
+    def ship(self, server, app_directory):
+        """ Ships the artifact to the server.
+
+        It is streamed through the decompressor and tar over a single channel, without a temporary file. When
+        the connection drops while streaming, or when a previous upload of an artifact did not complete, it
+        is uploaded with a ChunkedUpload instead, which resumes where the link dropped, even on the next deploy.
+
+        Args:
+            server (Server): The remote server.
+            app_directory (string): The remote project directory.
+
+        Returns:
+            TransferStats: What the transfer did.
+
+        Raises:
+            BuildError: If the artifact could not be shipped.
+
+        """
+        # The preflight read the state of an incomplete upload, if there is one
+        upload_state_path = ChunkedUpload.get_state_path(Artifact.get_upload_path(app_directory))
+        if server.facts['contents'].get(upload_state_path):
+            stats = self._upload(server, app_directory)
+        else:
+            # The transport is connected by now, so importing paramiko costs nothing
+            from paramiko import SSHException
+
+            try:
+                stats = self._stream(server, app_directory)
+            except (IOError, EOFError, SSHException):
+                Terminal.print_warn('The connection dropped while streaming the artifact, uploading it instead.')
+                stats = self._upload(server, app_directory)
+                stats.resumes += 1
+
+        server.facts['contents'][Artifact.get_shipped_path(app_directory)] = self.key
+        return stats
+
+
+class LocalBuild(object):
+    """ Builds the project on the local machine, so the servers need no toolchain.
+
+    The build runs in a persistent work tree of the commit, kept in the local cache along with the
+    `$DEPLOY_APP_DIR` of the preset, so incremental builds stay warm. Its outputs are packaged as a tar,
+    compressed with zstd when the `zstandard` module is installed and with gzip otherwise.
+
+    Artifacts are cached by the git tree hash of the commit, so deploying the same tree to other hosts or
+    groups, or deploying it again, reuses the artifact instead of building it again.
+
+    """
+    CACHE_ENTRIES = 10
+    WORK_TREE = 'src'
+    INDEX_FILE = 'build.index'
+    ZSTD_LEVEL = 3
+
+    def __init__(self, repository, project, command, paths):
+        self.repository = repository
+        self.command = command
+        self.paths = [path.strip('/') for path in paths]
+        self.compression = 'zstd' if zstandard is not None else 'gzip'
+        self.cache_dir = os.path.join(FactsCache.get_cache_dir(), 'builds', project)
+
+    @property
+    def work_tree(self):
+        return os.path.join(self.cache_dir, LocalBuild.WORK_TREE)
+
+    def get_key(self, sha):
+        """ Gets the cache key of a commit build: its tree hash, followed by a digest of how it is built. """
+        digest = hashlib.sha1('%s\0%s\0%s' % (self.command, '\0'.join(self.paths), self.compression))
+        return '%s-%s' % (self.repository.commit(sha).tree.hexsha, digest.hexdigest()[:8])
+
+    def _get_entry(self, key):
+        extension = 'tar.zst' if self.compression == 'zstd' else 'tar.gz'
+        return (os.path.join(self.cache_dir, '%s.%s' % (key, extension)),
+                os.path.join(self.cache_dir, '%s.json' % key))
+
+    def _build(self, sha):
+        env = dict(os.environ, GIT_INDEX_FILE=os.path.join(self.cache_dir, LocalBuild.INDEX_FILE))
+        try:
+            subprocess.check_call(['git', '--git-dir', self.repository.git_dir, '--work-tree', self.work_tree,
+                                   'read-tree', '--reset', '-u', sha], env=env)
+        except (OSError, subprocess.CalledProcessError), e:
+            raise BuildError('Could not check out "%s".\n\t> %s' % (sha, e), base=e)
+
+        try:
+            process = subprocess.Popen(['bash', '-c', self.command], cwd=self.work_tree,
+                                       env=dict(os.environ, DEPLOY_APP_DIR=self.cache_dir),
+                                       stdin=open(os.devnull, 'rb'), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            for line in iter(process.stdout.readline, ''):
+                Terminal.print_output(STDOUT, line.rstrip('\r\n'))
+            status = process.wait()
+        except OSError, e:
+            raise BuildError('Could not run the build.\n\t> %s' % e, base=e)
+
+        if status != 0:
+            raise BuildError('The build failed with exit status %s.' % status)
+
+    def _open_compressor(self, file_handle):
+        if self.compression == 'zstd':
+            return zstandard.ZstdCompressor(level=LocalBuild.ZSTD_LEVEL).stream_writer(file_handle)
+        return gzip.GzipFile(fileobj=file_handle, mode='wb')
+
+    def _package(self, archive_path):
+        """ Packages the build outputs as a compressed tar.
+
+        Returns:
+            dict: The manifest of the packaged files, in the DeltaSync manifest format.
+
+        """
+        files = []
+        for path in self.paths:
+            local_path = os.path.join(self.work_tree, path)
+            if os.path.isfile(local_path):
+                files.append(path)
+            elif os.path.isdir(local_path):
+                for root, dirs, names in os.walk(local_path):
+                    dirs.sort()
+                    files.extend(os.path.relpath(os.path.join(root, name), self.work_tree) for name in sorted(names)
+                                 if os.path.isfile(os.path.join(root, name)))
+            else:
+                raise BuildError('The build did not produce "%s".' % path)
+
+        manifest = {}
+        with open(archive_path, 'wb') as file_handle:
+            with self._open_compressor(file_handle) as compressor:
+                archive = tarfile.open(fileobj=compressor, mode='w|')
+                for path in files:
+                    local_path = os.path.join(self.work_tree, path)
+                    digest = hashlib.sha1()
+                    with open(local_path, 'rb') as source:
+                        for block in iter(lambda: source.read(1024 * 1024), ''):
+                            digest.update(block)
+                    manifest[path] = {'sha1': digest.hexdigest(), 'mode': os.stat(local_path).st_mode & 0777}
+                    archive.add(local_path, arcname=path, recursive=False)
+                archive.close()
+
+        return manifest
+
+    def _prune(self):
+        """ Only keeps the most recent cache entries. """
+        entries = sorted((os.path.getmtime(os.path.join(self.cache_dir, name)), name)
+                         for name in os.listdir(self.cache_dir) if name.endswith('.json'))
+        for mtime, name in entries[:-LocalBuild.CACHE_ENTRIES]:
+            key = name[:-len('.json')]
+            for path in self._get_entry(key):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def run(self, sha):
+        """ Builds and packages the commit, unless its tree was already built.
+
+        Args:
+            sha (string): The commit to build.
+
+        Returns:
+            Artifact: The packaged build outputs.
+
+        Raises:
+            BuildError: If the build failed.
+
+        """
+        key = self.get_key(sha)
+        archive_path, manifest_path = self._get_entry(key)
+
+        try:
+            with open(manifest_path, 'r') as file_handle:
+                manifest = json.load(file_handle)
+            if os.path.isfile(archive_path):
+                return Artifact(key, archive_path, self.compression, manifest, cached=True)
+        except (IOError, ValueError):
+            pass
+
+        if not os.path.isdir(self.work_tree):
+            os.makedirs(self.work_tree)
+
+        self._build(sha)
+
+        try:
+            manifest = self._package(archive_path + '.tmp')
+            os.rename(archive_path + '.tmp', archive_path)
+            # The manifest is written last, as it marks the cache entry complete
+            with open(manifest_path + '.tmp', 'w') as file_handle:
+                json.dump(manifest, file_handle)
+            os.rename(manifest_path + '.tmp', manifest_path)
+        except (IOError, OSError, tarfile.TarError), e:
+            raise BuildError('Could not package the build outputs.\n\t> %s' % e, base=e)
+
+        self._prune()
+        return Artifact(key, archive_path, self.compression, manifest)
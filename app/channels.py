@@ -0,0 +1,329 @@
+import collections
+import select
+import StringIO
+import time
+
+from tracing import tracer, Span
+
+STDOUT = 'stdout'
+STDERR = 'stderr'
+
+
+class Command(object):
+    """ A remote command, executed on its own channel of an SSH transport.
+
+    The standard input is either a string or a file object, which is streamed by chunks as the channel window
+    allows, while the output is read.
+
+    Once executed, `status` holds the exit status, `out` and `err` the standard output and error, unless
+    `keep_output` is False, in which case only the last lines are kept in the `tail` ring buffer, for error
+    reports. A command that exceeded its timeout is aborted and flagged with `timed_out`.
+
+    Commands that must authenticate first, such as sudo, have an `auth_prompt`, expected on the standard
+    error, and an `auth_marker`, a line the command prints on the standard output once authenticated. The
+    standard input is only sent once the prompt shows up. If the prompt shows up a second time, if the
+    command exits before printing the marker, or if the authentication exceeds `auth_timeout`, the command is
+    flagged with `auth_failed`. The `timeout` only starts once authenticated.
+
+    """
+    TAIL_LINES = 100
+
+    def __init__(self, command, stdin=None, timeout=None, pty=False, label=None, host=None, keep_output=True,
+                 auth_prompt=None, auth_marker=None, auth_timeout=None):
+        self.command = command
+        self.stdin = stdin
+        self.timeout = timeout
+        self.pty = pty
+        self.label = label
+        self.host = host
+        self.keep_output = keep_output
+        self.auth_prompt = auth_prompt
+        self.auth_marker = auth_marker
+        self.auth_timeout = auth_timeout
+
+        self.status = None
+        self.out = ''
+        self.err = ''
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.tail = collections.deque(maxlen=Command.TAIL_LINES)
+        self.timed_out = False
+        self.auth_failed = False
+        self.authenticated = auth_marker is None
+
+        self._partial = {STDOUT: '', STDERR: ''}
+        self._prompts = 0
+        self._prompt_window = ''
+        self._answered = False
+        self._stdin_source = None
+        self._stdin_buffer = ''
+
+    @property
+    def ok(self):
+        return self.status == 0 and not self.timed_out and not self.auth_failed
+
+    def get_tail(self):
+        """ Gets the last lines of output, both streams interleaved. """
+        return '\n'.join(line for stream, line in self.tail)
+
+    def _count_prompts(self, data):
+        # The prompt may be split between two chunks
+        window = self._prompt_window + data
+        self._prompts += window.count(self.auth_prompt) - self._prompt_window.count(self.auth_prompt)
+        self._prompt_window = window[-(len(self.auth_prompt) - 1):] if len(self.auth_prompt) > 1 else ''
+
+    def _feed(self, stream, data):
+        """ Records a chunk of output.
+
+        Returns:
+            list: The (stream, line) lines completed by the chunk.
+
+        """
+        self.bytes_out += len(data)
+
+        if stream == STDERR and self.auth_prompt is not None:
+            self._count_prompts(data)
+            data = data.replace(self.auth_prompt, '')
+
+        if stream == STDOUT and not self.authenticated:
+            pending = self._partial[STDOUT] + data
+            marker = '%s\n' % self.auth_marker
+            if marker not in pending:
+                self._partial[STDOUT] = pending
+                return []
+            self.authenticated = True
+            self._partial[STDOUT] = ''
+            data = pending.split(marker, 1)[1]
+
+        if self.keep_output:
+            if stream == STDOUT:
+                self.out += data
+            else:
+                self.err += data
+
+        lines = (self._partial[stream] + data).split('\n')
+        self._partial[stream] = lines.pop()
+
+        completed = [(stream, line.rstrip('\r')) for line in lines]
+        self.tail.extend(completed)
+        return completed
+
+    def _flush(self):
+        """ Completes the last lines of output, which did not end with a new line. """
+        completed = []
+        for stream in (STDOUT, STDERR):
+            if self._partial[stream] and (stream == STDERR or self.authenticated):
+                completed.append((stream, self._partial[stream].rstrip('\r')))
+            self._partial[stream] = ''
+
+        self.tail.extend(completed)
+        return completed
+
+
+class ChannelMultiplexer(object):
+    """ Drives many remote commands at once from a single select loop.
+
+    Every command gets its own channel, so independent commands run concurrently instead of paying one
+    round trip each. Commands may belong to different transports, which lets a single loop drive many hosts.
+    Their output can be consumed line by line as it arrives, with `iter_run`. The standard input is written
+    from the same loop, so a command whose output fills the window while it still reads its input goes on.
+
+    """
+    RECV_SIZE = 32 * 1024
+    # Window adjustments do not wake select up, so a channel waiting for one is polled
+    STDIN_POLL = 0.01
+
+    def __init__(self):
+        self._pending = []
+
+    def add(self, transport, command):
+        """ Registers a command to execute.
+
+        Args:
+            transport (Transport): The SSH transport to execute the command on.
+            command (Command): The command.
+
+        Returns:
+            Command: The same command, filled once it completed.
+
+        """
+        self._pending.append((transport, command))
+        return command
+
+    @staticmethod
+    def _start_stdin(channel, command):
+        """ Starts sending the standard input, or closes it if there is none. """
+        if command.stdin is not None:
+            command._stdin_source = command.stdin if hasattr(command.stdin, 'read') \
+                else StringIO.StringIO(command.stdin)
+        elif not command.pty:
+            channel.shutdown_write()
+
+    @staticmethod
+    def _send_stdin(channel, command):
+        """ Sends as much of the standard input as the channel window allows, and closes it once it was all
+            sent. """
+        while command._stdin_source is not None and channel.send_ready():
+            if channel.exit_status_ready():
+                # The command exited without reading the rest
+                command._stdin_source, command._stdin_buffer = None, ''
+                return
+
+            if not command._stdin_buffer:
+                command._stdin_buffer = command._stdin_source.read(ChannelMultiplexer.RECV_SIZE)
+                if not command._stdin_buffer:
+                    command._stdin_source = None
+                    if not command.pty:
+                        channel.shutdown_write()
+                    return
+
+            sent = channel.send(command._stdin_buffer)
+            command._stdin_buffer = command._stdin_buffer[sent:]
+            command.bytes_in += sent
+
+    @staticmethod
+    def _open(transport, command):
+        channel = transport.open_session()
+        if command.pty:
+            channel.get_pty()
+        channel.exec_command(command.command)
+
+        channel.setblocking(0)
+        if command.auth_prompt is None:
+            ChannelMultiplexer._start_stdin(channel, command)
+
+        return channel
+
+    @staticmethod
+    def _get_deadline(command, start):
+        timeout = command.timeout if command.authenticated else command.auth_timeout
+        return start + timeout if timeout is not None else None
+
+    @staticmethod
+    def _answer_prompt(channel, command):
+        """ Answers the authentication prompt, or detects that the answer was refused.
+
+        Returns:
+            bool: If the command can go on.
+
+        """
+        if command.auth_prompt is None:
+            return True
+
+        if command._prompts > 1:
+            command.auth_failed = True
+            return False
+
+        if not command._answered and (command._prompts > 0 or command.authenticated):
+            command._answered = True
+            if command._prompts > 0:
+                ChannelMultiplexer._start_stdin(channel, command)
+            elif not command.pty:
+                channel.shutdown_write()
+        return True
+
+    @staticmethod
+    def _trace(command, span):
+        span.args.update({
+            'command': command.command[:200],
+            'exit_code': command.status,
+            'bytes_in': command.bytes_in,
+            'bytes_out': command.bytes_out,
+            'timed_out': command.timed_out,
+        })
+        tracer.record(span)
+
+    def iter_run(self):
+        """ Executes every registered command, yielding their output lines as they arrive.
+
+        Yields:
+            tuple: The command, the stream (STDOUT or STDERR) and the line, without its line ending.
+
+        Raises:
+            IOError: If a channel could not be opened.
+
+        """
+        pending, self._pending = self._pending, []
+
+        running = {}
+        spans = {}
+        try:
+            for transport, command in pending:
+                spans[id(command)] = Span(command.label or command.command.split(' ', 1)[0], 'remote', command.host)
+                channel = ChannelMultiplexer._open(transport, command)
+                running[channel] = (command, ChannelMultiplexer._get_deadline(command, time.time()))
+
+            while running:
+                sending = False
+                for channel, (command, deadline) in running.items():
+                    ChannelMultiplexer._send_stdin(channel, command)
+                    sending = sending or command._stdin_source is not None
+
+                deadlines = [deadline for command, deadline in running.values() if deadline is not None]
+                wait = max(0, min(deadlines) - time.time()) if deadlines else None
+                if sending:
+                    wait = min(wait, ChannelMultiplexer.STDIN_POLL) if wait is not None \
+                        else ChannelMultiplexer.STDIN_POLL
+                readable, _, _ = select.select(list(running), [], [], wait)
+
+                for channel in readable:
+                    command, deadline = running[channel]
+                    was_authenticated = command.authenticated
+
+                    lines = []
+                    while channel.recv_ready():
+                        lines.extend(command._feed(STDOUT, channel.recv(ChannelMultiplexer.RECV_SIZE)))
+                    while channel.recv_stderr_ready():
+                        lines.extend(command._feed(STDERR, channel.recv_stderr(ChannelMultiplexer.RECV_SIZE)))
+
+                    if command.authenticated and not was_authenticated:
+                        running[channel] = (command, ChannelMultiplexer._get_deadline(command, time.time()))
+
+                    done = False
+                    if not ChannelMultiplexer._answer_prompt(channel, command):
+                        done = True
+                    elif channel.exit_status_ready() and not channel.recv_ready() \
+                            and not channel.recv_stderr_ready():
+                        command.status = channel.recv_exit_status()
+                        command.auth_failed = not command.authenticated
+                        done = True
+
+                    if done:
+                        channel.close()
+                        del running[channel]
+                        lines.extend(command._flush())
+                        ChannelMultiplexer._trace(command, spans.pop(id(command)))
+
+                    for stream, line in lines:
+                        yield command, stream, line
+
+                now = time.time()
+                for channel, (command, deadline) in list(running.items()):
+                    if deadline is not None and now >= deadline:
+                        if command.authenticated:
+                            command.timed_out = True
+                        else:
+                            command.auth_failed = True
+                        channel.close()
+                        del running[channel]
+                        ChannelMultiplexer._trace(command, spans.pop(id(command)))
+        finally:
+            for channel, (command, deadline) in running.items():
+                channel.close()
+                ChannelMultiplexer._trace(command, spans.pop(id(command)))
+
+    def run(self):
+        """ Executes every registered command and waits for all of them to complete.
+
+        Returns:
+            list: The executed commands, in the order they were added.
+
+        Raises:
+            IOError: If a channel could not be opened.
+
+        """
+        commands = [command for transport, command in self._pending]
+        for _ in self.iter_run():
+            pass
+
+        return commands
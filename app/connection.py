@@ -0,0 +1,115 @@
+import collections
+import threading
+
+from tracing import tracer
+
+
+class HostKey(collections.namedtuple('HostKey', ['address', 'port', 'user'])):
+    """ Identifies a server by its (address, port, user), as several servers may share an address """
+    __slots__ = ()
+
+    @staticmethod
+    def from_config(server_config):
+        """ Gets the key of a server config (dict). """
+        return HostKey(server_config['address'], server_config.get('port', 22), server_config['user'])
+
+    @property
+    def slug(self):
+        """ A name for the server, unique among the keys, that fits in file and git ref names. """
+        return '%s@%s-%d' % (self.user, self.address, self.port)
+
+    def __str__(self):
+        return self.address if self.port == 22 else '%s:%d' % (self.address, self.port)
+
+
+class ConnectionPool(object):
+    """ Keeps a single authenticated SSH transport per (address, port, user) and shares it between callers.
+
+    Every Server created with the same pool reuses the same transport, so a whole deploy run only pays
+    for one TCP connection and key exchange per host. A transport that dropped is transparently replaced
+    the next time it is requested.
+
+    """
+
+    def __init__(self):
+        self._clients = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        self.handshakes = {}
+
+    def _host_lock(self, key):
+        with self._lock:
+            if key not in self._locks:
+                self._locks[key] = threading.Lock()
+            return self._locks[key]
+
+    @staticmethod
+    def _is_alive(client):
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def get_client(self, address, user, port=22):
+        """ Gets a connected SSH client for the given host, connecting only if required.
+
+        Args:
+            address (string): The remote server address.
+            user (string): The remote server user.
+            port (Optional[int]): The remote server SSH port. Defaults to 22.
+
+        Returns:
+            SSHClient: A client with an active, authenticated transport.
+
+        Raises:
+            IOError: If the connection cannot be established.
+
+        """
+        # paramiko and its crypto backends are slow to import, and only needed once connecting
+        from paramiko import SSHClient, AutoAddPolicy
+
+        key = HostKey(address, port, user)
+
+        with self._host_lock(key):
+            client = self._clients.get(key)
+            if client is not None and self._is_alive(client):
+                return client
+
+            if client is not None:
+                client.close()
+
+            client = SSHClient()
+            client.load_system_host_keys()
+            client.set_missing_host_key_policy(AutoAddPolicy())
+            with tracer.span('SSH handshake', 'ssh', host=address, user=user):
+                client.connect(address, port=port, username=user)
+
+            self._clients[key] = client
+            self.handshakes[key] = self.handshakes.get(key, 0) + 1
+
+            return client
+
+    def get_handshakes(self, address=None, user=None, port=None):
+        """ Gets the number of SSH handshakes performed by this pool.
+
+        Args:
+            address (Optional[str]): Only count handshakes for this address. Defaults to None.
+            user (Optional[str]): Only count handshakes for this user. Defaults to None.
+            port (Optional[int]): Only count handshakes for this port. Defaults to None.
+
+        Returns:
+            int: The number of handshakes.
+
+        """
+        return sum(count for key, count in self.handshakes.items()
+                   if (address is None or key.address == address) and (user is None or key.user == user)
+                   and (port is None or key.port == port))
+
+    def close(self, address, user, port=22):
+        key = HostKey(address, port, user)
+        with self._host_lock(key):
+            client = self._clients.pop(key, None)
+            if client is not None:
+                client.close()
+
+    def close_all(self):
+        for key in list(self._clients.keys()):
+            self.close(key.address, key.user, key.port)
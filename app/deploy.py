@@ -1,16 +1,44 @@
 # coding=utf-8
 
+import hashlib
 import json
 import os
+import re
+import time
 
-from git import Repo, InvalidGitRepositoryError
-
-from utilities import get_string, valid_address, valid_config, get_installed_presets, load_preset, get_supervisor_config
+from utilities import get_string, valid_address, valid_config, get_installed_presets, load_preset, \
+    get_supervisor_config, format_bytes, format_uptime
 
 from terminal import Terminal
 
 from server import Server, ServerError
 
+from connection import ConnectionPool, HostKey
+
+from executor import HostExecutor
+
+from facts import FactsCache
+
+from sync import DeltaSync, SyncError, get_directory_digest
+
+from release import Release, ReleaseHistory, ReleaseError
+
+from build import RemoteBuild, LocalBuild, Artifact, BuildError
+
+from transfer import ChunkedUpload
+
+from restart import Restart, RestartError
+
+from seed import RepositorySeed, SeedError
+
+from scripts import ScriptStage, ScriptError
+
+from watch import FileWatcher, WatchSession, WatchError
+
+from status import FleetStatus, StatusCache, compare_to_head
+
+from tracing import tracer
+
 
 class DeployError(Exception):
     """ Base exception class for Deploy program.  """
@@ -21,13 +49,20 @@ class DeployError(Exception):
 
 
 class Deploy(object):
-    def __init__(self, command):
+    def __init__(self, command, options=None):
         self.cmd = command
+        self.options = options if options is not None else {}
         self.commands = {
             'init': self._cmd_init,
             'now': self._cmd_now,
+            'watch': self._cmd_watch,
+            'status': self._cmd_status,
+            'rollback': self._cmd_rollback,
         }
         self.presets = get_installed_presets()
+        self.pool = ConnectionPool()
+        # Spans are only kept when they are written out, a watch session would pile them up otherwise
+        tracer.enabled = bool(self.options.get('trace'))
 
     def _cmd_init(self):
         """ Interactively creates a config file
@@ -71,6 +106,13 @@ class Deploy(object):
             validate=valid_address,
             error_msg='The address must be a valid IP or hostname.')
 
+        #   Server SSH port
+        srv_port = int(get_string(
+            'Enter the remote server SSH port.',
+            default='22',
+            validate=lambda x: x.isdigit() and 0 < int(x) < 65536,
+            error_msg='The port must be a number between 1 and 65535.'))
+
         #   Server user
         srv_user = get_string(
             'Enter the remote server user.',
@@ -78,7 +120,8 @@ class Deploy(object):
             error_msg='The user field cannot be empty.')
 
         # Test SSH connection
-        valid, err = Server(srv_address, srv_user).has_valid_connection()
+        with Server(srv_address, srv_user, port=srv_port) as server:
+            valid, err = server.has_valid_connection()
         if not valid:
             Terminal.print_warn('Could not validate SSH connection.\n\t> %s' % err)
 
@@ -101,6 +144,8 @@ class Deploy(object):
                 'after': []
             }
         }
+        if srv_port != 22:
+            config['server']['port'] = srv_port
 
         try:
             with open('.deploy', 'w+') as file_handle:
@@ -136,13 +181,99 @@ class Deploy(object):
             DeployError: if there is no git repository.
 
         """
+        # GitPython is slow to import, and only needed by the commands working on the repository
+        from git import Repo, InvalidGitRepositoryError
+
         try:
             self.repository = Repo(os.getcwd())
         except InvalidGitRepositoryError, e:
             raise DeployError('No git repository was found.\n\t> %s' % e, base=e)
 
-    def _cmd_now(self):
-        """ Tries to synchronize the project state with the remote server, then reloads the app remotely.
+    def _load_preset(self):
+        """ Validates and loads the preset selected in the config.
+
+        Returns:
+            Preset: An instance of the preset.
+
+        Raises:
+            DeployError: If the preset does not exist or cannot be loaded.
+
+        """
+        preset_name = self.config['project']['preset']
+        if preset_name not in self.presets:
+            raise DeployError('Invalid preset. %s was not found in %s' % (preset_name, self.presets))
+
+        preset_class = load_preset(preset_name)
+        if preset_class is None:
+            raise DeployError('Unable to load preset %s.' % preset_name)
+
+        return preset_class()
+
+    def _get_servers(self):
+        """ Gets the servers targeted by the current command, from the config and the command line options.
+
+        Returns:
+            list: The selected server configs (dicts), in config order.
+
+        Raises:
+            DeployError: If no server matches the selection.
+
+        """
+        servers = self.config['servers'] if 'servers' in self.config else [self.config['server']]
+
+        group = self.options.get('group')
+        if group is not None:
+            members = self.config.get('groups', {}).get(group, [])
+            servers = [s for s in servers if s['address'] in members or group in s.get('groups', [])]
+
+        hosts = self.options.get('hosts')
+        if hosts is not None:
+            servers = [s for s in servers if s['address'] in hosts.split(',')]
+
+        if len(servers) == 0:
+            raise DeployError('No server matches the selected hosts or group.')
+
+        return servers
+
+    def _get_remote_name(self, server_config):
+        """ Gets the name of the local git remote pointing at a server. """
+        if 'servers' in self.config and len(self.config['servers']) > 1:
+            return 'deploy-%s' % HostKey.from_config(server_config).slug
+        return 'deploy'
+
+    def _set_remote(self, server_config):
+        """ Makes sure the local repository has a git remote pointing at the server's bare repository.
+
+        Args:
+            server_config (dict): The server config.
+
+        """
+        remote_name = self._get_remote_name(server_config)
+        host = server_config['address']
+        if server_config.get('port', 22) != 22:
+            host = '%s:%d' % (host, server_config['port'])
+        remote_repo_url = 'ssh://{0}@{1}/home/{0}/.deploy/{2}/src.git'.format(
+            server_config['user'], host, self.config['project']['name'])
+        try:
+            remote_repo = self.repository.remote(name=remote_name)
+            if remote_repo.url != remote_repo_url:
+                cw = remote_repo.config_writer
+                cw.set('url', remote_repo_url)
+        except ValueError, e:
+            self.repository.create_remote(remote_name, remote_repo_url)
+
+    def _get_rollout_option(self, name, default):
+        """ Gets a rollout option, from the command line first and then from the config. """
+        if self.options.get(name) is not None:
+            return self.options[name]
+        return self.config.get('rollout', {}).get(name, default)
+
+    def _prepare(self):
+        """ Runs the initial assertions shared by the commands deploying the project.
+
+        Returns:
+            tuple: The loaded preset (Preset), the targeted server configs (dicts) and the locally built
+                artifact (Artifact), None unless in local build mode.
 
         Raises:
             DeployError: If any of the assertion steps fails.
@@ -158,102 +289,751 @@ class Deploy(object):
         self._read_repository()
         Terminal.print_assert_valid("Found git repository.")
 
+        # [x] validate and load preset
+        preset = self._load_preset()
+        Terminal.print_assert_valid("Loaded preset.")
+
+        # [x] Local repo has the remote servers
+        servers = self._get_servers()
+        for server_config in servers:
+            self._set_remote(server_config)
+
+        Terminal.print_assert_valid("Local repository has valid remote.")
+
+        # Empty remote repositories are seeded from a bundle shared by every server
+        self.seed = RepositorySeed(self.repository, self.config['project']['name'],
+                                   self.config['project'].get('history_depth'))
+
+        # [x] The before and after scripts are valid, their local ones run once for every server
+        self.scripts = {}
+        for stage in ('before', 'after'):
+            self.scripts[stage] = ScriptStage(stage, self.config['scripts'].get(stage, []),
+                                              self.config['project']['name'])
+            try:
+                self.scripts[stage].validate()
+            except ScriptError, e:
+                raise DeployError('Invalid scripts.\n\t> %s' % e, base=e)
+
+        # [x] Build once locally for every server, in local build mode
+        artifact = None
+        if self.config['project'].get('build_mode', 'remote') == 'local':
+            artifact = self._build_locally(preset)
+
+        return preset, servers, artifact
+
+    def _run_on_servers(self, servers, task):
+        """ Runs a task against every server, concurrently in rolling batches when there are several.
+
+        Args:
+            servers (list): The server configs (dicts).
+            task (function): The task, called with the server config as its only argument.
+
+        Raises:
+            DeployError: If the task failed on any server.
+
+        """
+        if len(servers) == 1:
+            task(servers[0])
+            return
+
+        executor = HostExecutor(
+            concurrency=self._get_rollout_option('parallel', 10),
+            batch_size=self._get_rollout_option('batch', None),
+            max_failure_ratio=self._get_rollout_option('max_failure_ratio', 0.0))
+
+        by_key = dict((HostKey.from_config(s), s) for s in servers)
+        results = executor.run([HostKey.from_config(s) for s in servers], lambda host: task(by_key[host]))
+
+        Terminal.print_host_results(results)
+
+        failures = len([result for result in results if not result.ok])
+        if failures > 0:
+            raise DeployError('Deploy failed on %d of %d hosts.' % (failures, len(results)))
+
+    def _cmd_now(self):
+        """ Tries to synchronize the project state with the remote servers, then reloads the app remotely.
+
+        Raises:
+            DeployError: If any of the assertion steps fails.
+
+        """
+        preset, servers, artifact = self._prepare()
+        self._run_on_servers(servers, lambda server_config: self._deploy_to(server_config, preset, artifact))
+
+    def _get_watched_directories(self):
+        """ Gets the directories watched for changes: the source directory, the project root if there is none,
+            and the build directory. """
+        directories = self.config['project'].get('directories', {})
+        watched = [os.path.normpath(directories.get('source') or '.')]
+        build_directory = directories.get('build')
+        if build_directory and not any(directory == '.' or (os.path.normpath(build_directory) + '/').startswith(
+                directory + '/') for directory in watched):
+            watched.append(os.path.normpath(build_directory))
+        return [directory for directory in watched if os.path.isdir(directory)]
+
+    def _get_ignored(self, paths):
+        """ Gets the paths git ignores, the build directory aside, so editor and tool files are not shipped. """
+        # Imported along with the repository, so it is already loaded
+        from git import GitCommandError
+
+        build_directory = self.config['project'].get('directories', {}).get('build')
+        build_prefix = os.path.normpath(build_directory) + '/' if build_directory else None
+        paths = [path for path in paths if build_prefix is None or not (path + '/').startswith(build_prefix)]
+        if not paths:
+            return set()
+
+        try:
+            # Exits with 1 when none of the paths is ignored
+            return set(self.repository.git.check_ignore(*paths).splitlines())
+        except GitCommandError:
+            return set()
+
+    def _start_watch(self, server_config, preset, artifact, sessions):
+        """ Deploys the project to a server, then prepares the session applying the following changes to it. """
+        server = self._deploy_to(server_config, preset, artifact)
+        config = dict(self.config, server=server_config)
+        app_directory = '~/.deploy/%s' % self.config['project']['name']
+        restart = Restart(server, config, app_directory)
+        watch = WatchSession(server, app_directory, self.config['project'].get('directories', {}).get('build'),
+                             links=restart.get_reload_links())
+        sessions[HostKey.from_config(server_config)] = watch, restart
+
+    def _apply_changes(self, watch, restart, preset, changed, removed):
+        """ Applies a batch of changes to a server, restarting the program if the preset requires it.
+
+        Raises:
+            DeployError: If the changes could not be applied, or the program could not restart.
+
+        """
+        server = watch.server
+        fingerprint_path = '~/.deploy/%s/fingerprint' % self.config['project']['name']
+        try:
+            with tracer.span('Apply', host=server.address) as span:
+                stats = watch.apply(changed, removed, fingerprint_path)
+                span.args.update(changed=stats.changed, removed=stats.removed, bytes_sent=stats.bytes_sent)
+        except WatchError, e:
+            raise DeployError('Could not apply the changes.\n\t> %s' % e, base=e)
+
+        if not stats.changed and not stats.removed:
+            return
+
+        StatusCache(self.config['project']['name']).invalidate(server.key)
+
+        Terminal.print_assert_valid('Applied %d changed and %d removed file(s), sent %s.', stats.changed,
+                                    stats.removed, format_bytes(stats.bytes_sent), duration=span.duration)
+
+        if stats.switched or preset.requires_restart(changed + removed):
+            try:
+                with tracer.span('Restart', host=server.address) as span:
+                    restart_stats = restart.reload()
+            except RestartError, e:
+                raise DeployError('Could not restart the program.\n\t> %s' % e, base=e)
+
+            Terminal.print_assert_valid('Restarted "%s".', restart_stats.program, duration=span.duration)
+
+    def _cmd_watch(self):
+        """ Deploys the project, then ships the files changed under the source and build directories as they
+            are saved, without a commit, over the connections kept open. The program is restarted when the
+            preset requires it.
+
+        Raises:
+            DeployError: If any of the assertion steps fails.
+
+        """
+        preset, servers, artifact = self._prepare()
+
+        directories = self._get_watched_directories()
+        if not directories:
+            raise DeployError('Nothing to watch, the source and build directories do not exist.')
+
+        sessions = {}
+        self._run_on_servers(servers, lambda server_config: self._start_watch(server_config, preset, artifact,
+                                                                              sessions))
+
+        watcher = FileWatcher(directories, ignore=self._get_ignored)
+        Terminal.print_info('Watching "%s" for changes (%s), press Ctrl-C to stop.', '", "'.join(directories),
+                            watcher.backend)
+        try:
+            while True:
+                changed, removed = watcher.next_changes()
+                start = time.time()
+
+                def apply_changes(server_config):
+                    watch, restart = sessions[HostKey.from_config(server_config)]
+                    self._apply_changes(watch, restart, preset, changed, removed)
+
+                try:
+                    self._run_on_servers(servers, apply_changes)
+                except DeployError, e:
+                    # A failed batch is reported, and the next one tries again
+                    Terminal.print_error(str(e))
+                    continue
+                Terminal.print_info('Shipped the changes in %.2fs.', time.time() - start)
+        except KeyboardInterrupt:
+            Terminal.print_info('Stopped watching.')
+        finally:
+            watcher.close()
+
+    def _get_status_row(self, status, head, comparisons):
+        """ Gets the cells of the status table for a server. """
+        if status.error is not None:
+            return [str(status.host), '-', '-', '-', 'unreachable', status.error.split('\n')[0]]
+
+        if status.sha is None:
+            release, drift = 'none', '-'
+        else:
+            if status.sha not in comparisons:
+                comparisons[status.sha] = compare_to_head(self.repository, status.sha, head)
+            release = status.sha[:10] + (' (watch)' if status.watched else '')
+            drift = comparisons[status.sha]
+
+        process = status.get_process()
+        if status.supervisor_error is not None:
+            program, state, uptime = '-', 'unknown', status.supervisor_error
+        elif process is None:
+            program, state, uptime = '-', 'not installed', ''
+        else:
+            program, state = process['name'], process['state']
+            uptime = format_uptime(process['uptime']) if process['uptime'] is not None else ''
+
+        return [str(status.host), release, drift, program, state, uptime]
+
+    def _cmd_status(self):
+        """ Reports what every server runs: its release and how it compares to the local head, and the state
+            and uptime of the project program.
+
+        Raises:
+            DeployError: If the config is invalid or no server matches the selection.
+
+        """
+        self._read_config()
+        self._read_repository()
+        servers = self._get_servers()
+
+        fleet = FleetStatus(self.config, self.pool, concurrency=self.options.get('parallel') or FleetStatus.CONCURRENCY)
+        with tracer.span('Status') as span:
+            statuses = fleet.probe(servers, refresh=self.options.get('refresh_facts'))
+
+        head = self.repository.commit('master').hexsha
+        comparisons = {}
+        Terminal.print_table(['HOST', 'RELEASE', 'HEAD', 'PROGRAM', 'STATE', 'UPTIME'],
+                             [self._get_status_row(status, head, comparisons) for status in statuses])
+
+        cached = len([status for status in statuses if status.cached])
+        Terminal.print_info('Queried %d server(s) in %.2fs, %d status(es) were cached.', len(statuses) - cached,
+                            span.duration, cached)
+
+    def _get_rollback_target(self):
+        """ Gets the release to roll back to, from the command line.
+
+        Returns:
+            tuple: How many releases to go back, or None, and the commit or beginning of commit to go back to,
+                or None.
+
+        Raises:
+            DeployError: If the target is neither a number of releases nor a commit.
+
+        """
+        # GitPython is imported along with the repository
+        from gitdb.exc import BadName, BadObject
+
+        target = self.options.get('target') or '1'
+        if target.isdigit() and len(target) < 4:
+            if int(target) < 1:
+                raise DeployError('Cannot roll back %s releases.' % target)
+            return int(target), None
+
+        # Branches, tags and abbreviated commits are resolved locally, unknown commits are looked up remotely
+        try:
+            return None, self.repository.commit(target).hexsha
+        except (BadName, BadObject, ValueError), e:
+            if not re.match(r'^[0-9a-f]{4,40}$', target):
+                raise DeployError('Invalid release "%s", expected a number of releases or a commit.\n\t> %s'
+                                  % (target, e), base=e)
+            return None, target
+
+    def _cmd_rollback(self):
+        """ Points the servers back at a release they kept, with the supervisor config it was deployed with,
+            then restarts the program. Nothing is pushed nor built.
+
+        Raises:
+            DeployError: If the release is not kept, or the program could not restart.
+
+        """
+        self._read_config()
+        Terminal.print_assert_valid("Config file is valid.")
+
+        self._read_repository()
+        steps, sha = self._get_rollback_target()
+        servers = self._get_servers()
+
+        self._run_on_servers(servers, lambda server_config: self._rollback_on(server_config, steps, sha))
+
+    def _rollback_on(self, server_config, steps, sha):
+        """ Rolls a single server back to a release it kept.
+
+        Raises:
+            DeployError: If the release is not kept, or the program could not restart.
+
+        """
+        server = Server(server_config['address'], server_config['user'], pool=self.pool,
+                        port=server_config.get('port', 22))
+        facts_cache = FactsCache(server.key)
+        server.facts.update(facts_cache.load())
+
+        with tracer.span('Connect', host=server.address) as span:
+            valid, err = server.has_valid_connection()
+        if not valid:
+            raise DeployError('Impossible to connect to remote host.\n\t> %s' % err, base=err)
+
+        Terminal.print_assert_valid("Successfully connected to remote server.", duration=span.duration)
+
+        project_name = self.config['project']['name']
+        app_directory = '~/.deploy/%s' % project_name
+        restart = Restart(server, dict(self.config, server=server_config), app_directory)
+        history = ReleaseHistory(server, app_directory)
+        supervisor_dirs = [server.facts['supervisor_dir']] if 'supervisor_dir' in server.facts \
+            else Server.SUPERVISOR_CONFIG_DIRS
+
+        try:
+            with tracer.span('Rollback', host=server.address) as span:
+                stats = history.rollback(steps, sha, links=restart.get_rollback_links(),
+                                         slot_lines=restart.get_target_slot_lines(),
+                                         config_paths=['%s/%s.conf' % (directory, project_name.lower())
+                                                       for directory in supervisor_dirs],
+                                         fingerprint_path='%s/fingerprint' % app_directory,
+                                         current=restart.switches_current())
+        except ReleaseError, e:
+            raise DeployError('Could not roll back.\n\t> %s' % e, base=e)
+        finally:
+            StatusCache(project_name).invalidate(server.key)
+
+        if stats.unchanged:
+            Terminal.print_assert_valid('Release "%s" is already the current one.', stats.release)
+            return
+
+        Terminal.print_assert_valid('Switched from release "%s" to "%s".', stats.previous, stats.release,
+                                    duration=span.duration)
+
+        # [x] Install the supervisor config the release was deployed with, when it differs
+        if stats.supervisor_config is not None:
+            try:
+                with tracer.span('Supervisor', host=server.address) as span:
+                    server.set_supervisor_config(project_name, stats.supervisor_config)
+            except ServerError, e:
+                raise DeployError('Server error.\n\t> %s' % e, base=e)
+
+            Terminal.print_assert_valid('Installed the supervisor config of the release.', duration=span.duration)
+
+        server.facts['contents'][restart.active_path] = stats.active
+        self._restart(server, restart)
+        facts_cache.save(server.facts)
+
+    def _build_locally(self, preset):
+        """ Builds the project locally with the preset, and packages its build directory.
+
+        Args:
+            preset (Preset): The loaded project preset.
+
+        Returns:
+            Artifact: The packaged build outputs.
+
+        Raises:
+            DeployError: If the preset has nothing to build, or if the build failed.
+
+        """
+        build_command = preset.prepare()
+        if not build_command:
+            raise DeployError('The preset has no build to run locally.')
+
+        build_directory = self.config['project'].get('directories', {}).get('build')
+        paths = [build_directory] if build_directory else preset.get_build_outputs()
+
+        local_build = LocalBuild(self.repository, self.config['project']['name'], build_command, paths)
+        try:
+            with tracer.span('Local build') as span:
+                artifact = local_build.run(self.repository.commit('master').hexsha)
+                span.args.update(cached=artifact.cached, files=len(artifact.manifest), size=artifact.size)
+        except BuildError, e:
+            raise DeployError('Could not build the project locally.\n\t> %s' % e, base=e)
+
+        if artifact.cached:
+            Terminal.print_assert_valid('Reused the cached build of this tree, %d files, %s.', len(artifact.manifest),
+                                        format_bytes(artifact.size), duration=span.duration)
+        else:
+            Terminal.print_assert_valid('Built the project locally, %d files, %s.', len(artifact.manifest),
+                                        format_bytes(artifact.size), duration=span.duration)
+
+        return artifact
+
+    def _deploy_to(self, server_config, preset, artifact=None):
+        """ Synchronizes the project state with a single remote server, then reloads the app remotely.
+
+        Args:
+            server_config (dict): The server config.
+            preset (Preset): The loaded project preset.
+            artifact (Optional[Artifact]): The locally built outputs, in local build mode. Defaults to None.
+
+        Returns:
+            Server: The server, whose connection stays open until the command is over.
+
+        Raises:
+            DeployError: If any of the assertion steps fails.
+
+        """
+        server = Server(server_config['address'], server_config['user'], pool=self.pool,
+                        port=server_config.get('port', 22))
+
+        # Host facts gathered by previous runs let us skip most of the discovery work
+        facts_cache = FactsCache(server.key)
+        if self.options.get('refresh_facts'):
+            facts_cache.invalidate()
+        server.facts.update(facts_cache.load())
+
+        try:
+            with tracer.span('Deploy', host=server.address):
+                self._deploy_steps(server, dict(self.config, server=server_config), preset, artifact)
+        except DeployError:
+            facts_cache.invalidate()
+            raise
+        finally:
+            StatusCache(self.config['project']['name']).invalidate(server.key)
+
+        facts_cache.save(server.facts)
+        return server
+
+    def _get_fingerprint(self, config, preset, artifact=None):
+        """ Computes the fingerprint of what a deploy would ship to a server.
+
+        It covers the commit that would be pushed, the build directory or the locally built artifact, the
+        rendered supervisor config and the scripts, so two deploys with the same fingerprint leave the server in
+        the same state.
+
+        Args:
+            config (dict): The config, where 'server' is the remote server config.
+            preset (Preset): The loaded project preset.
+            artifact (Optional[Artifact]): The locally built outputs, in local build mode. Defaults to None.
+
+        Returns:
+            string: The fingerprint.
+
+        """
+        build_directory = config['project'].get('directories', {}).get('build')
+        if artifact is not None:
+            build_digest = artifact.key
+        else:
+            build_digest = get_directory_digest(build_directory) if build_directory else ''
+        supervisor_digest = hashlib.sha1(get_supervisor_config(config, preset)).hexdigest()
+        scripts_digest = hashlib.sha1(json.dumps(config['scripts'], sort_keys=True)).hexdigest()
+
+        return '%s %s %s %s' % (self.repository.commit('master').hexsha, build_digest, supervisor_digest,
+                                scripts_digest)
+
+    @staticmethod
+    def _trace_transfer(span, stats):
+        span.args.update(size=stats.size, bytes_sent=stats.bytes_sent, bytes_resumed=stats.bytes_resumed,
+                         resumes=stats.resumes, throughput=stats.throughput)
+
+    @staticmethod
+    def _print_transfer(stats):
+        """ Prints the throughput of an upload, and how it resumed. """
+        Terminal.print_info('Sent %s at %s/s.', format_bytes(stats.bytes_sent), format_bytes(stats.throughput))
+        if stats.bytes_resumed:
+            Terminal.print_info('Resumed a previous upload, %s were already there.', format_bytes(stats.bytes_resumed))
+        if stats.resumes:
+            Terminal.print_info('Resumed %d time(s) after the connection dropped.', stats.resumes)
+
+    def _run_scripts(self, stage, server, app_directory, release_directory):
+        """ Runs the scripts of a stage, if there are any.
+
+        Raises:
+            DeployError: If a script failed.
+
+        """
+        if not self.scripts[stage].scripts:
+            return
+
+        try:
+            with tracer.span('Scripts %s' % stage, host=server.address) as span:
+                stats = self.scripts[stage].run(server, app_directory, release_directory)
+                span.args.update(ran=stats.ran, skipped=stats.skipped)
+        except ScriptError, e:
+            raise DeployError('Could not run the %s scripts.\n\t> %s' % (stage, e), base=e)
+
+        Terminal.print_assert_valid('Ran %d %s script(s), skipped %d whose inputs did not change.', stats.ran, stage,
+                                    stats.skipped, duration=span.duration)
+
+    @staticmethod
+    def _restart(server, restart):
+        """ Restarts the program, or switches to the other blue/green slot once it is healthy.
+
+        Raises:
+            DeployError: If the program could not restart.
+
+        """
+        try:
+            with tracer.span('Restart', host=server.address) as span:
+                restart_stats = restart.run()
+                span.args.update(program=restart_stats.program, time_to_healthy=restart_stats.time_to_healthy)
+        except RestartError, e:
+            raise DeployError('Could not restart the program.\n\t> %s' % e, base=e)
+
+        if restart_stats.previous is not None:
+            Terminal.print_assert_valid('Switched from "%s" to "%s".', restart_stats.previous, restart_stats.program,
+                                        duration=span.duration)
+        else:
+            Terminal.print_assert_valid('Restarted "%s".', restart_stats.program, duration=span.duration)
+
+        if restart_stats.time_to_healthy is not None:
+            Terminal.print_info('"%s" was healthy after %.2fs.', restart_stats.program, restart_stats.time_to_healthy)
+
+    def _deploy_steps(self, server, config, preset, artifact=None):
+        """ Runs every deploy step against a single remote server.
+
+        Args:
+            server (Server): The remote server.
+            config (dict): The config, where 'server' is the remote server config.
+            preset (Preset): The loaded project preset.
+            artifact (Optional[Artifact]): The locally built outputs, in local build mode. Defaults to None.
+
+        Raises:
+            DeployError: If any of the assertion steps fails.
+
+        """
         #   [x] SSH connection is working.
-        address = self.config['server']['address']
-        user = self.config['server']['user']
-        server = Server(address, user)
-        valid, err = server.has_valid_connection()
+        with tracer.span('Connect', host=server.address) as span:
+            valid, err = server.has_valid_connection()
         if not valid:
             raise DeployError('Impossible to connect to remote host.\n\t> %s' % err, base=err)
 
-        Terminal.print_assert_valid("Successfully connected to remote server.")
+        Terminal.print_assert_valid("Successfully connected to remote server.", duration=span.duration)
+
+        # [x] The agent answers the following checks and programs from memory, when enabled
+        if config['server'].get('agent'):
+            try:
+                with tracer.span('Agent', host=server.address) as span:
+                    server.start_agent(forget=self.options.get('refresh_facts'))
+                Terminal.print_assert_valid('Connected to the deploy agent.', duration=span.duration)
+            except ServerError, e:
+                Terminal.print_warn('Continuing without the deploy agent.\n\t> %s' % e)
+
+        # [x] Gather every remote fact needed by the following assertions in a single round trip
+        project_name = self.config['project']['name']
+        app_directory = '~/.deploy/%s' % project_name
+        bare_repo_directory = '%s/src.git' % app_directory
+        fingerprint_path = '%s/fingerprint' % app_directory
+        build_state_path = '%s/%s' % (app_directory, RemoteBuild.STATE_FILE)
+        shipped_path = Artifact.get_shipped_path(app_directory)
+        upload_state_path = ChunkedUpload.get_state_path(Artifact.get_upload_path(app_directory))
+        restart = Restart(server, config, app_directory)
+        scripts_state_path = ScriptStage.get_state_path(app_directory)
+        # Artifacts compressed with zstd need it to be extracted
+        deps = ['supervisor', 'git'] + (['zstd'] if artifact is not None and artifact.compression == 'zstd' else [])
+        try:
+            with tracer.span('Preflight', host=server.address) as span:
+                server.run_preflight(deps=deps,
+                                     directories=[app_directory, bare_repo_directory],
+                                     repositories=[(bare_repo_directory, None)],
+                                     supervisor_projects=[project_name],
+                                     files=[fingerprint_path, build_state_path, shipped_path, restart.active_path,
+                                            scripts_state_path] + ([upload_state_path] if artifact is not None else []),
+                                     paths=RepositorySeed.get_ref_paths(bare_repo_directory))
+        except ServerError, e:
+            raise DeployError('Server error.\n\t> %s' % e, base=e)
+
+        Terminal.print_assert_valid('Gathered remote facts.', duration=span.duration)
+
+        # [x] Nothing to do if the last successful deploy shipped the very same state
+        fingerprint = self._get_fingerprint(config, preset, artifact)
+        if not self.options.get('force') and server.facts['contents'].get(fingerprint_path) == fingerprint:
+            Terminal.print_assert_valid('Remote server is already up to date.')
+            Terminal.print_info('Used %d SSH handshake(s).', server.handshakes)
+            return
 
         # [x] Server has supervisor and git installed.
         try:
-            server.validate_dep_list_installed(['supervisor', 'git'])
+            with tracer.span('Dependencies', host=server.address) as span:
+                server.validate_dep_list_installed(deps)
         except ServerError, e:
             raise DeployError('Server error.\n\t> %s' % e, base=e)
 
-        Terminal.print_assert_valid("Deploy dependencies are installed.")
+        Terminal.print_assert_valid("Deploy dependencies are installed.", duration=span.duration)
 
         # [x] ~/.deploy/{project} exists, or create
-        project_name = self.config['project']['name']
-        app_directory = '~/.deploy/%s' % project_name
-        bare_repo_directory = '%s/src.git' % app_directory
-        sources_directory = '%s/src' % app_directory
         try:
-            server.has_directories([app_directory, bare_repo_directory, sources_directory])
+            with tracer.span('Directories', host=server.address) as span:
+                server.has_directories([app_directory, bare_repo_directory])
         except ServerError, e:
             raise DeployError('Server error.\n\t> %s' % e, base=e)
 
-        Terminal.print_assert_valid("Valid directory Deploy directory structure.")
+        Terminal.print_assert_valid("Valid directory Deploy directory structure.", duration=span.duration)
 
-        # [x] check if bare and app git repo exists, create if necessary
+        # [x] check if the bare git repo exists, create if necessary
         try:
-            server.has_git_repositories(bare_repo_directory, sources_directory)
-        except Server, e:
+            with tracer.span('Repository', host=server.address) as span:
+                server.has_git_repositories(bare_repo_directory)
+        except ServerError, e:
             raise DeployError('Server error.\n\t> %s' % e, base=e)
 
-        Terminal.print_assert_valid("Found remote repository.")
+        Terminal.print_assert_valid("Found remote repository.", duration=span.duration)
 
-        # [x] Local repo has the remote server
-        remote_repo_url = 'ssh://{0}@{1}/home/{0}/.deploy/{2}/src.git'.format(user, address, project_name)
-        try:
-            remote_repo = self.repository.remote(name='deploy')
-            if remote_repo.url != remote_repo_url:
-                cw = remote_repo.config_writer
-                cw.set('url', remote_repo_url)
-        except ValueError, e:
-            self.repository.create_remote('deploy', remote_repo_url)
+        # Warnings
+        #   [ ] Local repo has uncommitted changes
 
-        Terminal.print_assert_valid("Local repository has valid remote.")
+        # Do the do
+        sha = self.repository.commit('master').hexsha
 
-        # [x] validate and load preset
-        preset_name = self.config['project']['preset']
-        if preset_name not in self.presets:
-            raise DeployError('Invalid preset. %s was not found in %s' % (preset_name, self.presets))
+        #   [x] Seed an empty remote repository from a bundle, otherwise push a thin pack of the missing objects
+        if not RepositorySeed.is_seeded(server, bare_repo_directory):
+            try:
+                with tracer.span('Seed', host=server.address) as span:
+                    transfer_stats = self.seed.run(server, app_directory, bare_repo_directory, sha)
+                    self._trace_transfer(span, transfer_stats)
+            except SeedError, e:
+                raise DeployError('Could not seed the remote repository.\n\t> %s' % e, base=e)
 
-        preset_class = load_preset(preset_name)
-        if preset_class is None:
-            raise DeployError('Unable to load preset %s.' % preset_name)
+            Terminal.print_assert_valid('Seeded remote repository from a %s bundle.',
+                                        format_bytes(transfer_stats.size), duration=span.duration)
+            self._print_transfer(transfer_stats)
+        else:
+            with tracer.span('Push', host=server.address) as span:
+                remote_repo = self.repository.remote(name=self._get_remote_name(config['server']))
+                results = remote_repo.push(refspec='master:master', thin=True)
 
-        preset = preset_class()
+            for info in results:
+                if info.flags & info.ERROR:
+                    raise DeployError('Error pushing to remote repository.\n\t> %s' % info.summary)
 
-        Terminal.print_assert_valid("Loaded preset.")
+            Terminal.print_assert_valid('Pushed to remote repository.', duration=span.duration)
+
+        release = Release(server, app_directory, sha)
+        release.add_git_tree(self.repository, bare_repo_directory)
+
+        #   [x] Ship the locally built artifact, unless the server already has it
+        if artifact is not None:
+            if artifact.is_shipped(server, app_directory):
+                Terminal.print_assert_valid('Server already has the build artifact.')
+            else:
+                try:
+                    with tracer.span('Ship', host=server.address) as span:
+                        transfer_stats = artifact.ship(server, app_directory)
+                        self._trace_transfer(span, transfer_stats)
+                except BuildError, e:
+                    raise DeployError('Could not ship the build artifact.\n\t> %s' % e, base=e)
+
+                Terminal.print_assert_valid('Shipped the build artifact, %s.', format_bytes(artifact.size),
+                                            duration=span.duration)
+                self._print_transfer(transfer_stats)
+
+            release.add_build_files('', artifact.get_remote_directory(app_directory), artifact.manifest)
+
+        #   [x] Synchronize the build directory
+        build_directory = config['project'].get('directories', {}).get('build')
+        if build_directory and artifact is None:
+            remote_build_directory = '%s/build' % app_directory
+            try:
+                with tracer.span('Sync', host=server.address) as span:
+                    sync = DeltaSync(server, build_directory, remote_build_directory)
+                    stats = sync.run()
+                    span.args.update(files=stats.files, changed=stats.changed, bytes_sent=stats.bytes_sent)
+            except SyncError, e:
+                raise DeployError('Could not synchronize the build directory.\n\t> %s' % e, base=e)
+
+            Terminal.print_assert_valid('Synchronized build directory, %d of %d files changed.',
+                                        stats.changed, stats.files, duration=span.duration)
+            Terminal.print_info('Sent %s for %s of changed files, saved %s.', format_bytes(stats.bytes_sent),
+                                format_bytes(stats.bytes_changed), format_bytes(stats.bytes_saved))
+
+            release.add_build_files(build_directory, remote_build_directory, sync.manifest)
+
+        #   [x] Run the preset build, unless its inputs did not change since the last successful build
+        build_command = preset.prepare() if artifact is None else None
+        if build_command:
+            build = RemoteBuild(server, app_directory, bare_repo_directory, build_command, preset.get_build_outputs())
+            try:
+                with tracer.span('Build', host=server.address) as span:
+                    build_stats = build.run(self.repository, release.sha)
+                    span.args.update(skipped=build_stats.skipped, outputs=build_stats.outputs)
+            except BuildError, e:
+                raise DeployError('Could not build the project.\n\t> %s' % e, base=e)
+
+            if build_stats.skipped:
+                Terminal.print_assert_valid('Build inputs did not change, reused %d build outputs.',
+                                            build_stats.outputs, duration=span.duration)
+            else:
+                Terminal.print_assert_valid('Built the project, %d build outputs.', build_stats.outputs,
+                                            duration=span.duration)
 
-        # [x] setup supervisor config
+            release.add_build_files('', build.work_tree, build.manifest, copy=True)
+
+        #   [x] Assemble the release out of the object store and make it current, keeping its supervisor config
+        local_sup_cfg = get_supervisor_config(config, preset)
         try:
-            # File is there
-            rmt_sup_cfg = server.get_supervisor_config(project_name)
-            local_sup_cfg = get_supervisor_config(self.config, preset)
-
-            # File is in sync with current preset
-            if rmt_sup_cfg != local_sup_cfg:
-                server.set_supervisor_config(project_name, local_sup_cfg)
-        except Server, e:
+            with tracer.span('Release', host=server.address) as span:
+                release_stats = release.publish(restart.get_links(), supervisor_config=local_sup_cfg,
+                                                keep=config['project'].get('keep_releases'),
+                                                current=restart.switches_current())
+                span.args.update(pruned=release_stats.pruned)
+        except ReleaseError, e:
+            raise DeployError('Could not publish the release.\n\t> %s' % e, base=e)
+
+        if release_stats.reused:
+            Terminal.print_assert_valid('Release "%s" already exists, reused it.', release.id,
+                                        duration=span.duration)
+        else:
+            Terminal.print_assert_valid('Published release "%s", %d files, %d new objects.', release.id,
+                                        release_stats.files, release_stats.new_objects, duration=span.duration)
+        if release_stats.pruned:
+            Terminal.print_info('Pruned %d old release(s).', release_stats.pruned)
+
+        # [x] setup supervisor config, pointing at the current release
+        try:
+            with tracer.span('Supervisor', host=server.address) as span:
+                # File is there
+                rmt_sup_cfg = server.get_supervisor_config(project_name)
+
+                # File is in sync with current preset
+                if rmt_sup_cfg.rstrip() != local_sup_cfg.rstrip():
+                    server.set_supervisor_config(project_name, local_sup_cfg)
+        except ServerError, e:
             raise DeployError('Server error.\n\t> %s' % e, base=e)
 
-        Terminal.print_assert_valid("Installed supervisor config.")
+        Terminal.print_assert_valid("Installed supervisor config.", duration=span.duration)
 
-        # Warnings
-        #   [ ] Local repo has uncommitted changes
-        #   [ ] Remote repo is already up to date
+        # [x] Run the before scripts, from the published release, before the program restarts
+        self._run_scripts('before', server, app_directory, release.directory)
 
-        # Do the do
-        #   [ ] Push to the remote
-        remote_repo = self.repository.remote(name='deploy')
-        results = remote_repo.push(refspec='master:master')
+        # [x] Restart the program, or switch to the other blue/green slot once it is healthy
+        self._restart(server, restart)
 
-        for info in results:
-            if info.flags & info.ERROR:
-                raise DeployError('Error pushing to remote repository.\n\t> %s' % info.summary)
+        # [x] Run the after scripts, once the program restarted
+        self._run_scripts('after', server, app_directory, release.directory)
 
-        #   [ ] Run the before scripts
-        #   [ ] Run the preset
-        #   [ ] Run the after scripts
+        # [x] Remember what was shipped, so the next deploy can be skipped if nothing changes
+        try:
+            server.write_file(fingerprint_path, fingerprint)
+        except ServerError, e:
+            raise DeployError('Server error.\n\t> %s' % e, base=e)
+
+        Terminal.print_info('Used %d SSH handshake(s).', server.handshakes)
+
+    def _write_trace(self):
+        """ Writes the trace of the run to the file given with --trace, if any. """
+        path = self.options.get('trace')
+        if not path:
+            return
+
+        try:
+            tracer.write(path)
+            Terminal.print_info('Wrote trace to "%s".', path)
+        except IOError, e:
+            Terminal.print_warn('Could not write trace to "%s".\n\t> %s', path, e)
 
     def execute(self):
         try:
             self.commands[self.cmd]()
         except DeployError, e:
             Terminal.print_error(str(e))
+        finally:
+            self.pool.close_all()
+            self._write_trace()
@@ -0,0 +1,97 @@
+import threading
+import time
+import Queue
+
+from terminal import Terminal
+
+
+class HostResult(object):
+    """ The outcome of a task executed against a single host """
+
+    def __init__(self, host, ok=False, error=None, duration=0.0, skipped=False):
+        self.host = host
+        self.ok = ok
+        self.error = error
+        self.duration = duration
+        self.skipped = skipped
+
+
+class HostExecutor(object):
+    """ Executes a task against many hosts concurrently, in rolling batches.
+
+    Hosts are processed batch after batch, each batch running at most `concurrency` hosts at the same
+    time. Once a batch is over, the rollout stops if the ratio of failed hosts exceeds `max_failure_ratio`,
+    and the remaining hosts are reported as skipped.
+
+    """
+
+    def __init__(self, concurrency=10, batch_size=None, max_failure_ratio=0.0):
+        self.concurrency = max(1, concurrency)
+        self.batch_size = batch_size
+        self.max_failure_ratio = max_failure_ratio
+
+    def _run_task(self, host, task):
+        Terminal.set_host(host)
+        start = time.time()
+        try:
+            task(host)
+            return HostResult(host, ok=True, duration=time.time() - start)
+        except Exception, e:
+            Terminal.print_error('%s', e)
+            return HostResult(host, error=e, duration=time.time() - start)
+        finally:
+            Terminal.set_host(None)
+
+    def _run_batch(self, hosts, task):
+        queue = Queue.Queue()
+        results = {}
+        lock = threading.Lock()
+
+        for host in hosts:
+            queue.put(host)
+
+        def worker():
+            while True:
+                try:
+                    host = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                result = self._run_task(host, task)
+                with lock:
+                    results[host] = result
+
+        workers = [threading.Thread(target=worker) for _ in range(min(self.concurrency, len(hosts)))]
+        for thread in workers:
+            thread.daemon = True
+            thread.start()
+        for thread in workers:
+            while thread.is_alive():
+                thread.join(0.5)
+
+        return [results[host] for host in hosts]
+
+    def run(self, hosts, task):
+        """ Runs a task against every host.
+
+        Args:
+            hosts (list): The hosts to run the task against, such as HostKeys, printed as strings.
+            task (function): The task, called with the host as its only argument.
+
+        Returns:
+            list: The HostResult of every host, in the same order as the hosts.
+
+        """
+        batch_size = self.batch_size or len(hosts)
+        results = []
+
+        for offset in range(0, len(hosts), batch_size):
+            results.extend(self._run_batch(hosts[offset:offset + batch_size], task))
+
+            failures = len([result for result in results if not result.ok])
+            remaining = hosts[offset + batch_size:]
+            if remaining and float(failures) / len(results) > self.max_failure_ratio:
+                Terminal.print_warn('Stopping rollout, %d of %d hosts failed.', failures, len(results))
+                results.extend(HostResult(host, skipped=True) for host in remaining)
+                break
+
+        return results
@@ -0,0 +1,78 @@
+import json
+import os
+import time
+
+
+class FactsCache(object):
+    """ Persists the remote host facts that almost never change between runs.
+
+    The installed helpers version, the package manager, the installed deploy dependencies and the
+    supervisor include directory are stored in a JSON file per server. They are trusted until the TTL
+    expires, or until the cache is invalidated because a deploy failed or the user asked for a refresh.
+
+    """
+    CACHED_FACTS = ['helpers', 'package_manager', 'dependencies', 'supervisor_dir', 'agent']
+    DEFAULT_TTL = 24 * 60 * 60
+
+    def __init__(self, key, ttl=DEFAULT_TTL):
+        self.key = key
+        self.ttl = ttl
+
+    @staticmethod
+    def get_cache_dir():
+        """ Gets the local directory holding the deploy caches. """
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+        return os.path.join(base, 'deploy')
+
+    @property
+    def path(self):
+        return os.path.join(FactsCache.get_cache_dir(), '%s.json' % self.key.slug)
+
+    def load(self):
+        """ Loads the cached facts of the host.
+
+        Returns:
+            dict: The cached facts, empty if there are none or if they expired.
+
+        """
+        try:
+            with open(self.path, 'r') as file_handle:
+                cache = json.load(file_handle)
+        except (IOError, ValueError):
+            return {}
+
+        if time.time() - cache.get('timestamp', 0) > self.ttl:
+            return {}
+
+        facts = cache.get('facts', {})
+        return dict((key, facts[key]) for key in FactsCache.CACHED_FACTS if key in facts)
+
+    def save(self, facts):
+        """ Saves the cacheable subset of the host facts.
+
+        Args:
+            facts (dict): The facts gathered on the host.
+
+        """
+        cached = dict((key, facts[key]) for key in FactsCache.CACHED_FACTS if key in facts)
+        if 'dependencies' in cached:
+            cached['dependencies'] = dict((dep, True) for dep, ok in cached['dependencies'].items() if ok)
+
+        try:
+            os.makedirs(FactsCache.get_cache_dir())
+        except OSError:
+            pass
+
+        try:
+            with open(self.path, 'w') as file_handle:
+                json.dump({'timestamp': time.time(), 'facts': cached}, file_handle)
+        except IOError:
+            # The cache is only an optimization, the next run will rediscover the facts.
+            pass
+
+    def invalidate(self):
+        """ Removes the cached facts of the host. """
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
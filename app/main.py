@@ -1,15 +1,61 @@
 import argparse
+import sys
+import time
 
-from deploy import Deploy
+from startup import ImportProfiler
+
+from terminal import Terminal
+
+
+def _report_startup(profiler, dispatched, startup_imports):
+    Terminal.print_info('Dispatched the command after %.1fms, %.1fms of which importing modules.',
+                        (dispatched - profiler.start) * 1000, startup_imports * 1000)
+    Terminal.print_info('Imported modules for %.1fms in total, the command included. Slowest imports '
+                        '(cumulative, own):', profiler.total * 1000)
+    for name, cumulative, own in profiler.get_slowest():
+        Terminal.print_info('%8.1fms %8.1fms  %s', cumulative * 1000, own * 1000, name)
 
 
 def run():
+    # Installed before anything else is imported, so that every import is timed
+    profiler = None
+    if '--profile-startup' in sys.argv[1:]:
+        profiler = ImportProfiler()
+        profiler.install()
+
     parser = argparse.ArgumentParser(description='Painless code deployment.')
-    parser.add_argument('command', metavar='cmd', help='The command to execute.', choices=['init', 'now'])
+    parser.add_argument('command', metavar='cmd', help='The command to execute.',
+                        choices=['init', 'now', 'watch', 'status', 'rollback'])
+    parser.add_argument('target', nargs='?',
+                        help='For rollback, how many releases to go back, or the commit to go back to. Defaults to 1.')
+    parser.add_argument('--hosts', help='Comma separated list of server addresses to target.')
+    parser.add_argument('--group', help='Only target the servers of this host group.')
+    parser.add_argument('--parallel', type=int, help='Maximum number of servers deployed concurrently.')
+    parser.add_argument('--batch', type=int, help='Number of servers per rolling batch.')
+    parser.add_argument('--max-failure-ratio', type=float,
+                        help='Stop the rollout once the ratio of failed servers exceeds this value.')
+    parser.add_argument('--refresh-facts', action='store_true',
+                        help='Ignore the cached remote host facts and statuses, and discover them again.')
+    parser.add_argument('--force', action='store_true',
+                        help='Deploy even if the remote server is already up to date.')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='Write a Chrome trace event file of every deploy phase and remote command.')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='Report how long the command took to start, and the slowest imports, once it ran.')
     args = parser.parse_args()
 
-    deploy = Deploy(args.command)
-    deploy.execute()
+    # Heavy dependencies are only imported by the commands that need them
+    from deploy import Deploy
+
+    deploy = Deploy(args.command, vars(args))
+    dispatched = time.time()
+    startup_imports = profiler.total if profiler is not None else 0
+    try:
+        deploy.execute()
+    finally:
+        if profiler is not None:
+            profiler.uninstall()
+            _report_startup(profiler, dispatched, startup_imports)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,185 @@
+import base64
+import json
+import pipes
+
+
+class PreflightError(Exception):
+    """ Base error class for Preflight """
+
+    def __init__(self, message, base=None):
+        super(PreflightError, self).__init__(message)
+        self.base_exception = base
+
+
+class Preflight(object):
+    """ Batches many remote checks into a single bash program, so they cost one round trip.
+
+    Every check prints a JSON line of the form {"id": ..., "ok": ..., "value": ...} where the value is
+    base64 encoded. Checks that could not produce a reliable answer simply print nothing, which leaves
+    the corresponding fact unknown so that the caller can fall back to checking it live.
+
+    """
+    HELPERS_DELIMITER = '__DEPLOY_HELPERS__'
+
+    HEADER = '\n'.join([
+        '_emit() { printf \'{"id": "%s", "ok": %s, "value": "%s"}\\n\' "$1" "$2" "$3"; }',
+        '_b64() { printf %s "$1" | base64 | tr -d \'\\n\'; }',
+        '_test() { local id=$1; shift; if "$@"; then _emit $id true ""; else _emit $id false ""; fi; }',
+    ])
+
+    def __init__(self):
+        self._lines = []
+        self._checks = {}
+        self._has_pm = False
+        self._has_helpers = False
+
+    @staticmethod
+    def quote_path(path):
+        """ Quotes a remote path for bash while preserving a leading home directory tilde.
+
+        Args:
+            path (string): The remote path.
+
+        Returns:
+            string: The quoted path.
+
+        """
+        if path == '~':
+            return path
+        if path.startswith('~/'):
+            return '~/%s' % pipes.quote(path[2:])
+        return pipes.quote(path)
+
+    def _add_check(self, kind, key):
+        check_id = 'c%d' % len(self._checks)
+        self._checks[check_id] = (kind, key)
+        return check_id
+
+    def use_helpers(self, path, version, content=None):
+        """ Loads the bash helpers file, which the package manager and dependency checks rely on.
+
+        Args:
+            path (string): The remote path of the helpers file.
+            version (string): The version of the helpers, reported back once they are loaded.
+            content (Optional[str]): The helpers content, to install them before loading. Defaults to None.
+
+        """
+        check_id = self._add_check('helpers', None)
+        quoted_path = Preflight.quote_path(path)
+
+        if content is not None:
+            self._lines.append('mkdir -p "$(dirname %s)" && cat > %s.$$ <<\'%s\' && mv %s.$$ %s\n%s%s'
+                               % (quoted_path, quoted_path, Preflight.HELPERS_DELIMITER, quoted_path, quoted_path,
+                                  content, Preflight.HELPERS_DELIMITER))
+
+        self._lines.append('_helpers=""')
+        self._lines.append('if [ -f %s ] && . %s; then _helpers=1; _emit %s true "$(_b64 %s)"; '
+                           'else _emit %s false ""; fi'
+                           % (quoted_path, quoted_path, check_id, pipes.quote(version), check_id))
+        self._has_helpers = True
+
+    def check_package_manager(self, package_manager=None):
+        if self._has_pm:
+            return
+
+        if not self._has_helpers:
+            raise PreflightError('The helpers must be loaded before checking the package manager.')
+
+        self._has_pm = True
+
+        if package_manager is not None:
+            self._lines.append('_pm=%s' % pipes.quote(package_manager))
+            return
+
+        check_id = self._add_check('package_manager', None)
+        self._lines.append('_pm=""')
+        self._lines.append('if [ -n "$_helpers" ]; then _pm=$(PM_detect); '
+                           'if [[ "$_pm" == "[ERROR]"* ]]; then _pm=""; _emit %s false ""; '
+                           'else _emit %s true "$(_b64 "$_pm")"; fi; fi' % (check_id, check_id))
+
+    def check_dependencies(self, deps, package_manager=None):
+        self.check_package_manager(package_manager)
+
+        # A single package manager query answers for every dependency
+        self._lines.append('if [ -n "$_helpers" ] && [ -n "$_pm" ]; then')
+        self._lines.append('_missing=" $(missing_packages "$_pm" %s | tr \'\\n\' \' \') "'
+                           % ' '.join(pipes.quote(dep) for dep in deps))
+        for dep in deps:
+            check_id = self._add_check('dependencies', dep)
+            self._lines.append('case "$_missing" in *%s*) _emit %s false "";; *) _emit %s true "";; esac'
+                               % (pipes.quote(' %s ' % dep), check_id, check_id))
+        self._lines.append('fi')
+
+    def check_files(self, paths):
+        for path in paths:
+            check_id = self._add_check('files', path)
+            self._lines.append('_test %s [ -e %s ]' % (check_id, Preflight.quote_path(path)))
+
+    def read_files(self, paths):
+        for path in paths:
+            check_id = self._add_check('contents', path)
+            quoted_path = Preflight.quote_path(path)
+            self._lines.append('if [ -f %s ] && _content=$(base64 < %s 2>/dev/null); then'
+                               ' _emit %s true "$(printf %%s "$_content" | tr -d \'\\n\')"; else _emit %s false ""; fi'
+                               % (quoted_path, quoted_path, check_id, check_id))
+
+    def check_supervisor_config(self, project, config_dirs):
+        dir_id = self._add_check('supervisor_dir', None)
+        config_id = self._add_check('supervisor_configs', project)
+        config_file = pipes.quote('%s.conf' % project.lower())
+
+        self._lines.append('_supdir=""')
+        for config_dir in config_dirs:
+            self._lines.append('[ -z "$_supdir" ] && [ -e %s ] && _supdir=%s'
+                               % (pipes.quote(config_dir), pipes.quote(config_dir)))
+        self._lines.append('[ -n "$_supdir" ] && _emit %s true "$(_b64 "$_supdir")"' % dir_id)
+        self._lines.append('if [ -n "$_supdir" ]; then'
+                           ' if [ ! -e "$_supdir"/%s ]; then _emit %s false "";'
+                           ' elif _cfg=$(base64 < "$_supdir"/%s 2>/dev/null); then'
+                           ' _emit %s true "$(printf %%s "$_cfg" | tr -d \'\\n\')"; fi; fi'
+                           % (config_file, config_id, config_file, config_id))
+
+    def get_script(self):
+        """ Builds the bash program running every registered check.
+
+        Returns:
+            string: The bash program.
+
+        """
+        return '\n'.join([Preflight.HEADER] + self._lines) + '\n'
+
+    def parse(self, output):
+        """ Parses the output of the preflight program back into facts.
+
+        Args:
+            output (string): The standard output of the program.
+
+        Returns:
+            dict: The facts, keyed by kind.
+
+        Raises:
+            PreflightError: If the output is not valid.
+
+        """
+        facts = {'files': {}, 'dependencies': {}, 'supervisor_configs': {}, 'contents': {}}
+
+        for line in output.splitlines():
+            if not line.startswith('{'):
+                continue
+
+            try:
+                result = json.loads(line)
+                kind, key = self._checks[result['id']]
+                value = base64.b64decode(result['value'])
+            except (ValueError, KeyError, TypeError), e:
+                raise PreflightError('Invalid preflight output "%s".' % line, base=e)
+
+            if kind in ('helpers', 'package_manager', 'supervisor_dir'):
+                if result['ok']:
+                    facts[kind] = value
+            elif kind in ('supervisor_configs', 'contents'):
+                facts[kind][key] = value.rstrip() if result['ok'] else None
+            else:
+                facts[kind][key] = result['ok']
+
+        return facts
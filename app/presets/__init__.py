@@ -0,0 +1,5 @@
+# The installed presets, by name, along with the module and the class implementing them. The registry is
+# static so that listing the presets imports none of them, wherever deploy runs from.
+PRESETS = {
+    'java:gradle': ('java.gradle', 'JavaGradlePreset'),
+}
@@ -1,13 +1,29 @@
+import os
+
 from ..preset import Preset
 
 
 class JavaGradlePreset(Preset):
+    BUILD_FILES = ['build.gradle', 'build.gradle.kts']
 
     def __init__(self):
         pass
 
     def prepare(self):
-        pass
+        """ Assembles the project with its Gradle wrapper, or the installed Gradle.
+
+        Gradle gets a home directory of its own per project, so its daemon and its dependency and build caches
+        stay warm from one deploy to the next.
+
+        """
+        if not any(os.path.isfile(build_file) for build_file in JavaGradlePreset.BUILD_FILES):
+            return None
+
+        return ('_gradle=gradle; if [ -f gradlew ]; then _gradle="bash gradlew"; fi; '
+                'GRADLE_USER_HOME="$DEPLOY_APP_DIR/gradle" $_gradle --daemon --build-cache --console=plain assemble')
+
+    def get_build_outputs(self):
+        return ['build/libs']
 
     def get_run_cmd(self):
         return '/bin/bash run.sh'
@@ -10,7 +10,26 @@ class Preset:
 
     @abstractmethod
     def prepare(self):
-        """ The preset own method to build or run any preparation scripts. """
+        """ The preset own method to build or run any preparation scripts.
+
+        Returns:
+            string: The bash command building the project, run remotely from the project source directory, or
+                None if there is nothing to build.
+
+        """
+
+    def get_build_outputs(self):
+        """ The paths the build command produces, relative to the project source directory. """
+        return []
+
+    def requires_restart(self, paths):
+        """ If the program must restart to pick up changed files, rather than reading them as they change.
+
+        Args:
+            paths (list): The changed paths, relative to the project root (Strings).
+
+        """
+        return True
 
     @abstractmethod
     def get_run_cmd(self):
@@ -0,0 +1,249 @@
+""" The deploy agent, a long lived process answering deploy runs with the host state it keeps in memory.
+
+Usage:
+    agent.py serve      Serves requests on the agent socket, until nobody connected for IDLE_TIMEOUT seconds.
+    agent.py relay      Relays the standard input and output to the agent, starting it first if it does not run.
+
+Requests are JSON lines {"id": ..., "method": ..., "params": {...}}, answered by JSON lines {"id": ..., "result": ...}
+or {"id": ..., "error": ...}, in order. File contents are base64 encoded both ways.
+
+It runs with either python 2 or 3, and is installed by deploy itself, next to its socket.
+"""
+import base64
+import fcntl
+import json
+import os
+import select
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+SOCKET_PATH = os.path.join(DIRECTORY, 'agent.sock')
+LOCK_PATH = os.path.join(DIRECTORY, 'agent.lock')
+IDLE_TIMEOUT = 3600
+START_TIMEOUT = 5
+CHUNK_SIZE = 65536
+
+
+def encode(data):
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    return base64.b64encode(data).decode('ascii')
+
+
+def decode(data):
+    return base64.b64decode(data.encode('ascii'))
+
+
+def expand(path):
+    return os.path.expanduser(path)
+
+
+def read_file(path):
+    try:
+        with open(expand(path), 'rb') as file_handle:
+            return encode(file_handle.read())
+    except (IOError, OSError):
+        return None
+
+
+class Agent(object):
+    """ Answers requests. The package manager and the installed dependencies are kept in memory, everything
+        else is checked again on every request, without spawning any process. """
+
+    def __init__(self):
+        self.package_manager = None
+        self.installed = set()
+        self.last_seen = time.time()
+        self.lock = threading.Lock()
+
+    def _run_helper(self, helpers, function, *args):
+        script = '%s\n%s "$@"' % (helpers, function)
+        process = subprocess.Popen(['bash', '-c', script, 'helper'] + list(args), stdout=subprocess.PIPE)
+        return process.communicate()[0].decode('utf-8')
+
+    def _check_dependencies(self, deps, helpers):
+        unknown = [dep for dep in deps if dep not in self.installed]
+        if unknown and helpers is not None:
+            if self.package_manager is None:
+                package_manager = self._run_helper(helpers, 'PM_detect').strip()
+                if package_manager and not package_manager.startswith('[ERROR]'):
+                    self.package_manager = package_manager
+
+            if self.package_manager is not None:
+                missing = self._run_helper(helpers, 'missing_packages', self.package_manager, *unknown).split()
+                self.installed.update(dep for dep in unknown if dep not in missing)
+
+        return dict((dep, dep in self.installed) for dep in deps)
+
+    def status(self, paths=(), contents=(), supervisor_projects=(), supervisor_dirs=(), deps=(), helpers=None):
+        """ Gathers the same facts as the preflight program. """
+        facts = {
+            'files': dict((path, os.path.exists(expand(path))) for path in paths),
+            'contents': dict((path, read_file(path)) for path in contents),
+            'supervisor_configs': {},
+        }
+
+        if supervisor_projects:
+            supervisor_dir = None
+            for directory in supervisor_dirs:
+                if os.path.exists(directory):
+                    supervisor_dir = directory
+                    break
+            if supervisor_dir is not None:
+                facts['supervisor_dir'] = supervisor_dir
+                for project in supervisor_projects:
+                    facts['supervisor_configs'][project] = read_file(
+                        os.path.join(supervisor_dir, '%s.conf' % project.lower()))
+
+        if deps:
+            with self.lock:
+                facts['dependencies'] = self._check_dependencies(deps, helpers)
+                if self.package_manager is not None:
+                    facts['package_manager'] = self.package_manager
+
+        return facts
+
+    def run(self, script, stdin=None):
+        """ Runs a bash program. """
+        process = subprocess.Popen(['bash', '-c', script], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, cwd=os.path.expanduser('~'))
+        out, err = process.communicate(decode(stdin) if stdin is not None else b'')
+        return {'status': process.returncode, 'out': encode(out), 'err': encode(err)}
+
+    def write(self, path, content):
+        """ Atomically replaces the content of a file. """
+        path = expand(path)
+        with open(path + '.tmp', 'wb') as file_handle:
+            file_handle.write(decode(content))
+        os.rename(path + '.tmp', path)
+        return True
+
+    def forget(self):
+        """ Forgets the state kept in memory, so it is discovered again. """
+        with self.lock:
+            self.package_manager = None
+            self.installed = set()
+        return True
+
+    def hello(self):
+        return {'pid': os.getpid()}
+
+    def handle(self, connection):
+        reader = connection.makefile('rb')
+        try:
+            for line in iter(reader.readline, b''):
+                self.last_seen = time.time()
+                request = {}
+                try:
+                    request = json.loads(line.decode('utf-8'))
+                    method = request['method']
+                    if method not in ('status', 'run', 'write', 'forget', 'hello'):
+                        raise ValueError('Unknown method "%s".' % method)
+                    response = {'id': request.get('id'), 'result': getattr(self, method)(**request.get('params', {}))}
+                except Exception as e:
+                    response = {'id': request.get('id'), 'error': '%s: %s' % (type(e).__name__, e)}
+                connection.sendall((json.dumps(response) + '\n').encode('utf-8'))
+        finally:
+            reader.close()
+            connection.close()
+            self.last_seen = time.time()
+
+    def serve(self):
+        # When relays start agents concurrently, only the first one serves
+        lock = open(LOCK_PATH, 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return
+
+        os.chdir(os.path.expanduser('~'))
+        try:
+            os.unlink(SOCKET_PATH)
+        except OSError:
+            pass
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            listener.bind(SOCKET_PATH)
+        finally:
+            os.umask(old_umask)
+        listener.listen(16)
+
+        while True:
+            readable, _, _ = select.select([listener], [], [], 60)
+            if readable:
+                connection, _ = listener.accept()
+                thread = threading.Thread(target=self.handle, args=(connection,))
+                thread.daemon = True
+                thread.start()
+            elif time.time() - self.last_seen > IDLE_TIMEOUT and threading.active_count() == 1:
+                break
+
+        listener.close()
+        try:
+            os.unlink(SOCKET_PATH)
+        except OSError:
+            pass
+
+
+def connect():
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(SOCKET_PATH)
+    return sock
+
+
+def start():
+    """ Starts the agent in the background, detached from the SSH session. """
+    devnull = open(os.devnull, 'r+b')
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), 'serve'], stdin=devnull, stdout=devnull,
+                     stderr=devnull, close_fds=True, preexec_fn=os.setsid)
+
+
+def relay():
+    try:
+        sock = connect()
+    except socket.error:
+        start()
+        deadline = time.time() + START_TIMEOUT
+        while True:
+            try:
+                sock = connect()
+                break
+            except socket.error:
+                if time.time() > deadline:
+                    sys.stderr.write('The agent did not start.\n')
+                    sys.exit(1)
+                time.sleep(0.05)
+
+    stdin, stdout = sys.stdin.fileno(), sys.stdout.fileno()
+    inputs = [stdin, sock]
+    while sock in inputs:
+        readable, _, _ = select.select(inputs, [], [])
+        if stdin in readable:
+            data = os.read(stdin, CHUNK_SIZE)
+            if data:
+                sock.sendall(data)
+            else:
+                inputs.remove(stdin)
+                sock.shutdown(socket.SHUT_WR)
+        if sock in readable:
+            data = sock.recv(CHUNK_SIZE)
+            if data:
+                while data:
+                    data = data[os.write(stdout, data):]
+            else:
+                inputs.remove(sock)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['serve']:
+        Agent().serve()
+    elif sys.argv[1:] == ['relay']:
+        relay()
+    else:
+        sys.stderr.write(__doc__)
+        sys.exit(2)
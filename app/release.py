@@ -0,0 +1,456 @@
+import base64
+import hashlib
+import pipes
+import stat
+
+from preflight import Preflight
+from utilities import BLUE_GREEN_SLOTS
+
+from server import ServerError
+
+
+class ReleaseError(Exception):
+    """ Base error class for Release """
+
+    def __init__(self, message, base=None):
+        super(ReleaseError, self).__init__(message)
+        self.base_exception = base
+
+
+class ReleaseStats(object):
+    """ What publishing a release did """
+
+    def __init__(self):
+        self.files = 0
+        self.new_objects = 0
+        self.reused = False
+        self.pruned = 0
+
+
+class Release(object):
+    """ An immutable release of the project, assembled remotely out of a content addressed object store.
+
+    Every file of a release is a hardlink to `objects/<hash>`, where the hash is the git blob hash of the
+    tracked files and the sha1 of the build files. Tracked files are materialized from the bare repository
+    the commit was pushed to, and build files from the synchronized build directory or the build outputs, so a
+    file that did not change between two deploys costs neither bytes nor disk. Once assembled, the release
+    becomes the `current` one through an atomic symlink swap, and the releases beyond the ones kept by
+    `ReleaseHistory` are pruned.
+
+    """
+    OBJECTS_DIR = 'objects'
+    RELEASES_DIR = 'releases'
+    CURRENT_LINK = 'current'
+    EXECUTABLE_SUFFIX = '.x'
+    WATCH_SUFFIX = '-watch'
+
+    def __init__(self, server, app_directory, sha):
+        self.server = server
+        self.app_directory = app_directory.rstrip('/')
+        self.sha = str(sha)
+        self.bare_repo_directory = None
+        self.files = {}
+        self.symlinks = {}
+        self.copied = set()
+
+    @property
+    def id(self):
+        """ The release directory name, the commit sha followed by the build files digest if any. """
+        build_files = sorted((path, entry) for path, entry in self.files.items() if entry[0] == 'build')
+        if not build_files:
+            return self.sha
+
+        digest = hashlib.sha1()
+        for path, (source, key, origin) in build_files:
+            digest.update('%s\0%s\0' % (path, key))
+        return '%s-%s' % (self.sha, digest.hexdigest()[:8])
+
+    @property
+    def directory(self):
+        """ The remote release directory. """
+        return '%s/%s/%s' % (self.app_directory, Release.RELEASES_DIR, self.id)
+
+    @staticmethod
+    def get_object_key(digest, executable):
+        return digest + Release.EXECUTABLE_SUFFIX if executable else digest
+
+    def add_git_tree(self, repository, bare_repo_directory):
+        """ Adds every file tracked by the release commit.
+
+        Args:
+            repository (Repo): The local repository.
+            bare_repo_directory (string): The remote bare repository the commit was pushed to.
+
+        """
+        self.bare_repo_directory = bare_repo_directory
+
+        for line in repository.git.ls_tree('-r', '-z', self.sha).split('\0'):
+            if not line:
+                continue
+            info, path = line.split('\t', 1)
+            mode, kind, digest = info.split()
+
+            if kind != 'blob':
+                # Submodules are not part of the pushed history
+                continue
+            elif mode == '120000':
+                self.symlinks[path] = repository.git.cat_file('blob', digest)
+            else:
+                self.files[path] = ('git', Release.get_object_key(digest, mode == '100755'), path)
+
+    def add_build_files(self, local_build_directory, remote_build_directory, manifest, copy=False):
+        """ Adds build files, either synchronized or built remotely, at the same place they have in the project.
+
+        Args:
+            local_build_directory (string): The build directory, relative to the project root.
+            remote_build_directory (string): The remote directory holding the build files.
+            manifest (dict): The DeltaSync manifest of the build files.
+            copy (Optional[bool]): If the files are copied into the object store instead of hardlinked, as the
+                next build may overwrite them in place. Defaults to False.
+
+        """
+        remote_build_directory = remote_build_directory.rstrip('/')
+        prefix = local_build_directory.strip('/')
+
+        for rel_path, entry in manifest.items():
+            executable = bool(entry['mode'] & (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH))
+            path = '%s/%s' % (prefix, rel_path) if prefix else rel_path
+            self.symlinks.pop(path, None)
+            self.files[path] = ('build', Release.get_object_key(entry['sha1'], executable),
+                                '%s/%s' % (remote_build_directory, rel_path))
+            if copy:
+                self.copied.add(path)
+            else:
+                self.copied.discard(path)
+
+    @staticmethod
+    def get_store_function():
+        """ Builds the bash function `_store <key> <file> [copy]`, adding a file to the object store unless it has
+            it, hardlinked unless `copy` is given, and counting the new objects in `$_new`. It runs from the
+            project directory. """
+        objects = Release.OBJECTS_DIR
+        return [
+            '_new=0',
+            '_store() {',
+            '    if [ ! -e "%s/$1" ]; then' % objects,
+            '        { [ -z "$3" ] && ln "$2" "%s/$1.tmp.$$" 2>/dev/null; } || cp "$2" "%s/$1.tmp.$$"'
+            % (objects, objects),
+            '        case "$1" in *%s) chmod 755 "%s/$1.tmp.$$" ;; *) chmod 644 "%s/$1.tmp.$$" ;; esac'
+            % (Release.EXECUTABLE_SUFFIX, objects, objects),
+            '        mv -f "%s/$1.tmp.$$" "%s/$1"' % (objects, objects),
+            '        _new=$((_new + 1))',
+            '    fi',
+            '}',
+        ]
+
+    @staticmethod
+    def get_switch_lines(release, links=(), current=True):
+        """ Builds the commands atomically pointing the current symlink, and the other links, at a release.
+
+        Args:
+            release (string): The release directory relative to the project directory, quoted for bash.
+            links (Optional[list]): The other symlinks of the project directory. Defaults to none.
+            current (Optional[bool]): If the current symlink is switched too. Defaults to True.
+
+        """
+        lines = []
+        for link in ([Release.CURRENT_LINK] if current else []) + list(links):
+            lines.extend([
+                'ln -sfn %s %s.tmp.$$' % (release, pipes.quote(link)),
+                'mv -T %s.tmp.$$ %s' % (pipes.quote(link), pipes.quote(link)),
+            ])
+        return lines
+
+    def get_script(self, links=(), supervisor_config=None, keep=None, current=True):
+        """ Builds the remote program assembling the release, recording its supervisor config and pointing the
+            links, and unless told otherwise the current one, at it, then pruning the old releases. """
+        release_id = self.id
+        release = '%s/%s' % (Release.RELEASES_DIR, release_id)
+        incoming = 'incoming/%s' % release_id
+        objects = Release.OBJECTS_DIR
+
+        lines = [
+            'set -e -o pipefail',
+            'cd %s' % Preflight.quote_path(self.app_directory),
+        ]
+        lines.extend(Release.get_store_function())
+        lines.extend([
+            'if [ ! -d %s ]; then' % pipes.quote(release),
+            'mkdir -p %s %s' % (objects, Release.RELEASES_DIR),
+        ])
+
+        # Tracked files missing from the store are extracted with a single git archive of the pushed commit
+        git_files = sorted((path, key) for path, (source, key, origin) in self.files.items() if source == 'git')
+        if git_files:
+            lines.append('_archive=()')
+            lines.extend('[ -e %s/%s ] || _archive+=(%s)' % (objects, key, pipes.quote(':(literal)%s' % path))
+                         for path, key in git_files)
+            lines.extend([
+                'if [ ${#_archive[@]} -gt 0 ]; then',
+                '    rm -rf %s && mkdir -p %s' % (pipes.quote(incoming), pipes.quote(incoming)),
+                '    git --git-dir %s archive %s -- "${_archive[@]}" | tar -x -C %s'
+                % (Preflight.quote_path(self.bare_repo_directory), self.sha, pipes.quote(incoming)),
+                'fi',
+            ])
+            lines.extend('[ -e %s/%s ] || _store %s %s' % (objects, key, key, pipes.quote('%s/%s' % (incoming, path)))
+                         for path, key in git_files)
+
+        for path, (source, key, origin) in sorted(self.files.items()):
+            if source == 'build':
+                lines.append('_store %s %s%s' % (key, Preflight.quote_path(origin),
+                                                 ' copy' if path in self.copied else ''))
+
+        # The release is assembled aside, then moved in place so it is never seen half built
+        lines.append('_rel=%s.tmp.$$' % pipes.quote(release))
+        lines.append('rm -rf "$_rel" && mkdir -p "$_rel"')
+
+        paths = list(self.files) + list(self.symlinks)
+        directories = sorted(set(path.rsplit('/', 1)[0] for path in paths if '/' in path))
+        for offset in range(0, len(directories), 100):
+            lines.append('mkdir -p %s' % ' '.join('"$_rel"/%s' % pipes.quote(directory)
+                                                  for directory in directories[offset:offset + 100]))
+
+        lines.extend('ln %s/%s "$_rel"/%s' % (objects, key, pipes.quote(path))
+                     for path, (source, key, origin) in sorted(self.files.items()))
+        lines.extend('ln -s %s "$_rel"/%s' % (pipes.quote(target), pipes.quote(path))
+                     for path, target in sorted(self.symlinks.items()))
+
+        lines.extend([
+            'mv "$_rel" %s' % pipes.quote(release),
+            'rm -rf %s' % pipes.quote(incoming),
+            'else',
+            'echo reused',
+            'fi',
+            # The release order is the publication one, a reused release being the newest again
+            'touch %s' % pipes.quote(release),
+        ])
+        if supervisor_config is not None:
+            config_path = pipes.quote(ReleaseHistory.get_config_path(release_id))
+            lines.append('echo %s | base64 -d > %s.tmp.$$ && mv -f %s.tmp.$$ %s' % (
+                base64.b64encode(supervisor_config), config_path, config_path, config_path))
+        lines.extend(Release.get_switch_lines(pipes.quote(release), links, current))
+        lines.extend(ReleaseHistory.get_prune_lines(keep or ReleaseHistory.DEFAULT_KEEP))
+        lines.append('echo "new:$_new"')
+
+        return '\n'.join(lines)
+
+    def publish(self, links=(), supervisor_config=None, keep=None, current=True):
+        """ Assembles the release remotely and makes it the current one, in a single round trip.
+
+        Args:
+            links (Optional[list]): Other symlinks of the project directory to point at the release, such as
+                a blue/green slot. Defaults to none.
+            supervisor_config (Optional[str]): The rendered supervisor config, kept along with the release to
+                roll back to it. Defaults to None.
+            keep (Optional[int]): The number of releases kept. Defaults to `ReleaseHistory.DEFAULT_KEEP`.
+            current (Optional[bool]): If the release becomes the current one, rather than once its program is
+                healthy. Defaults to True.
+
+        Returns:
+            ReleaseStats: What publishing the release did.
+
+        Raises:
+            ReleaseError: If the release could not be assembled or published.
+
+        """
+        stats = ReleaseStats()
+        stats.files = len(self.files) + len(self.symlinks)
+
+        try:
+            status, out, err = self.server.run_script(self.get_script(links, supervisor_config, keep, current),
+                                                      label='publish release')
+        except ServerError, e:
+            raise ReleaseError('Could not publish release "%s".\n\t> %s' % (self.id, e), base=e)
+
+        if status != 0:
+            raise ReleaseError('Could not publish release "%s".\n\t> %s' % (self.id, err.rstrip()))
+
+        for line in out.splitlines():
+            if line == 'reused':
+                stats.reused = True
+            elif line.startswith('new:'):
+                stats.new_objects = int(line[len('new:'):])
+            elif line.startswith('pruned:'):
+                stats.pruned = int(line[len('pruned:'):])
+
+        return stats
+
+
+class RollbackStats(object):
+    """ What rolling back did """
+
+    def __init__(self):
+        self.release = None
+        self.previous = None
+        self.active = None
+        self.supervisor_config = None
+        self.unchanged = False
+
+
+class ReleaseHistory(object):
+    """ The releases kept on a server, to roll back to without pushing nor building anything.
+
+    Releases are ordered by publication, newest first, from the modification time of their directory, and
+    each one is kept along with the supervisor config rendered when it was published. Publishing prunes the
+    releases beyond the `keep` newest ones, along with the objects no kept release uses anymore, the releases
+    a link still points at aside. Watch releases are pruned once no link points at them.
+
+    Rolling back is a single remote program, which resolves the release, points the links at it, and tells
+    whether the supervisor config of the release differs from the installed one.
+
+    """
+    DEFAULT_KEEP = 5
+    CONFIG_SUFFIX = '.supervisor.conf'
+
+    def __init__(self, server, app_directory):
+        self.server = server
+        self.app_directory = app_directory.rstrip('/')
+
+    @staticmethod
+    def get_config_path(release_id):
+        """ Gets the supervisor config of a release, relative to the project directory. """
+        return '%s/%s%s' % (Release.RELEASES_DIR, release_id, ReleaseHistory.CONFIG_SUFFIX)
+
+    @staticmethod
+    def get_list_command():
+        """ Builds the command listing the releases, newest first, without the ones being assembled. """
+        return 'ls -1t %s 2>/dev/null | { grep -v -e %s -e %s || true; }' % (
+            Release.RELEASES_DIR, pipes.quote(r'\.tmp\.'), pipes.quote('%s$' % ReleaseHistory.CONFIG_SUFFIX))
+
+    @staticmethod
+    def get_prune_lines(keep):
+        """ Builds the commands removing the releases beyond the `keep` newest ones, and the unused objects,
+            printing how many releases were removed. It runs from the project directory. """
+        objects = Release.OBJECTS_DIR
+        return [
+            '_linked=$(for _link in %s; do readlink "$_link" 2>/dev/null || true; done)' % ' '.join(
+                [Release.CURRENT_LINK] + BLUE_GREEN_SLOTS),
+            '_kept=0',
+            '_pruned=0',
+            'for _id in $(%s); do' % ReleaseHistory.get_list_command(),
+            '    case "$_id" in *%s) ;; *) _kept=$((_kept + 1)) ;; esac' % Release.WATCH_SUFFIX,
+            '    case "$_id" in *%s) ;; *) [ $_kept -gt %d ] || continue ;; esac' % (Release.WATCH_SUFFIX, keep),
+            '    printf "%%s\\n" $_linked | grep -qxF "%s/$_id" && continue' % Release.RELEASES_DIR,
+            '    rm -rf "%s/$_id" "%s/$_id%s"' % (Release.RELEASES_DIR, Release.RELEASES_DIR,
+                                                  ReleaseHistory.CONFIG_SUFFIX),
+            '    _pruned=$((_pruned + 1))',
+            'done',
+            # Objects are only linked from the store once no kept release uses them
+            'if [ $_pruned -gt 0 ]; then',
+            '    find %s -maxdepth 1 -type f -links 1 ! -name "*.tmp.*" ! -name "*.upload" -delete' % objects,
+            'fi',
+            'echo "pruned:$_pruned"',
+        ]
+
+    def get_rollback_script(self, steps=None, sha=None, links=(), slot_lines=(), config_paths=(),
+                            fingerprint_path=None, current=True):
+        """ Builds the remote program pointing the links at a previous release.
+
+        Args:
+            steps (Optional[int]): How many releases to go back from the current one.
+            sha (Optional[str]): The commit, or the beginning of the commit, of the release to go back to.
+            links (Optional[list]): The symlinks to point at the release besides the current one, quoted for
+                bash. Defaults to none.
+            slot_lines (Optional[list]): Commands run before the links are switched, such as choosing a
+                blue/green slot and printing the active one. Defaults to none.
+            config_paths (Optional[list]): Where the installed supervisor config may be. Defaults to none.
+            fingerprint_path (Optional[str]): The file recording what the last deploy shipped, which no longer
+                describes the server. Defaults to None.
+            current (Optional[bool]): If the current symlink is switched too, rather than once the program is
+                healthy. Defaults to True.
+
+        """
+        releases = Release.RELEASES_DIR
+        lines = [
+            'set -e -o pipefail',
+            'cd %s' % Preflight.quote_path(self.app_directory),
+            '_list=$(%s | { grep -v -e %s || true; })' % (ReleaseHistory.get_list_command(),
+                                                         pipes.quote('%s$' % Release.WATCH_SUFFIX)),
+            '_previous=$(readlink %s 2>/dev/null || true)' % Release.CURRENT_LINK,
+            '_current=${_previous#%s/}' % releases,
+            '_current=${_current%%%s}' % Release.WATCH_SUFFIX,
+        ]
+        if sha is not None:
+            lines.extend([
+                '_id=$(echo "$_list" | { grep %s || true; } | head -n 1)' % pipes.quote('^%s' % sha),
+                'if [ $(echo "$_list" | { grep %s || true; } | cut -c 1-40 | sort -u | wc -l) -gt 1 ]; then'
+                % pipes.quote('^%s' % sha),
+                '    echo "Several kept releases match \"%s\"." >&2 && exit 1' % sha,
+                'fi',
+            ])
+        else:
+            lines.append('_id=$(echo "$_list" | awk -v current="$_current" \'found && ++n == %d { print; exit }'
+                         ' $0 == current { found = 1 }\')' % steps)
+        lines.extend([
+            'if [ -z "$_id" ]; then',
+            '    echo "No such release is kept, the kept ones are:" >&2 && echo "$_list" >&2 && exit 1',
+            'fi',
+            'echo "release:$_id"',
+            'echo "previous:${_previous#%s/}"' % releases,
+            'if [ "%s/$_id" = "$_previous" ]; then echo unchanged && exit 0; fi' % releases,
+        ])
+
+        # The stored config is only sent back when it differs from the installed one
+        lines.append('_config="%s/$_id%s"' % (releases, ReleaseHistory.CONFIG_SUFFIX))
+        lines.append('if [ -f "$_config" ]; then')
+        lines.append('    _installed=')
+        for path in config_paths:
+            lines.append('    [ -n "$_installed" ] || [ ! -f %s ] || _installed=%s' % (pipes.quote(path),
+                                                                                    pipes.quote(path)))
+        lines.extend([
+            '    if [ -z "$_installed" ] || ! cmp -s "$_config" "$_installed"; then',
+            '        echo "config:$(base64 < "$_config" | tr -d \'\\n\')"',
+            '    fi',
+            'fi',
+        ])
+
+        lines.extend(slot_lines)
+        for link in ([Release.CURRENT_LINK] if current else []) + list(links):
+            lines.extend([
+                'ln -sfn "%s/$_id" %s.tmp.$$' % (releases, link),
+                'mv -T %s.tmp.$$ %s' % (link, link),
+            ])
+        if fingerprint_path is not None:
+            lines.append('rm -f %s' % Preflight.quote_path(fingerprint_path))
+
+        return '\n'.join(lines)
+
+    def rollback(self, steps=None, sha=None, links=(), slot_lines=(), config_paths=(), fingerprint_path=None,
+                 current=True):
+        """ Points the links at a previous release, in a single round trip. The program is not restarted.
+
+        See `get_rollback_script` for the arguments.
+
+        Returns:
+            RollbackStats: The release rolled back to, the previous one, the blue/green slot active before
+                rolling back if the slot commands print it, and the supervisor config of the release when it
+                differs from the installed one.
+
+        Raises:
+            ReleaseError: If the release is not kept, or the links could not be switched.
+
+        """
+        script = self.get_rollback_script(steps, sha, links, slot_lines, config_paths, fingerprint_path, current)
+        try:
+            status, out, err = self.server.run_script(script, label='rollback')
+        except ServerError, e:
+            raise ReleaseError('Could not run the rollback program.\n\t> %s' % e, base=e)
+
+        if status != 0:
+            raise ReleaseError(err.rstrip().replace('\n', '\n\t  '))
+
+        stats = RollbackStats()
+        for line in out.splitlines():
+            key, _, value = line.partition(':')
+            if key == 'release':
+                stats.release = value
+            elif key == 'previous':
+                stats.previous = value or None
+            elif key == 'active':
+                stats.active = value or None
+            elif key == 'config':
+                stats.supervisor_config = base64.b64decode(value)
+            elif key == 'unchanged':
+                stats.unchanged = True
+
+        return stats
@@ -0,0 +1,311 @@
+import math
+import pipes
+import time
+
+from preflight import Preflight
+from release import Release
+from utilities import BLUE_GREEN_SLOTS, get_program_names
+
+from server import ServerError
+
+from supervisor_rpc import SupervisorClient, SupervisorError
+
+
+class RestartError(Exception):
+    """ Base error class for Restart """
+
+    def __init__(self, message, base=None):
+        super(RestartError, self).__init__(message)
+        self.base_exception = base
+
+
+class RestartStats(object):
+    """ What restarting the project did """
+
+    def __init__(self):
+        self.program = None
+        self.previous = None
+        self.time_to_healthy = None
+
+
+class HealthCheck(object):
+    """ Polls a program from the server itself until it is healthy, or until the timeout.
+
+    The program is probed either by opening a TCP connection to its port, by requesting an HTTP path and
+    expecting a 2xx status, or by running a command from the release directory with `$PORT` set.
+
+    """
+    DEFAULT_TIMEOUT = 60
+    DEFAULT_INTERVAL = 1
+    PROBE_TIMEOUT = 5
+    HEALTHY_MARKER = '__DEPLOY_HEALTHY__'
+
+    def __init__(self, config):
+        self.type = config['type']
+        self.path = config.get('path', '/')
+        self.command = config.get('command')
+        self.timeout = config.get('timeout', HealthCheck.DEFAULT_TIMEOUT)
+        self.interval = config.get('interval', HealthCheck.DEFAULT_INTERVAL)
+
+    def get_probe(self, port):
+        """ Builds the bash command probing the program once.
+
+        Raises:
+            RestartError: If the check needs a port and there is none, or a command and there is none.
+
+        """
+        if self.type == 'command':
+            if not self.command:
+                raise RestartError('The command health check has no command.')
+            return self.command
+
+        if port is None:
+            raise RestartError('The %s health check needs the restart port.' % self.type)
+
+        probe = 'exec 3<>/dev/tcp/127.0.0.1/%d' % port
+        if self.type == 'http':
+            request = 'GET %s HTTP/1.0\r\nHost: localhost\r\n\r\n' % self.path
+            probe += ' && printf %s >&3 && head -n 1 <&3 | grep -q "^HTTP/[0-9.]* 2"' % pipes.quote(request)
+        return probe
+
+    def get_script(self, directory, port):
+        """ Builds the remote program polling the program until it is healthy. """
+        lines = ['cd %s' % Preflight.quote_path(directory)]
+        if port is not None:
+            lines.append('export PORT=%d' % port)
+
+        lines.extend([
+            '_deadline=$(($(date +%%s) + %d))' % int(math.ceil(self.timeout)),
+            'while true; do',
+            '    if _out=$(timeout %d bash -c %s 2>&1); then' % (HealthCheck.PROBE_TIMEOUT,
+                                                                 pipes.quote(self.get_probe(port))),
+            '        echo %s' % HealthCheck.HEALTHY_MARKER,
+            '        exit 0',
+            '    fi',
+            '    if [ "$(date +%s)" -ge "$_deadline" ]; then',
+            '        echo "$_out" | tail -n 20 >&2',
+            '        exit 1',
+            '    fi',
+            '    sleep %s' % self.interval,
+            'done',
+        ])
+
+        return '\n'.join(lines)
+
+    def wait(self, server, directory, port):
+        """ Waits for the program to be healthy.
+
+        Args:
+            server (Server): The remote server.
+            directory (string): The release directory the program runs from.
+            port (int): The port of the program, or None.
+
+        Returns:
+            tuple: If the program is healthy, and the output of the last probe otherwise.
+
+        Raises:
+            RestartError: If the check could not run.
+
+        """
+        try:
+            status, out, err = server.run_script(self.get_script(directory, port), label='health check')
+        except ServerError, e:
+            raise RestartError('Could not run the health check.\n\t> %s' % e, base=e)
+
+        if HealthCheck.HEALTHY_MARKER in out:
+            return True, ''
+        return False, err.rstrip() or 'Exit status %s.' % status
+
+
+class Restart(object):
+    """ Restarts the project with supervisor once a release is published.
+
+    With the default "restart" strategy, the single program is restarted in place. With the "blue_green"
+    strategy, the project has a program per slot, each running the release its slot symlink points at, on
+    the restart port plus the slot index. The release is published to the inactive slot, whose program is
+    restarted and checked. Only once it is healthy does the current symlink follow the slot and is the program
+    of the previously active slot stopped, otherwise the new program is stopped and the previous one keeps
+    serving, still current.
+
+    """
+    ACTIVE_FILE = 'active'
+
+    def __init__(self, server, config, app_directory):
+        restart_config = config.get('restart', {})
+
+        self.server = server
+        self.app_directory = app_directory.rstrip('/')
+        self.strategy = restart_config.get('strategy', 'restart')
+        self.port = restart_config.get('port')
+        self.programs = [str(program) for program in get_program_names(config)]
+        self.supervisor = SupervisorClient(server)
+
+        # Switching strategies removes the programs of the other one
+        project = str(config['project']['name'].lower())
+        self.groups = [project] + ['%s-%s' % (project, slot) for slot in BLUE_GREEN_SLOTS]
+        self.health_check = None
+        if 'health_check' in restart_config:
+            self.health_check = HealthCheck(restart_config['health_check'])
+
+    @property
+    def active_path(self):
+        return '%s/%s' % (self.app_directory, Restart.ACTIVE_FILE)
+
+    def get_active_slot(self):
+        """ Gets the blue/green slot serving the last healthy release, from the contents gathered by the
+            preflight, or None. """
+        slot = self.server.facts['contents'].get(self.active_path)
+        return slot if slot in BLUE_GREEN_SLOTS else None
+
+    def get_target_slot(self):
+        """ Gets the blue/green slot the next release goes to. """
+        active = self.get_active_slot()
+        return BLUE_GREEN_SLOTS[1] if active == BLUE_GREEN_SLOTS[0] else BLUE_GREEN_SLOTS[0]
+
+    def get_links(self):
+        """ Gets the symlinks to point at the published release, besides the current one. """
+        return [self.get_target_slot()] if self.strategy == 'blue_green' else []
+
+    def switches_current(self):
+        """ Tells if the current symlink points at a release as soon as it is published. In blue/green mode, it
+            only follows the target slot once its program is healthy. """
+        return self.strategy != 'blue_green'
+
+    def get_rollback_links(self):
+        """ Gets the symlinks to point at a release rolled back to, besides the current one, quoted for bash. They
+            are resolved remotely by the commands of `get_target_slot_lines`. """
+        return ['"$_slot"'] if self.strategy == 'blue_green' else []
+
+    def get_target_slot_lines(self):
+        """ Builds the commands printing the active blue/green slot, and setting `$_slot` to the slot the next
+            release goes to, as `get_target_slot` does. They run from the project directory. """
+        if self.strategy != 'blue_green':
+            return []
+        return [
+            '_active=$(cat %s 2>/dev/null || true)' % Restart.ACTIVE_FILE,
+            'echo "active:$_active"',
+            'if [ "$_active" = %s ]; then _slot=%s; else _slot=%s; fi' % (BLUE_GREEN_SLOTS[0], BLUE_GREEN_SLOTS[1],
+                                                                         BLUE_GREEN_SLOTS[0]),
+        ]
+
+    def get_reload_links(self):
+        """ Gets the symlinks to point at a release reloaded in place, besides the current one. """
+        if self.strategy != 'blue_green':
+            return []
+        return [self.get_active_slot() or self.get_target_slot()]
+
+    def _wait_healthy(self, slot, port, stats, start):
+        if self.health_check is None:
+            return True, ''
+
+        healthy, error = self.health_check.wait(self.server, '%s/%s' % (self.app_directory, slot), port)
+        if healthy:
+            stats.time_to_healthy = time.time() - start
+        return healthy, error
+
+    def _restart(self):
+        stats = RestartStats()
+        stats.program = self.programs[0]
+
+        start = time.time()
+        self.supervisor.update(self.groups, then=SupervisorClient.get_restart_calls(stats.program))
+
+        healthy, error = self._wait_healthy('current', self.port, stats, start)
+        if not healthy:
+            raise RestartError('"%s" did not become healthy within %ss.\n\t> %s' % (
+                stats.program, self.health_check.timeout, error))
+
+        return stats
+
+    def _switch(self):
+        stats = RestartStats()
+        active, target = self.get_active_slot(), self.get_target_slot()
+        index = BLUE_GREEN_SLOTS.index(target)
+        stats.program = self.programs[index]
+        stats.previous = self.programs[BLUE_GREEN_SLOTS.index(active)] if active is not None else None
+
+        start = time.time()
+        self.supervisor.update(self.groups, then=SupervisorClient.get_restart_calls(stats.program))
+
+        healthy, error = self._wait_healthy(target, self.port + index if self.port else None, stats, start)
+        if not healthy:
+            try:
+                self.supervisor.stop([stats.program])
+            except SupervisorError:
+                pass
+            kept = ', kept "%s" running' % stats.previous if stats.previous is not None else ''
+            raise RestartError('"%s" did not become healthy within %ss%s.\n\t> %s' % (
+                stats.program, self.health_check.timeout, kept, error))
+
+        self._activate(target)
+        # The other slot may also run after a reboot, as both slots start with supervisord
+        self.supervisor.stop([program for program in self.programs if program != stats.program])
+
+        return stats
+
+    def _activate(self, slot):
+        """ Points the current symlink at the release of a healthy slot, and records the slot as the active one.
+
+        Raises:
+            RestartError: If the slot could not be activated.
+
+        """
+        lines = ['set -e', 'cd %s' % Preflight.quote_path(self.app_directory)]
+        lines.extend(Release.get_switch_lines('"$(readlink %s)"' % slot))
+        lines.append('echo %s > %s' % (slot, Restart.ACTIVE_FILE))
+        status, out, err = self.server.run_script('\n'.join(lines), label='activate slot')
+        if status != 0:
+            raise RestartError('Could not make "%s" the active slot.\n\t> %s' % (slot, err.rstrip() or status))
+        self.server.facts['contents'][self.active_path] = slot
+
+    def _reload(self):
+        stats = RestartStats()
+        active = self.get_active_slot()
+        index = BLUE_GREEN_SLOTS.index(active)
+        stats.program = self.programs[index]
+
+        start = time.time()
+        self.supervisor.update(self.groups, then=SupervisorClient.get_restart_calls(stats.program))
+
+        healthy, error = self._wait_healthy(active, self.port + index if self.port else None, stats, start)
+        if not healthy:
+            raise RestartError('"%s" did not become healthy within %ss.\n\t> %s' % (
+                stats.program, self.health_check.timeout, error))
+
+        return stats
+
+    def reload(self):
+        """ Restarts the program serving the project in place, without switching blue/green slots, unless
+            no slot serves it yet.
+
+        Returns:
+            RestartStats: What restarting the project did.
+
+        Raises:
+            RestartError: If the program could not be restarted, or did not become healthy in time.
+
+        """
+        if self.strategy != 'blue_green' or self.get_active_slot() is None:
+            return self.run()
+
+        try:
+            return self._reload()
+        except (ServerError, SupervisorError), e:
+            raise RestartError('Could not control supervisor.\n\t> %s' % e, base=e)
+
+    def run(self):
+        """ Restarts the project, or switches it to the release of the inactive blue/green slot.
+
+        Returns:
+            RestartStats: What restarting the project did.
+
+        Raises:
+            RestartError: If the program could not be restarted, or did not become healthy in time.
+
+        """
+        try:
+            if self.strategy == 'blue_green':
+                return self._switch()
+            return self._restart()
+        except (ServerError, SupervisorError), e:
+            raise RestartError('Could not control supervisor.\n\t> %s' % e, base=e)
@@ -0,0 +1,373 @@
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import pipes
+import Queue
+import signal
+import subprocess
+import threading
+
+from channels import Command, STDOUT
+from facts import FactsCache
+from preflight import Preflight
+from release import Release
+from terminal import Terminal
+from tracing import tracer
+
+from server import ServerError
+
+# Local scripts of every host share the same process pool
+_local_slots = threading.BoundedSemaphore(multiprocessing.cpu_count())
+_local_cache_lock = threading.Lock()
+
+RAN = 'ran'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+
+class ScriptError(Exception):
+    """ Base error class for ScriptStage """
+
+    def __init__(self, message, base=None):
+        super(ScriptError, self).__init__(message)
+        self.base_exception = base
+
+
+class ScriptStats(object):
+    """ What running the scripts of a stage did """
+
+    def __init__(self):
+        self.ran = 0
+        self.skipped = 0
+
+
+class Script(object):
+    """ A before or after script, either a bare remote command or an object such as
+        `{"name": "migrate", "command": "./migrate.sh", "target": "remote", "depends_on": ["assets"],
+        "timeout": 300, "inputs": ["migrations"]}`. """
+    TARGETS = ('local', 'remote')
+
+    def __init__(self, config):
+        if not isinstance(config, dict):
+            config = {'command': config}
+
+        self.command = config['command']
+        self.name = config.get('name', self.command)
+        self.target = config.get('target', 'remote')
+        self.depends_on = config.get('depends_on', [])
+        self.timeout = config.get('timeout')
+        self.inputs = config.get('inputs')
+
+    def get_inputs_hash(self):
+        """ Hashes the script and the content of its inputs, files, directories or glob patterns relative to the
+            project root.
+
+        Returns:
+            string: The hash, or None if the script declares no inputs and must always run.
+
+        """
+        if self.inputs is None:
+            return None
+
+        digest = hashlib.sha1()
+        digest.update('%s\0%s\0' % (self.target, self.command))
+
+        paths = set()
+        for pattern in self.inputs:
+            for match in glob.glob(pattern) or [pattern]:
+                if os.path.isdir(match):
+                    for root, dirs, names in os.walk(match):
+                        paths.update(os.path.join(root, name) for name in names)
+                else:
+                    paths.add(match)
+
+        for path in sorted(paths):
+            digest.update('%s\0' % os.path.normpath(path))
+            try:
+                with open(path, 'rb') as file_handle:
+                    for chunk in iter(lambda: file_handle.read(65536), ''):
+                        digest.update(chunk)
+            except IOError:
+                digest.update('\0missing\0')
+
+        return digest.hexdigest()
+
+
+class ScriptStage(object):
+    """ Runs the before or after scripts of a deploy, following their dependencies.
+
+    Scripts whose dependencies succeeded start right away, up to `CONCURRENCY` at the same time: local ones
+    as processes, at most one per CPU across every host, and remote ones on their own channel of the server
+    transport, from the release directory. Their output is streamed as it arrives, and a script exceeding its
+    timeout is aborted. Once a script failed, no other one starts, and the stage fails once the running ones
+    are over.
+
+    A local script runs once per deploy, however many servers are deployed. Scripts declaring their inputs are
+    skipped when these did not change since they last succeeded, which is recorded remotely in `scripts.json`
+    for remote scripts, and in the local cache for local ones.
+
+    """
+    CONCURRENCY = 8
+    STATE_FILE = 'scripts.json'
+    TAIL_LINES = 20
+
+    def __init__(self, stage, configs, project):
+        self.stage = stage
+        self.scripts = [Script(config) for config in configs]
+        self.cache_path = os.path.join(FactsCache.get_cache_dir(), 'scripts', '%s.json' % project)
+        self._local = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_state_path(app_directory):
+        """ Gets the remote file recording the inputs of the remote scripts that last succeeded. """
+        return '%s/%s' % (app_directory.rstrip('/'), ScriptStage.STATE_FILE)
+
+    def validate(self):
+        """ Checks the names, targets and dependencies of the scripts.
+
+        Raises:
+            ScriptError: If a name is not unique, a target or a dependency is unknown, or dependencies form a
+                cycle.
+
+        """
+        by_name = {}
+        for script in self.scripts:
+            if script.name in by_name:
+                raise ScriptError('The %s script "%s" is defined twice.' % (self.stage, script.name))
+            if script.target not in Script.TARGETS:
+                raise ScriptError('The %s script "%s" has an unknown target "%s".' % (self.stage, script.name,
+                                                                                       script.target))
+            by_name[script.name] = script
+
+        for script in self.scripts:
+            for dependency in script.depends_on:
+                if dependency not in by_name:
+                    raise ScriptError('The %s script "%s" depends on an unknown script "%s".' % (
+                        self.stage, script.name, dependency))
+
+        visited = {}
+
+        def visit(script, path):
+            if visited.get(script.name) == 'done':
+                return
+            if script.name in path:
+                raise ScriptError('The %s scripts "%s" depend on each other.' % (self.stage, '", "'.join(path)))
+            for dependency in script.depends_on:
+                visit(by_name[dependency], path + [script.name])
+            visited[script.name] = 'done'
+
+        for script in self.scripts:
+            visit(script, [])
+
+    def _key(self, script):
+        return '%s:%s' % (self.stage, script.name)
+
+    def _read_local_cache(self):
+        try:
+            with open(self.cache_path, 'r') as file_handle:
+                return json.load(file_handle)
+        except (IOError, ValueError):
+            return {}
+
+    def _write_local_cache(self, script, inputs):
+        with _local_cache_lock:
+            cache = self._read_local_cache()
+            cache[self._key(script)] = inputs
+            try:
+                if not os.path.isdir(os.path.dirname(self.cache_path)):
+                    os.makedirs(os.path.dirname(self.cache_path))
+                with open(self.cache_path + '.tmp', 'w') as file_handle:
+                    json.dump(cache, file_handle)
+                os.rename(self.cache_path + '.tmp', self.cache_path)
+            except (IOError, OSError), e:
+                Terminal.print_warn('Could not record the inputs of "%s".\n\t> %s', script.name, e)
+
+    @staticmethod
+    def _print(script, stream, line):
+        Terminal.print_output(stream, '%s: %s' % (script.name, line))
+
+    def _exec_local(self, script, host):
+        """ Runs a local script from the project root, aborting it after its timeout.
+
+        Returns:
+            tuple: If the script succeeded, and its last lines of output.
+
+        """
+        env = dict(os.environ, DEPLOY_HOST=host, DEPLOY_STAGE=self.stage)
+        tail = []
+        with _local_slots:
+            with tracer.span(script.name, 'local', host=host, command=script.command[:200]) as span:
+                process = subprocess.Popen(['bash', '-c', script.command], stdin=open(os.devnull, 'r'),
+                                           stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env,
+                                           preexec_fn=os.setsid)
+                timed_out = []
+
+                def abort():
+                    timed_out.append(True)
+                    try:
+                        os.killpg(process.pid, signal.SIGKILL)
+                    except OSError:
+                        pass
+
+                timer = threading.Timer(script.timeout, abort) if script.timeout else None
+                if timer is not None:
+                    timer.start()
+                try:
+                    for line in iter(process.stdout.readline, ''):
+                        ScriptStage._print(script, STDOUT, line.rstrip('\n'))
+                        tail = (tail + [line.rstrip('\n')])[-ScriptStage.TAIL_LINES:]
+                    status = process.wait()
+                finally:
+                    if timer is not None:
+                        timer.cancel()
+                span.args.update(exit_code=status, timed_out=bool(timed_out))
+
+        if timed_out:
+            return False, 'Timed out after %ss.' % script.timeout
+        return status == 0, '\n'.join(tail) or 'Exit status %s.' % status
+
+    def _run_local(self, script, host):
+        """ Runs a local script, unless another host already runs it for this deploy, in which case its result
+            is shared. """
+        with self._lock:
+            entry = self._local.get(script.name)
+            owner = entry is None
+            if owner:
+                entry = self._local[script.name] = {'done': threading.Event(), 'result': (FAILED, '')}
+
+        if not owner:
+            entry['done'].wait()
+            return entry['result']
+
+        try:
+            inputs = script.get_inputs_hash()
+            if inputs is not None and self._read_local_cache().get(self._key(script)) == inputs:
+                entry['result'] = (SKIPPED, '')
+            else:
+                ok, output = self._exec_local(script, host)
+                entry['result'] = (RAN if ok else FAILED, output)
+                if ok and inputs is not None:
+                    self._write_local_cache(script, inputs)
+        finally:
+            entry['done'].set()
+
+        return entry['result']
+
+    def _run_remote(self, script, server, app_directory, release_directory, state):
+        """ Runs a remote script from the release directory, on its own channel. """
+        inputs = script.get_inputs_hash()
+        if inputs is not None and state.get(self._key(script)) == inputs:
+            return SKIPPED, ''
+
+        program = 'export DEPLOY_APP_DIR=%s DEPLOY_STAGE=%s && cd %s && %s' % (
+            Preflight.quote_path(app_directory), self.stage, Preflight.quote_path(release_directory), script.command)
+        command = Command('bash -c %s' % pipes.quote(program), timeout=script.timeout,
+                          label=script.name, keep_output=False)
+        try:
+            for stream, line in server.stream(command):
+                ScriptStage._print(script, stream, line)
+        except IOError, e:
+            return FAILED, 'An error occurred with the ssh connection.\n\t> %s' % e
+
+        if command.timed_out:
+            return FAILED, 'Timed out after %ss.' % script.timeout
+        if not command.ok:
+            return FAILED, command.get_tail() or 'Exit status %s.' % command.status
+
+        if inputs is not None:
+            with self._lock:
+                state[self._key(script)] = inputs
+        return RAN, ''
+
+    def _run_script(self, script, server, app_directory, release_directory, state, host, results):
+        Terminal.set_host(host)
+        try:
+            if script.target == 'local':
+                result = self._run_local(script, server.address)
+            else:
+                result = self._run_remote(script, server, app_directory, release_directory, state)
+        except Exception, e:
+            result = FAILED, str(e)
+        finally:
+            Terminal.set_host(None)
+        results.put((script, result))
+
+    def _read_state(self, server, app_directory):
+        content = server.facts['contents'].get(ScriptStage.get_state_path(app_directory))
+        try:
+            return json.loads(content) if content else {}
+        except ValueError:
+            return {}
+
+    def run(self, server, app_directory, release_directory=None):
+        """ Runs the scripts of the stage for a server.
+
+        Args:
+            server (Server): The remote server.
+            app_directory (string): The remote project directory.
+            release_directory (Optional[str]): The remote release directory the remote scripts run from, which
+                may not be the current one yet. Defaults to the current release.
+
+        Returns:
+            ScriptStats: What running the scripts did.
+
+        Raises:
+            ScriptError: If a script failed, or the scripts are invalid.
+
+        """
+        self.validate()
+        if release_directory is None:
+            release_directory = '%s/%s' % (app_directory.rstrip('/'), Release.CURRENT_LINK)
+
+        stats = ScriptStats()
+        state = self._read_state(server, app_directory)
+        initial_state = dict(state)
+        host = Terminal.get_host()
+        results = Queue.Queue()
+        pending = list(self.scripts)
+        finished = {}
+        running = 0
+        failures = []
+
+        while pending or running:
+            # Every script whose dependencies succeeded starts, unless a script already failed
+            for script in list(pending):
+                if failures or running >= ScriptStage.CONCURRENCY:
+                    break
+                if all(finished.get(dependency) in (RAN, SKIPPED) for dependency in script.depends_on):
+                    pending.remove(script)
+                    thread = threading.Thread(target=self._run_script,
+                                              args=(script, server, app_directory, release_directory, state, host,
+                                                    results))
+                    thread.daemon = True
+                    thread.start()
+                    running += 1
+
+            if not running:
+                break
+
+            script, (outcome, output) = results.get()
+            running -= 1
+            finished[script.name] = outcome
+            if outcome == RAN:
+                stats.ran += 1
+            elif outcome == SKIPPED:
+                stats.skipped += 1
+            else:
+                failures.append('"%s" failed.\n%s' % (script.name, output))
+
+        # What succeeded is recorded, even if another script failed
+        if state != initial_state:
+            try:
+                server.write_file(ScriptStage.get_state_path(app_directory), json.dumps(state, sort_keys=True))
+            except ServerError, e:
+                Terminal.print_warn('Could not record the inputs of the %s scripts.\n\t> %s', self.stage, e)
+
+        if failures:
+            raise ScriptError('%d %s script(s) failed, %d did not run.\n\t> %s' % (
+                len(failures), self.stage, len(pending), '\n\t> '.join(failures)))
+
+        return stats
@@ -0,0 +1,182 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+from facts import FactsCache
+from preflight import Preflight
+
+from server import ServerError
+
+from transfer import ChunkedUpload, TransferError
+
+
+class SeedError(Exception):
+    """ Base error class for RepositorySeed """
+
+    def __init__(self, message, base=None):
+        super(SeedError, self).__init__(message)
+        self.base_exception = base
+
+
+class RepositorySeed(object):
+    """ Seeds an empty remote bare repository from a git bundle built locally, instead of a first full push.
+
+    The bundle holds the deployed branch, down to the configured history depth if any, in which case the
+    remote repository is made shallow. It is cached locally by commit and depth, so seeding other servers
+    with the same commit does not build it again. It is uploaded with a ChunkedUpload, so an upload that was
+    interrupted resumes where it stopped. The following deploys push thin packs on top of the seeded history.
+
+    """
+    BRANCH = 'master'
+    CACHE_ENTRIES = 3
+    BUNDLE_FILE = 'seed.bundle'
+
+    def __init__(self, repository, project, depth=None):
+        self.repository = repository
+        self.depth = depth
+        self.cache_dir = os.path.join(FactsCache.get_cache_dir(), 'bundles', project)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_ref_paths(bare_repo_directory):
+        """ Gets the remote paths of which one exists once the deployed branch was pushed or seeded. """
+        return ['%s/refs/heads/%s' % (bare_repo_directory, RepositorySeed.BRANCH),
+                '%s/packed-refs' % bare_repo_directory]
+
+    @staticmethod
+    def is_seeded(server, bare_repo_directory):
+        """ Tells if the remote repository has the deployed branch, from the paths checked by the preflight. """
+        return any(server.facts['files'].get(path, True)
+                   for path in RepositorySeed.get_ref_paths(bare_repo_directory))
+
+    def _get_entry(self, sha):
+        name = '%s-%s' % (sha, self.depth if self.depth else 'full')
+        return os.path.join(self.cache_dir, '%s.bundle' % name), os.path.join(self.cache_dir, '%s.shallow' % name)
+
+    def _create(self, bundle_path, shallow_path):
+        """ Bundles the deployed branch, from a shallow clone when the history depth is limited. """
+        ref = 'refs/heads/%s' % RepositorySeed.BRANCH
+        shallow = ''
+
+        if not self.depth:
+            subprocess.check_call(['git', '--git-dir', self.repository.git_dir, 'bundle', 'create', '-q',
+                                   bundle_path + '.tmp', ref])
+        else:
+            clone_directory = tempfile.mkdtemp(dir=self.cache_dir)
+            try:
+                subprocess.check_call(['git', 'clone', '-q', '--bare', '--depth', str(self.depth),
+                                       '--branch', RepositorySeed.BRANCH,
+                                       'file://%s' % os.path.abspath(self.repository.git_dir), clone_directory])
+                subprocess.check_call(['git', '--git-dir', clone_directory, 'bundle', 'create', '-q',
+                                       bundle_path + '.tmp', ref])
+                # The commits whose parents were cut, unless the history is not deeper than the depth
+                if os.path.isfile(os.path.join(clone_directory, 'shallow')):
+                    with open(os.path.join(clone_directory, 'shallow'), 'r') as file_handle:
+                        shallow = file_handle.read()
+            finally:
+                shutil.rmtree(clone_directory, ignore_errors=True)
+
+        os.rename(bundle_path + '.tmp', bundle_path)
+        # The shallow list is written last, as it marks the cache entry complete
+        with open(shallow_path + '.tmp', 'w') as file_handle:
+            file_handle.write(shallow)
+        os.rename(shallow_path + '.tmp', shallow_path)
+
+    def _prune(self):
+        """ Only keeps the most recent cache entries. """
+        entries = sorted((os.path.getmtime(os.path.join(self.cache_dir, name)), name)
+                         for name in os.listdir(self.cache_dir) if name.endswith('.shallow'))
+        for mtime, name in entries[:-RepositorySeed.CACHE_ENTRIES]:
+            for extension in ('.bundle', '.shallow'):
+                try:
+                    os.remove(os.path.join(self.cache_dir, name[:-len('.shallow')] + extension))
+                except OSError:
+                    pass
+
+    def get_bundle(self, sha):
+        """ Gets the bundle of the deployed branch, creating it unless it is cached already.
+
+        Args:
+            sha (string): The deployed commit.
+
+        Returns:
+            tuple: The local bundle path and the shallow commits (Strings), empty when the history is complete.
+
+        Raises:
+            SeedError: If the bundle could not be created.
+
+        """
+        bundle_path, shallow_path = self._get_entry(sha)
+
+        # Servers seeded concurrently share the same bundle
+        with self._lock:
+            try:
+                if not os.path.isfile(shallow_path) or not os.path.isfile(bundle_path):
+                    if not os.path.isdir(self.cache_dir):
+                        os.makedirs(self.cache_dir)
+                    self._create(bundle_path, shallow_path)
+                    self._prune()
+
+                with open(shallow_path, 'r') as file_handle:
+                    shallow = file_handle.read().split()
+            except (IOError, OSError, subprocess.CalledProcessError), e:
+                raise SeedError('Could not create the git bundle of "%s".\n\t> %s' % (sha, e), base=e)
+
+        return bundle_path, shallow
+
+    @staticmethod
+    def get_script(bare_repo_directory, remote_path, shallow):
+        """ Builds the remote program fetching the deployed branch out of the uploaded bundle. """
+        bare = Preflight.quote_path(bare_repo_directory)
+        bundle = Preflight.quote_path(remote_path)
+
+        lines = ['set -e -o pipefail']
+        if shallow:
+            lines.append('printf "%%s\\n" %s > %s/shallow' % (' '.join(shallow), bare))
+        lines.extend([
+            # A bundle that does not apply is uploaded again next time
+            'if ! git --git-dir %s fetch -q %s %s:%s; then' % (bare, bundle, RepositorySeed.BRANCH,
+                                                               RepositorySeed.BRANCH),
+            '    rm -f %s %s/shallow' % (bundle, bare),
+            '    exit 1',
+            'fi',
+            'rm -f %s' % bundle,
+        ])
+
+        return '\n'.join(lines)
+
+    def run(self, server, app_directory, bare_repo_directory, sha):
+        """ Seeds the remote repository with the deployed branch.
+
+        Args:
+            server (Server): The remote server.
+            app_directory (string): The remote project directory.
+            bare_repo_directory (string): The remote bare repository, without the deployed branch.
+            sha (string): The deployed commit.
+
+        Returns:
+            TransferStats: What uploading the bundle did.
+
+        Raises:
+            SeedError: If the repository could not be seeded.
+
+        """
+        bundle_path, shallow = self.get_bundle(sha)
+        remote_path = '%s/%s' % (app_directory.rstrip('/'), RepositorySeed.BUNDLE_FILE)
+
+        try:
+            stats = ChunkedUpload(server, bundle_path, remote_path).run()
+            status, out, err = server.run_script(RepositorySeed.get_script(bare_repo_directory, remote_path, shallow),
+                                                 label='seed repository')
+        except TransferError, e:
+            raise SeedError('Could not upload the git bundle.\n\t> %s' % e, base=e)
+        except ServerError, e:
+            raise SeedError('Could not fetch the git bundle.\n\t> %s' % e, base=e)
+
+        if status != 0:
+            raise SeedError('Could not fetch the git bundle.\n\t> %s' % err.rstrip())
+
+        server.facts['files'][RepositorySeed.get_ref_paths(bare_repo_directory)[0]] = True
+        return stats
@@ -1,10 +1,21 @@
-from paramiko import SSHClient, AutoAddPolicy
+from agent_rpc import AgentClient, AgentError
 
-from utilities import get_bash_script, get_string
+from connection import ConnectionPool, HostKey
+
+from preflight import Preflight, PreflightError
+
+from utilities import get_string, BASH_HELPERS, BASH_HELPERS_HASH
 
 from terminal import Terminal
 
-from socket import timeout
+from channels import Command, ChannelMultiplexer
+
+import base64
+import pipes
+import threading
+
+# Serializes password prompts when several servers are handled concurrently
+_prompt_lock = threading.Lock()
 
 
 class ServerError(Exception):
@@ -17,16 +28,128 @@ class ServerError(Exception):
 
 class Server(object):
     """ Represents a target remote server """
-    SCRIPT_DEP_INSTALLED = 'dependencies_installed'
-    SCRIPT_DETECT_PM = 'detect_pm'
-
-    def __init__(self, address, user):
+    HELPERS_PATH = '~/.deploy/.helpers/%s/helpers.sh' % BASH_HELPERS_HASH
+    BARE_REPO_ENTRIES = ['branches', 'config', 'description', 'HEAD', 'hooks', 'info', 'objects', 'refs']
+    SUPERVISOR_CONFIG_DIRS = ['/etc/supervisor/conf.d', '/etc/supervisord.d']
+    SUDO_PROMPT = '[deploy] sudo password:'
+    SUDO_MARKER = '__DEPLOY_SUDO_AUTHENTICATED__'
+    SUDO_AUTH_TIMEOUT = 15
+
+    def __init__(self, address, user, pool=None, port=22):
         self.address = address
         self.user = user
+        self.port = port
         self.password = None
-        self.ssh_client = SSHClient()
-        self.ssh_client.load_system_host_keys()
-        self.ssh_client.set_missing_host_key_policy(AutoAddPolicy())
+        self.pool = pool if pool is not None else ConnectionPool()
+        self.facts = {'files': {}, 'dependencies': {}, 'supervisor_configs': {}, 'contents': {}}
+        self._sftp = None
+        self.agent = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def ssh_client(self):
+        """ The pooled SSH client for this server, reconnected if the transport dropped. """
+        return self.pool.get_client(self.address, self.user, self.port)
+
+    @property
+    def key(self):
+        """ The (address, port, user) identifying this server (HostKey). """
+        return HostKey(self.address, self.port, self.user)
+
+    @property
+    def sftp(self):
+        """ An SFTP session over the pooled transport, reopened if the transport changed. """
+        transport = self.ssh_client.get_transport()
+        if self._sftp is None or self._sftp.get_channel().get_transport() is not transport \
+                or self._sftp.get_channel().closed:
+            self._sftp = self.ssh_client.open_sftp()
+        return self._sftp
+
+    @staticmethod
+    def get_sftp_path(path):
+        """ Converts a remote path into an SFTP path, where the home directory is the working directory. """
+        if path == '~':
+            return '.'
+        if path.startswith('~/'):
+            return path[2:]
+        return path
+
+    @property
+    def handshakes(self):
+        """ The number of SSH handshakes performed against this server so far. """
+        return self.pool.get_handshakes(self.address, self.user, self.port)
+
+    def exec_many(self, commands):
+        """ Executes independent commands concurrently, each on its own channel of the pooled transport.
+            Every command is traced as a span of this server.
+
+        Args:
+            commands (list): The commands to execute (Command).
+
+        Returns:
+            list: The executed commands, in the same order.
+
+        Raises:
+            IOError: If the connection closes.
+
+        """
+        multiplexer = ChannelMultiplexer()
+        transport = self.ssh_client.get_transport()
+        for command in commands:
+            command.host = self.address
+            multiplexer.add(transport, command)
+
+        return multiplexer.run()
+
+    def execute(self, command, stdin=None, timeout=None, label=None):
+        """ Executes a single command on the remote server.
+
+        Args:
+            command (string): The command.
+            stdin (Optional[str]): The data to send on the command standard input, or a file object to stream.
+                Defaults to None.
+            timeout (Optional[float]): The time after which the command is aborted, in seconds. Defaults to None.
+            label (Optional[str]): The name of the command in the trace. Defaults to None.
+
+        Returns:
+            Command: The executed command.
+
+        Raises:
+            IOError: If the connection closes.
+
+        """
+        return self.exec_many([Command(command, stdin=stdin, timeout=timeout, label=label)])[0]
+
+    def stream(self, command):
+        """ Executes a command, yielding its output lines as they arrive instead of buffering them.
+
+        Args:
+            command (Command): The command, which holds the exit status once the lines are exhausted.
+
+        Yields:
+            tuple: The stream (STDOUT or STDERR) and the line.
+
+        Raises:
+            IOError: If the connection closes.
+
+        """
+        command.host = self.address
+        multiplexer = ChannelMultiplexer()
+        multiplexer.add(self.ssh_client.get_transport(), command)
+
+        for _, stream, line in multiplexer.iter_run():
+            yield stream, line
+
+    def close(self):
+        """ Closes the pooled connection to this server. """
+        self._sftp = None
+        self.stop_agent()
+        self.pool.close(self.address, self.user, self.port)
 
     def has_valid_connection(self):
         """ Validates the SSH connection to a remote server.
@@ -36,14 +159,220 @@ class Server(object):
 
         """
         try:
-            self.ssh_client.connect(self.address, username=self.user)
+            self.pool.get_client(self.address, self.user, self.port)
         except IOError, e:
             return False, e
-        finally:
-            self.ssh_client.close()
 
         return True, None
 
+    def run_preflight(self, deps=(), directories=(), repositories=(), supervisor_projects=(), files=(), paths=()):
+        """ Runs every deploy assertion check in a single remote round trip and records the results as facts.
+
+        The other Server methods consult these facts before querying the server, so they keep making the
+        same pass, fail or auto-create decisions without paying a round trip per check.
+
+        Args:
+            deps (Optional[list]): The dependencies to check (Strings).
+            directories (Optional[list]): The directories to check (Strings).
+            repositories (Optional[list]): The (bare repository, source repository) paths to check, the source
+                repository being None when there is no checkout.
+            supervisor_projects (Optional[list]): The projects whose supervisor config must be read (Strings).
+            files (Optional[list]): The small files whose content must be read (Strings).
+            paths (Optional[list]): Other paths whose existence must be checked (Strings).
+
+        Raises:
+            ServerError: If the connection closes or the preflight output is invalid.
+
+        """
+        # Facts that are already known, e.g. from the facts cache, are not checked again
+        unknown_deps = [dep for dep in deps if not self.facts['dependencies'].get(dep)]
+
+        checked_paths = list(directories) + list(paths)
+        for bare_repo_directory, src_repo_directory in repositories:
+            checked_paths.extend('%s/%s' % (bare_repo_directory, item) for item in Server.BARE_REPO_ENTRIES)
+            if src_repo_directory is not None:
+                checked_paths.append('%s/.git' % src_repo_directory)
+
+        # A known supervisor dir is confirmed again, and forgotten if it disappeared
+        config_dirs = []
+        if supervisor_projects:
+            known_supervisor_dir = self.facts.pop('supervisor_dir', None)
+            config_dirs = [known_supervisor_dir] if known_supervisor_dir else Server.SUPERVISOR_CONFIG_DIRS
+
+        if self.agent is not None:
+            facts = self._get_agent_status(unknown_deps, checked_paths, supervisor_projects, config_dirs, files)
+        else:
+            facts = self._get_preflight_status(unknown_deps, checked_paths, supervisor_projects, config_dirs, files)
+
+        for kind, value in facts.items():
+            if isinstance(value, dict):
+                self.facts.setdefault(kind, {}).update(value)
+            else:
+                self.facts[kind] = value
+
+    def _get_preflight_status(self, deps, paths, supervisor_projects, config_dirs, files):
+        """ Gathers the preflight facts with the preflight program, in a single remote command. """
+        preflight = Preflight()
+
+        if deps:
+            # The helpers are only sent along when they are not known to be installed already
+            has_helpers = self.facts.pop('helpers', None) == BASH_HELPERS_HASH
+            preflight.use_helpers(Server.HELPERS_PATH, BASH_HELPERS_HASH, None if has_helpers else BASH_HELPERS)
+            preflight.check_dependencies(deps, self.facts.get('package_manager'))
+
+        preflight.check_files(paths)
+        for project in supervisor_projects:
+            preflight.check_supervisor_config(project, config_dirs)
+        preflight.read_files(files)
+
+        try:
+            command = self.execute('bash -c %s' % pipes.quote(preflight.get_script()), label='preflight')
+            return preflight.parse(command.out)
+        except IOError, e:
+            raise ServerError('An error occurred with the ssh connection.\n\t> %s' % e, base=e)
+        except PreflightError, e:
+            raise ServerError('Could not run the preflight checks.\n\t> %s' % e, base=e)
+
+    def _get_agent_status(self, deps, paths, supervisor_projects, config_dirs, files):
+        """ Gathers the preflight facts from the agent, which keeps the dependencies it checked in memory. """
+        try:
+            status = self.agent.call('status', label='preflight', paths=paths, contents=list(files),
+                                     supervisor_projects=list(supervisor_projects), supervisor_dirs=config_dirs,
+                                     deps=deps, helpers=BASH_HELPERS if deps else None)
+        except AgentError, e:
+            raise ServerError('Could not query the agent.\n\t> %s' % e, base=e)
+
+        facts = {'files': status['files'], 'dependencies': status.get('dependencies', {})}
+        for kind in ('contents', 'supervisor_configs'):
+            facts[kind] = dict((key, base64.b64decode(value).rstrip() if value is not None else None)
+                               for key, value in status[kind].items())
+        for kind in ('package_manager', 'supervisor_dir'):
+            if kind in status:
+                facts[kind] = status[kind]
+
+        return facts
+
+    def start_agent(self, forget=False):
+        """ Connects to the deploy agent of the server, which then answers the preflight checks, the remote
+            programs and the file writes instead of separate SSH commands.
+
+        Args:
+            forget (Optional[bool]): If the agent discovers the host state again. Defaults to False.
+
+        Raises:
+            ServerError: If the agent could not be reached.
+
+        """
+        agent = AgentClient(self)
+        try:
+            agent.connect()
+            if forget:
+                agent.call('forget')
+        except AgentError, e:
+            agent.close()
+            raise ServerError('Could not start the deploy agent.\n\t> %s' % e, base=e)
+
+        self.agent = agent
+
+    def stop_agent(self):
+        """ Closes the connection to the deploy agent, which keeps running for the next runs. """
+        if self.agent is not None:
+            self.agent.close()
+            self.agent = None
+
+    def write_file(self, path, content):
+        """ Atomically replaces the content of a remote file.
+
+        Args:
+            path (string): The remote path.
+            content (string): The new content.
+
+        Raises:
+            ServerError: If the file could not be written.
+
+        """
+        if self.agent is not None:
+            try:
+                self.agent.call('write', label='write file', path=path, content=base64.b64encode(content))
+            except AgentError, e:
+                raise ServerError('Could not write "%s".\n\t> %s' % (path, e), base=e)
+            self.facts['contents'][path] = content.rstrip()
+            return
+
+        sftp_path = Server.get_sftp_path(path)
+        try:
+            with self.sftp.open(sftp_path + '.tmp', 'w') as file_handle:
+                file_handle.write(content)
+            self.sftp.posix_rename(sftp_path + '.tmp', sftp_path)
+        except IOError, e:
+            raise ServerError('Could not write "%s".\n\t> %s' % (path, e), base=e)
+
+        self.facts['contents'][path] = content.rstrip()
+
+    def run_script(self, script, label=None):
+        """ Runs a bash program on the remote server.
+
+        Args:
+            script (string): The bash program.
+            label (Optional[str]): The name of the program in the trace. Defaults to None.
+
+        Returns:
+            tuple: The exit status, the standard output and the standard error of the program.
+
+        Raises:
+            ServerError: If the connection closes.
+
+        """
+        if self.agent is not None:
+            try:
+                result = self.agent.call('run', label=label, script=script)
+            except AgentError, e:
+                raise ServerError('Could not run the program through the agent.\n\t> %s' % e, base=e)
+            return result['status'], base64.b64decode(result['out']), base64.b64decode(result['err'])
+
+        try:
+            command = self.execute('bash -c %s' % pipes.quote(script), label=label)
+            return command.status, command.out, command.err
+        except IOError, e:
+            raise ServerError('An error occurred with the ssh connection.\n\t> %s' % e, base=e)
+
+    def _ensure_helpers(self):
+        """ Uploads the bash helpers to their versioned location, unless they are known to be there already.
+
+        Raises:
+            ServerError: If the helpers could not be installed.
+
+        """
+        if self.facts.get('helpers') == BASH_HELPERS_HASH:
+            return
+
+        path = Preflight.quote_path(Server.HELPERS_PATH)
+        command = self.execute('mkdir -p "$(dirname %s)" && cat > %s.$$ && mv %s.$$ %s' % (path, path, path, path),
+                               stdin=BASH_HELPERS, label='install helpers')
+
+        if not command.ok:
+            raise ServerError('Could not install the bash helpers.\n\t> %s' % command.err.rstrip())
+
+        self.facts['helpers'] = BASH_HELPERS_HASH
+
+    def _exec_helper(self, function, *args):
+        """ Executes one of the bash helpers functions on the remote server.
+
+        Args:
+            function (string): The helper function name.
+            *args: The function arguments (Strings).
+
+        Returns:
+            Command: The executed remote command.
+
+        """
+        self._ensure_helpers()
+
+        command = '. %s && %s' % (Preflight.quote_path(Server.HELPERS_PATH),
+                                  ' '.join([function] + [pipes.quote(arg) for arg in args]))
+
+        return self.execute('bash -c %s' % pipes.quote(command), label=function)
+
     def _get_package_manager(self):
         """ Gets the remote server package manager in an OS agnostic way.
 
@@ -54,40 +383,41 @@ class Server(object):
             ServerError: If the connection closes or we fail to retrieve the package manager.
 
         """
-        stdin, stdout, stderr = self.ssh_client.exec_command(
-            "bash -c '%s'" % get_bash_script(Server.SCRIPT_DETECT_PM))
+        if 'package_manager' in self.facts:
+            return self.facts['package_manager']
 
-        package_manager = stdout.read().rstrip()
+        package_manager = self._exec_helper('PM_detect').out.rstrip()
 
         if package_manager.startswith('[ERROR]'):
             raise ServerError('Could not retrieve the package manager.\n\t> %s' % package_manager)
 
+        self.facts['package_manager'] = package_manager
         return package_manager
 
-    def _validate_single_dep_installed(self, pm, dep):
-        """ Validates that a specific dependency is installed on the remote server.
+    def _get_missing_deps(self, pm, deps):
+        """ Gets the dependencies that are not installed on the remote server, in a single query.
 
         Args:
             pm (string): The server's package manager name.
-            dep (string: The dependency to validate.
+            deps (list): The dependencies to validate (Strings).
 
         Returns:
-            bool: If the dependency is installed.
+            list: The missing dependencies (Strings).
 
         """
-        script = "%s\nis_installed %s %s" % (get_bash_script(Server.SCRIPT_DEP_INSTALLED), pm, dep)
-        command = "bash -c '%s'" % script
-        stdin, stdout, stderr = self.ssh_client.exec_command(command)
+        unknown_deps = [dep for dep in deps if dep not in self.facts['dependencies']]
 
-        ret_code, errors = stdout.read().rstrip(), stderr.read().rstrip()
+        if unknown_deps:
+            missing = self._exec_helper('missing_packages', pm, *unknown_deps).out.split()
 
-        # if errors is not '':
-        # Terminal.print_warn('Got errors from dependency checker script.\n\t> %s' % errors)
+            for dep in unknown_deps:
+                self.facts['dependencies'][dep] = dep not in missing
 
-        return ret_code == '0'
+        return [dep for dep in deps if not self.facts['dependencies'][dep]]
 
     def validate_dep_list_installed(self, deps):
         """ Validates that certain dependencies are installed on the remote server.
+            Every missing dependency is installed in a single package manager transaction.
 
         Args:
             deps (list): The list of dependencies to validate against (Strings).
@@ -97,77 +427,163 @@ class Server(object):
 
         """
         try:
-            self.ssh_client.connect(self.address, username=self.user)
             pm = self._get_package_manager()
-            for dep in deps:
-                if not self._validate_single_dep_installed(pm, dep):
-                    if self.user != 'root' and self.password is None:
-                        self._prompt_superuser_pwd(
-                            'Missing dependency "%s". Please enter password to proceed to installation.' % dep)
+            missing = self._get_missing_deps(pm, deps)
 
-                    if not self._install_dependency(pm, dep):
-                        raise ServerError('Could not install dependency "%s".' % dep)
-                    else:
-                        print 'Successfully installed "%s".' % dep
+            if missing:
+                missing_list = '", "'.join(missing)
+                if self.user != 'root' and self.password is None:
+                    self._prompt_superuser_pwd(
+                        'Missing dependencies "%s". Please enter password to proceed to installation.' % missing_list)
+
+                if not self._install_dependencies(pm, missing):
+                    raise ServerError('Could not install dependencies "%s".' % missing_list)
+                else:
+                    Terminal.print_info('Successfully installed "%s".', missing_list)
         except IOError, e:
             raise ServerError('An error occurred with the ssh connection.\n\t> %s' % e, base=e)
-        finally:
-            self.ssh_client.close()
 
-    def _install_dependency(self, pm, dep):
-        ret, error = self._execute_sudo_cmd('%s install -y %s' % (pm, dep))
+    def _install_dependencies(self, pm, deps):
+        """ Installs dependencies in a single package manager transaction, with a single sudo authentication.
+
+        Args:
+            pm (string): The server's package manager name.
+            deps (list): The dependencies to install (Strings).
+
+        Returns:
+            bool: If every dependency is now installed.
+
+        """
+        self._ensure_helpers()
+
+        # The helpers path is an argument, expanded by the user's shell, since sudo may reset the home directory
+        ret, error = self._execute_sudo_cmd('. "$1" && shift && install_packages "$@"', echo=True,
+                                            args=[Preflight.quote_path(Server.HELPERS_PATH)]
+                                            + [pipes.quote(arg) for arg in [pm] + deps])
 
         if error != '':
             self.password = None
+            return False
 
-        return error == ''
+        for dep in deps:
+            del self.facts['dependencies'][dep]
 
-    def _execute_sudo_cmd(self, cmd):
-        transport = self.ssh_client.get_transport()
-        session = transport.open_session()
-        session.settimeout(3)
-        session.get_pty()
+        return len(self._get_missing_deps(pm, deps)) == 0
 
-        try:
-            session.exec_command("sudo -k %s" % cmd)
-            stdin = session.makefile('wb', -1)
-            stdout = session.makefile('rb', -1)
-            stderr = session.makefile_stderr('rb', -1)
+    def get_sudo_command(self, cmd, timeout=None, keep_output=True, label='sudo', args=()):
+        """ Builds a command executing as the superuser, answering the sudo prompt with the user's password.
+
+        The authentication has its own timeout, so a refused or missing password is reported right away,
+        while the command itself may run for as long as it needs, such as a package installation.
+
+        Args:
+            cmd (string): The command.
+            timeout (Optional[float]): The time after which the command is aborted, in seconds, once
+                authenticated. Defaults to None.
+            keep_output (Optional[bool]): If the whole output is kept. Defaults to True.
+            label (Optional[str]): The name of the command in the trace. Defaults to 'sudo'.
+            args (Optional[list]): The arguments of the command, `$1` and following, as shell words expanded by
+                the user's shell rather than the superuser's one. Defaults to ().
+
+        Returns:
+            Command: The command, to execute on this server.
+
+        """
+        script = pipes.quote('echo %s && %s' % (Server.SUDO_MARKER, cmd))
+        return Command(' '.join(['sudo -k -S -p %s bash -c %s sudo' % (pipes.quote(Server.SUDO_PROMPT), script)]
+                                + list(args)),
+                       stdin=None if self.password is None else '%s\n' % self.password,
+                       timeout=timeout, label=label, host=self.address, keep_output=keep_output,
+                       auth_prompt=Server.SUDO_PROMPT, auth_marker=Server.SUDO_MARKER,
+                       auth_timeout=Server.SUDO_AUTH_TIMEOUT)
+
+    @staticmethod
+    def get_sudo_result(command):
+        """ Interprets an executed superuser command.
 
-            stdin.write('%s\n' % self.password)
-            stdin.flush()
+        Returns:
+            tuple: The output and the errors of the command, the errors being empty on success.
+
+        """
+        if command.auth_failed:
+            return '', 'Invalid password.'
+        if command.timed_out:
+            return '', 'Timed out after %ss.\n%s' % (command.timeout, command.get_tail())
+        if not command.ok:
+            return '', command.get_tail() or 'Exit status %s.' % command.status
+        return command.out.strip(), ''
+
+    def _execute_sudo_cmd(self, cmd, timeout=None, echo=False, args=()):
+        """ Executes a command as the superuser.
+
+        Args:
+            cmd (string): The command.
+            timeout (Optional[float]): The time after which the command is aborted, in seconds, once
+                authenticated. Defaults to None.
+            echo (Optional[bool]): If the command output is printed as it arrives. Defaults to False.
+            args (Optional[list]): The arguments of the command, as shell words expanded by the user's shell.
+                Defaults to ().
+
+        Returns:
+            tuple: The output and the errors of the command, the errors being empty on success.
+
+        """
+        command = self.get_sudo_command(cmd, timeout=timeout, keep_output=not echo, args=args)
+
+        for stream, line in self.stream(command):
+            if echo:
+                Terminal.print_output(stream, line)
 
-            return stdout.read().rstrip(), stderr.read().rstrip()
+        return Server.get_sudo_result(command)
 
-        except timeout, e:
-            return "", "Invalid password."
+    def ensure_superuser_pwd(self, label):
+        """ Asks for the user's password, unless it is known already or the user is root. """
+        if self.user != 'root' and self.password is None:
+            self._prompt_superuser_pwd(label)
 
     def _prompt_superuser_pwd(self, label):
         """"""
-        self.password = get_string(label, password=True)
+        with _prompt_lock:
+            self.password = get_string('[%s] %s' % (self.address, label), password=True)
         return self.password
 
-    def _has_file(self, file):
-        stdin, stdout, stderr = self.ssh_client.exec_command('stat %s' % file)
+    def _has_files(self, files):
+        """ Checks if remote files exist, the unknown ones being checked concurrently.
+
+        Args:
+            files (list): The remote paths (Strings).
+
+        Returns:
+            dict: If each file exists, keyed by path.
 
-        out, err = stdout.read().rstrip(), stderr.read().rstrip()
+        """
+        unknown = [file for file in files if file not in self.facts['files']]
+
+        if unknown:
+            commands = self.exec_many([Command('stat %s' % file) for file in unknown])
+            for file, command in zip(unknown, commands):
+                self.facts['files'][file] = not command.err.rstrip().endswith('No such file or directory')
 
-        return not err.endswith('No such file or directory')
+        return dict((file, self.facts['files'][file]) for file in files)
+
+    def _has_file(self, file):
+        return self._has_files([file])[file]
 
     def _create_directory(self, directory):
         try:
-            stdin, stdout, stderr = self.ssh_client.exec_command('mkdir -p %s' % directory)
-            out, err = stdout.read().rstrip(), stderr.read().rstrip()
-            return out == '' and err == ''
+            command = self.execute('mkdir -p %s' % directory)
+            if command.out.rstrip() == '' and command.err.rstrip() == '':
+                self.facts['files'][directory] = True
+                return True
+            return False
         except IOError, e:
             return False
 
     def has_directories(self, directories, auto_create=True):
         try:
-            self.ssh_client.connect(self.address, username=self.user)
-
+            existing = self._has_files(directories)
             for directory in directories:
-                if not self._has_file(directory):
+                if not existing[directory]:
                     if auto_create:
                         Terminal.print_warn('Missing directory "%s", attempting to create.' % directory)
                         if not self._create_directory(directory):
@@ -177,41 +593,42 @@ class Server(object):
 
         except IOError, e:
             raise ServerError('An error occurred with the ssh connection.\n\t> %s' % e, base=e)
-        finally:
-            self.ssh_client.close()
 
     def _init_repo(self, path, bare=False):
         cmd = 'cd %s && git init' % path
         if bare:
             cmd = '%s --bare' % cmd
-        stdin, stdout, stderr = self.ssh_client.exec_command(cmd)
+        command = self.execute(cmd)
 
-        out, err = stdout.read().rstrip(), stderr.read().rstrip()
+        out = command.out.rstrip()
 
-        return out.startswith('Initialized empty Git repository') and err == ''
+        if command.ok and out.startswith('Initialized empty Git repository'):
+            if bare:
+                for item in Server.BARE_REPO_ENTRIES:
+                    self.facts['files']['%s/%s' % (path, item)] = True
+            return True
+        return False
 
     def _clone_repo(self, bare_repo_directory, src_repo_directory):
-        stdin, stdout, stderr = self.ssh_client.exec_command(
-            'git clone %s %s' % (bare_repo_directory, src_repo_directory))
+        command = self.execute('git clone %s %s' % (bare_repo_directory, src_repo_directory))
 
-        out, err = stdout.read().rstrip(), stderr.read().rstrip()
+        out, err = command.out.rstrip(), command.err.rstrip()
 
-        return out.endswith('done.') or err.endswith('done.')
+        if out.endswith('done.') or err.endswith('done.'):
+            self.facts['files']['%s/.git' % src_repo_directory] = True
+            return True
+        return False
 
     def _is_repo(self, path, bare=False):
 
         if bare:
-            for item in ['branches', 'config', 'description', 'HEAD', 'hooks', 'info', 'objects', 'refs']:
-                if not self._has_file('%s/%s' % (path, item)):
-                    return False
-            return True
+            entries = self._has_files(['%s/%s' % (path, item) for item in Server.BARE_REPO_ENTRIES])
+            return all(entries.values())
         else:
             return self._has_file('%s/.git' % path)
 
-    def has_git_repositories(self, bare_repo_directory, src_repo_directory, auto_create=True):
+    def has_git_repositories(self, bare_repo_directory, src_repo_directory=None, auto_create=True):
         try:
-            self.ssh_client.connect(self.address, username=self.user)
-
             if not self._is_repo(bare_repo_directory, bare=True):
                 if auto_create:
                     Terminal.print_warn('No bare git repository in "%s", attempting to create.' % bare_repo_directory)
@@ -220,7 +637,7 @@ class Server(object):
                 else:
                     raise ServerError('Missing bare git repository in "%s".' % bare_repo_directory)
 
-            if not self._is_repo(src_repo_directory, bare=False):
+            if src_repo_directory is not None and not self._is_repo(src_repo_directory, bare=False):
                 if auto_create:
                     Terminal.print_warn('No src git repository in "%s", attempting to create.' % src_repo_directory)
                     if not self._clone_repo(bare_repo_directory, src_repo_directory):
@@ -229,33 +646,43 @@ class Server(object):
                     raise ServerError('Missing src git repository in "%s".' % src_repo_directory)
         except IOError, e:
             raise ServerError('An error occurred with the ssh connection.\n\t> %s' % e, base=e)
-        finally:
-            self.ssh_client.close()
 
-    def _is_service_running(self, service):
-        stdin, stdout, stderr = self.ssh_client.exec_command(
-            "bash -c 'ps -ef | grep -v grep | grep -q %s; echo $?'" % service)
+    def _get_supervisor_config_path(self, project):
+        """ Gets the path of the supervisor config of a project, depending on the server's distribution.
 
-        ret_code, errors = stdout.read().rstrip(), stderr.read().rstrip()
+        Args:
+            project (string): The project name.
 
-        return ret_code == '0'
+        Returns:
+            string: The config file path.
+
+        Raises:
+            ServerError: If no supervisor include directory was found.
+
+        """
+        if 'supervisor_dir' not in self.facts:
+            existing = self._has_files(Server.SUPERVISOR_CONFIG_DIRS)
+            for config_dir in Server.SUPERVISOR_CONFIG_DIRS:
+                if existing[config_dir]:
+                    self.facts['supervisor_dir'] = config_dir
+                    break
+            else:
+                raise ServerError('Could not find supervisor include dir')
+
+        return '%s/%s.conf' % (self.facts['supervisor_dir'], project.lower())
 
     def get_supervisor_config(self, project, auto_create=True):
         try:
-            self.ssh_client.connect(self.address, username=self.user)
+            config_path = self._get_supervisor_config_path(project)
 
-            ubuntu_config_dir = '/etc/supervisor/conf.d'
-            rehl_config_dir = '/etc/supervisord.d'
-            config_path = ''
+            known_configs = self.facts['supervisor_configs']
 
-            if self._has_file(ubuntu_config_dir):
-                config_path = "%s/%s.conf" % (ubuntu_config_dir, project.lower())
-            elif self._has_file(rehl_config_dir):
-                config_path = '%s/%s.conf' % (rehl_config_dir, project.lower())
+            if project in known_configs:
+                has_config = known_configs[project] is not None
             else:
-                raise ServerError('Could not find supervisor include dir')
+                has_config = self._has_file(config_path)
 
-            if not self._has_file(config_path):
+            if not has_config:
                 if auto_create:
                     Terminal.print_warn(
                         'Missing supervisor config for %s in "%s", attempting to create.' % (project, config_path))
@@ -270,13 +697,17 @@ class Server(object):
                         self.password = None
                         raise ServerError('Could not create supervisor config in "%s" : %s' % (config_path, err))
 
+                    self.facts['supervisor_configs'][project] = ''
                     return ''
                 else:
                     raise ServerError('Missing supervisor config for %s in "%s".' % (project, config_path))
 
-            stdin, stdout, stderr = self.ssh_client.exec_command('cat %s' % config_path)
+            if known_configs.get(project) is not None:
+                return known_configs[project]
+
+            command = self.execute('cat %s' % config_path)
 
-            out, err = stdout.read().rstrip(), stderr.read().rstrip()
+            out, err = command.out.rstrip(), command.err.rstrip()
 
             if err != '':
                 raise ServerError('Could not read supervisor config "%s"' % config_path)
@@ -284,34 +715,22 @@ class Server(object):
             return out
         except IOError, e:
             raise ServerError('An error occurred with the ssh connection.\n\t> %s' % e, base=e)
-        finally:
-            self.ssh_client.close()
 
     def set_supervisor_config(self, project, config):
         try:
-            self.ssh_client.connect(self.address, username=self.user)
+            config_path = self._get_supervisor_config_path(project)
 
-            ubuntu_config_dir = '/etc/supervisor/conf.d'
-            rehl_config_dir = '/etc/supervisord.d'
-            config_path = ''
+            self.ensure_superuser_pwd(
+                'Need to write configuration to "%s", please enter password to proceed.' % config_path)
 
-            if self._has_file(ubuntu_config_dir):
-                config_path = "%s/%s.conf" % (ubuntu_config_dir, project.lower())
-            elif self._has_file(rehl_config_dir):
-                config_path = '%s/%s.conf' % (rehl_config_dir, project.lower())
-            else:
-                raise ServerError('Could not find supervisor include dir')
-
-            if self.user != 'root' and self.password is None:
-                self._prompt_superuser_pwd(
-                    'Need to write configuration to "%s", please enter password to proceed.' % config_path)
-
-            out, err = self._execute_sudo_cmd("bash -c 'echo \"%s\" > %s'" % (config, config_path))
+            # The config is sent encoded, so no quote or shell character of it can break the command
+            out, err = self._execute_sudo_cmd('echo %s | base64 -d > %s' % (
+                base64.b64encode(config), pipes.quote(config_path)))
 
             if err != '':
                 raise ServerError('Could not write to config in "%s" : %s' % (config_path, err))
 
+            self.facts['supervisor_configs'][project] = config.rstrip()
+
         except IOError, e:
             raise ServerError('An error occurred with the ssh connection.\n\t> %s' % e, base=e)
-        finally:
-            self.ssh_client.close()
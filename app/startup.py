@@ -0,0 +1,61 @@
+import __builtin__
+import sys
+import threading
+import time
+
+
+class ImportProfiler(object):
+    """ Times the first import of every module, by wrapping the import builtin.
+
+    The cumulative time of a module includes the modules it imported in turn, while its own time does not.
+    Modules imported lazily while a command runs are timed as well, as long as the profiler is installed.
+
+    """
+    REPORTED_MODULES = 10
+
+    def __init__(self):
+        self.start = time.time()
+        self.timings = {}
+        self._stack = []
+        self._lock = threading.RLock()
+        self._import = None
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=None, level=-1):
+        # Only the first import of a module does the work, the next ones are dictionary lookups
+        if name in sys.modules:
+            return self._import(name, globals, locals, fromlist, level)
+
+        with self._lock:
+            self._stack.append(0.0)
+            start = time.time()
+            try:
+                return self._import(name, globals, locals, fromlist, level)
+            finally:
+                cumulative = time.time() - start
+                children = self._stack.pop()
+                if self._stack:
+                    self._stack[-1] += cumulative
+                if name not in self.timings:
+                    self.timings[name] = (cumulative, cumulative - children)
+
+    def install(self):
+        self._import = __builtin__.__import__
+        __builtin__.__import__ = self._timed_import
+
+    def uninstall(self):
+        __builtin__.__import__ = self._import
+
+    @property
+    def total(self):
+        """ The time spent importing, in seconds. """
+        return sum(own for cumulative, own in self.timings.values())
+
+    def get_slowest(self):
+        """ Gets the slowest imports.
+
+        Returns:
+            list: The (module name, cumulative time, own time) of the slowest modules, slowest first.
+
+        """
+        slowest = sorted(self.timings.items(), key=lambda item: item[1][0], reverse=True)
+        return [(name, cumulative, own) for name, (cumulative, own) in slowest[:ImportProfiler.REPORTED_MODULES]]
@@ -0,0 +1,280 @@
+import json
+import os
+import threading
+import time
+
+from channels import Command
+from connection import HostKey
+from executor import HostExecutor
+from facts import FactsCache
+from preflight import Preflight
+from release import Release
+from restart import Restart
+from utilities import get_program_names
+from watch import WatchSession
+
+from server import Server
+
+from supervisor_rpc import SupervisorClient, SupervisorError
+
+_cache_lock = threading.Lock()
+
+
+class StatusError(Exception):
+    """ Base error class for FleetStatus """
+
+    def __init__(self, message, base=None):
+        super(StatusError, self).__init__(message)
+        self.base_exception = base
+
+
+class HostStatus(object):
+    """ What a server runs: its current release, and the state of the project programs """
+
+    def __init__(self, host):
+        self.host = host
+        self.release = None
+        self.slot = None
+        self.processes = []
+        self.supervisor_error = None
+        self.error = None
+        self.cached = False
+
+    @property
+    def sha(self):
+        """ The commit of the current release, or None if there is none. """
+        return self.release[:40] if self.release else None
+
+    @property
+    def watched(self):
+        """ If the current release was patched by `deploy watch`, and differs from its commit. """
+        return self.release is not None and self.release.endswith(WatchSession.RELEASE_SUFFIX)
+
+    def get_process(self):
+        """ Gets the program serving the project, the one of the active slot in blue/green mode, or None. """
+        for process in self.processes:
+            if self.slot is not None and process['name'].endswith('-%s' % self.slot):
+                return process
+        return self.processes[0] if self.processes else None
+
+    def to_dict(self):
+        return {'release': self.release, 'slot': self.slot, 'processes': self.processes,
+                'supervisor_error': self.supervisor_error}
+
+    @staticmethod
+    def from_dict(host, values):
+        status = HostStatus(host)
+        status.release = values.get('release')
+        status.slot = values.get('slot')
+        status.processes = values.get('processes', [])
+        status.supervisor_error = values.get('supervisor_error')
+        return status
+
+
+class StatusCache(object):
+    """ Keeps the status of the servers of a project for a few seconds, so repeated calls answer at once.
+
+    Servers that failed to answer are not cached, and deploying to a server invalidates its status. The cache
+    file is rewritten whole, under a lock, since the host tasks of a deploy invalidate their statuses at once.
+
+    """
+    DEFAULT_TTL = 10
+
+    def __init__(self, project, ttl=DEFAULT_TTL):
+        self.project = project
+        self.ttl = ttl
+
+    @property
+    def path(self):
+        return os.path.join(FactsCache.get_cache_dir(), 'status', '%s.json' % self.project)
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as file_handle:
+                return json.load(file_handle)
+        except (IOError, ValueError):
+            return {}
+
+    def _write(self, entries):
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            temp_path = '%s.%d.%d.tmp' % (self.path, os.getpid(), threading.current_thread().ident)
+            with open(temp_path, 'w') as file_handle:
+                json.dump(entries, file_handle)
+            os.rename(temp_path, self.path)
+        except (IOError, OSError):
+            # The cache is only an optimization, the next call will query the servers.
+            pass
+
+    def load(self):
+        """ Loads the statuses that did not expire.
+
+        Returns:
+            dict: The HostStatus of the cached servers, keyed by HostKey.
+
+        """
+        now = time.time()
+        statuses = {}
+        for entry in self._read().values():
+            if now - entry.get('timestamp', 0) <= self.ttl and 'host' in entry:
+                host = HostKey(*entry['host'])
+                statuses[host] = HostStatus.from_dict(host, entry['status'])
+        return statuses
+
+    def save(self, statuses):
+        """ Saves the statuses of the servers that answered, along with the other unexpired ones. """
+        with _cache_lock:
+            now = time.time()
+            entries = dict((slug, entry) for slug, entry in self._read().items()
+                           if now - entry.get('timestamp', 0) <= self.ttl)
+            entries.update((status.host.slug, {'timestamp': now, 'host': list(status.host),
+                                               'status': status.to_dict()})
+                           for status in statuses if status.error is None)
+            self._write(entries)
+
+    def invalidate(self, host):
+        """ Forgets the status of a server (HostKey), whose state changed. """
+        with _cache_lock:
+            entries = self._read()
+            if entries.pop(host.slug, None) is not None:
+                self._write(entries)
+
+
+class FleetStatus(object):
+    """ Finds out what many servers run, at once.
+
+    Every server is queried by its own task, up to `concurrency` at the same time, over the pooled connection.
+    A task asks, in a single round trip, for the current release and, through the supervisord XML-RPC
+    interface, for the state of the project programs. The superuser password is only asked for once every
+    task is over, for the servers where sudo required one. The statuses are cached for a few seconds by
+    `StatusCache`.
+
+    """
+    CONCURRENCY = 50
+
+    def __init__(self, config, pool, concurrency=CONCURRENCY):
+        self.config = config
+        self.pool = pool
+        self.concurrency = concurrency
+        self.app_directory = '~/.deploy/%s' % config['project']['name']
+        self.programs = [str(program) for program in get_program_names(config)]
+        self.cache = StatusCache(config['project']['name'])
+
+    def get_command(self):
+        """ Builds the command printing the current release and the active blue/green slot. """
+        return 'cd %s 2>/dev/null || exit 0; echo "current:$(readlink %s)"; echo "active:$(cat %s 2>/dev/null)"' % (
+            Preflight.quote_path(self.app_directory), Release.CURRENT_LINK, Restart.ACTIVE_FILE)
+
+    def _read_release(self, status, command):
+        if not command.ok:
+            raise StatusError('Could not read the current release.\n\t> %s' % (
+                command.get_tail() or 'Exit status %s.' % command.status))
+
+        for line in command.out.splitlines():
+            key, _, value = line.partition(':')
+            if key == 'current' and value:
+                status.release = os.path.basename(value.rstrip('/'))
+            elif key == 'active' and value:
+                status.slot = value
+
+    def _read_processes(self, status, info):
+        if isinstance(info, SupervisorError):
+            status.supervisor_error = str(info).split('\n')[0]
+            return
+
+        status.processes = [{'name': process['name'], 'state': process['statename'],
+                             'uptime': process['now'] - process['start']
+                             if process['state'] == SupervisorClient.RUNNING else None}
+                            for process in sorted(info, key=lambda process: process['name'])
+                            if process['name'] in self.programs]
+
+    def _query(self, server, status, retries):
+        """ Asks a server for its release and programs, in a single round trip. """
+        # Until a password is known, sudo only succeeds where it does not need one
+        supervisor = SupervisorClient(server)
+        release_command, supervisor_command = server.exec_many([
+            Command(self.get_command(), label='status'),
+            supervisor.get_command('supervisor.getAllProcessInfo'),
+        ])
+
+        self._read_release(status, release_command)
+        if supervisor_command.auth_failed and server.user != 'root':
+            retries.append(supervisor)
+            return
+
+        try:
+            info = SupervisorClient.parse_response(*Server.get_sudo_result(supervisor_command))
+        except SupervisorError, e:
+            info = e
+        self._read_processes(status, info)
+
+    def probe(self, server_configs, refresh=False):
+        """ Gets the status of many servers.
+
+        Args:
+            server_configs (list): The server configs (dicts).
+            refresh (Optional[bool]): If the cached statuses are ignored. Defaults to False.
+
+        Returns:
+            list: The HostStatus of every server, in the same order, with an `error` if it could not be queried.
+
+        """
+        cached = {} if refresh else self.cache.load()
+        hosts = [HostKey.from_config(server_config) for server_config in server_configs]
+        statuses = dict((host, HostStatus(host)) for host in hosts)
+        for host, status in cached.items():
+            if host in statuses:
+                status.cached = True
+                statuses[host] = status
+
+        stale = [host for host in hosts if not statuses[host].cached]
+        if not stale:
+            return [statuses[host] for host in hosts]
+
+        retries = []
+
+        def query(host):
+            server = Server(host.address, host.user, pool=self.pool, port=host.port)
+            self._query(server, statuses[host], retries)
+
+        executor = HostExecutor(concurrency=self.concurrency)
+        for result in executor.run(stale, query):
+            if not result.ok:
+                statuses[result.host].error = str(result.error)
+
+        # The password is asked for, and the programs queried again, only on the servers that need one
+        if retries:
+            for client, info in zip(retries, SupervisorClient.try_call_many(retries, 'supervisor.getAllProcessInfo')):
+                self._read_processes(statuses[client.server.key], info)
+
+        self.cache.save([statuses[host] for host in stale])
+        return [statuses[host] for host in hosts]
+
+
+def compare_to_head(repository, sha, head):
+    """ Describes how a deployed commit relates to the local head.
+
+    Returns:
+        string: "up to date", "<n> behind", "<n> ahead", "<n> ahead, <m> behind", or "unknown commit" if the local
+            repository does not have the deployed commit.
+
+    """
+    # Imported along with the repository, so it is already loaded
+    from git import GitCommandError
+
+    if sha == head:
+        return 'up to date'
+
+    try:
+        ahead, behind = [int(count) for count in repository.git.rev_list('--left-right', '--count',
+                                                                         '%s...%s' % (sha, head)).split()]
+    except (GitCommandError, ValueError):
+        return 'unknown commit'
+
+    parts = []
+    if ahead:
+        parts.append('%d ahead' % ahead)
+    if behind:
+        parts.append('%d behind' % behind)
+    return ', '.join(parts) or 'up to date'
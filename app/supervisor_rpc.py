@@ -0,0 +1,280 @@
+import base64
+import pipes
+import xmlrpclib
+
+from channels import ChannelMultiplexer
+
+from server import Server
+
+# Relays a single XML-RPC request to the supervisord unix socket, and prints the base64 encoded response.
+# It runs with either python 2 or 3, one of which supervisor depends on.
+BRIDGE = '''
+import base64, socket, sys
+body = base64.b64decode(sys.argv[1])
+for path in sys.argv[2:]:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        continue
+    header = 'POST /RPC2 HTTP/1.0\\r\\nContent-Type: text/xml\\r\\nContent-Length: %d\\r\\n\\r\\n' % len(body)
+    sock.sendall(header.encode('ascii') + body)
+    response = b''
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        response += chunk
+    sys.stdout.write(base64.b64encode(response).decode('ascii'))
+    sys.exit(0)
+sys.stderr.write('No supervisord socket in %s\\n' % ', '.join(sys.argv[2:]))
+sys.exit(1)
+'''
+
+
+class SupervisorError(Exception):
+    """ Base error class for SupervisorClient """
+
+    def __init__(self, message, base=None):
+        super(SupervisorError, self).__init__(message)
+        self.base_exception = base
+
+
+class SupervisorClient(object):
+    """ Talks to supervisord through its XML-RPC interface, over the pooled SSH transport of a server.
+
+    The supervisord unix socket is only accessible to the superuser, so every request goes through a
+    short lived bridge program executed with sudo on a channel of the server transport. Every request is
+    a single round trip, batched with `system.multicall` when there are several calls, and requests to many
+    servers can be executed concurrently with `call_many`.
+
+    """
+    SOCKET_PATHS = ['/var/run/supervisor.sock', '/var/run/supervisor/supervisor.sock', '/run/supervisor.sock',
+                    '/tmp/supervisor.sock']
+
+    # Process states and fault codes, from supervisor.states and supervisor.xmlrpc
+    RUNNING = 20
+    BAD_NAME = 10
+    ALREADY_STARTED = 60
+    NOT_RUNNING = 70
+
+    def __init__(self, server):
+        self.server = server
+
+    def get_command(self, method, *params):
+        """ Builds the command executing an XML-RPC call on the server.
+
+        Returns:
+            Command: The command, to execute on the server.
+
+        """
+        request = xmlrpclib.dumps(params, method, allow_none=True)
+        bridge = '"$(command -v python3 || command -v python)" -c %s %s %s' % (
+            pipes.quote(BRIDGE), base64.b64encode(request), ' '.join(pipes.quote(path)
+                                                                     for path in SupervisorClient.SOCKET_PATHS))
+        return self.server.get_sudo_command(bridge, label=method)
+
+    @staticmethod
+    def parse_response(out, err):
+        """ Parses the response of an executed XML-RPC call.
+
+        Args:
+            out (string): The output of the bridge.
+            err (string): The errors of the bridge, empty on success.
+
+        Returns:
+            object: The value returned by the call.
+
+        Raises:
+            SupervisorError: If the call could not be executed, or returned a fault.
+
+        """
+        if err != '':
+            raise SupervisorError('Could not reach supervisord.\n\t> %s' % err)
+
+        try:
+            response = base64.b64decode(out)
+            header, body = response.split('\r\n\r\n', 1)
+            status = header.split(' ', 2)[1]
+        except (TypeError, ValueError, IndexError), e:
+            raise SupervisorError('Invalid supervisord response.', base=e)
+
+        if status != '200':
+            raise SupervisorError('Supervisord answered with "%s".' % header.split('\r\n', 1)[0])
+
+        try:
+            return xmlrpclib.loads(body)[0][0]
+        except xmlrpclib.Fault, e:
+            raise SupervisorError('Supervisord fault: %s' % e.faultString, base=e)
+        except Exception, e:
+            raise SupervisorError('Invalid supervisord response.', base=e)
+
+    def _ensure_password(self):
+        self.server.ensure_superuser_pwd('Need to control supervisor, please enter password to proceed.')
+
+    def call(self, method, *params):
+        """ Executes a single XML-RPC call.
+
+        Returns:
+            object: The value returned by the call.
+
+        Raises:
+            SupervisorError: If the call could not be executed, or returned a fault.
+
+        """
+        return SupervisorClient.call_many([self], method, *params)[0]
+
+    @staticmethod
+    def call_many(clients, method, *params):
+        """ Executes the same XML-RPC call on many servers at once, from a single select loop.
+
+        Returns:
+            list: The values returned by every server, in the same order.
+
+        Raises:
+            SupervisorError: If the call failed on any server.
+
+        """
+        results = SupervisorClient.try_call_many(clients, method, *params)
+        for result in results:
+            if isinstance(result, SupervisorError):
+                raise result
+        return results
+
+    @staticmethod
+    def try_call_many(clients, method, *params):
+        """ Executes the same XML-RPC call on many servers at once, from a single select loop.
+
+        Returns:
+            list: The values returned by every server, in the same order, or the SupervisorError it failed with.
+
+        """
+        for client in clients:
+            client._ensure_password()
+
+        multiplexer = ChannelMultiplexer()
+        commands = []
+        results = [None] * len(clients)
+        for index, client in enumerate(clients):
+            try:
+                command = client.get_command(method, *params)
+                multiplexer.add(client.server.ssh_client.get_transport(), command)
+                commands.append((index, client, command))
+            except IOError, e:
+                results[index] = SupervisorError('An error occurred with the ssh connection.\n\t> %s' % e, base=e)
+
+        try:
+            multiplexer.run()
+        except IOError, e:
+            error = SupervisorError('An error occurred with the ssh connection.\n\t> %s' % e, base=e)
+            return [error if result is None else result for result in results]
+
+        for index, client, command in commands:
+            out, err = Server.get_sudo_result(command)
+            if command.auth_failed:
+                client.server.password = None
+            try:
+                results[index] = SupervisorClient.parse_response(out, err)
+            except SupervisorError, e:
+                results[index] = e
+
+        return results
+
+    def multicall(self, calls):
+        """ Executes many XML-RPC calls in a single round trip.
+
+        Args:
+            calls (list): The (method name, params list) of every call.
+
+        Returns:
+            list: The values returned by every call, faults being dicts with a `faultCode` and a `faultString`.
+
+        Raises:
+            SupervisorError: If the calls could not be executed.
+
+        """
+        if not calls:
+            return []
+        return self.call('system.multicall', [{'methodName': method, 'params': list(params)}
+                                              for method, params in calls])
+
+    def get_process_info(self, name):
+        """ Gets the state of a program, or None if supervisord does not know it. """
+        try:
+            return self.call('supervisor.getProcessInfo', name)
+        except SupervisorError, e:
+            if isinstance(e.base_exception, xmlrpclib.Fault) and e.base_exception.faultCode == self.BAD_NAME:
+                return None
+            raise
+
+    def is_running(self, name):
+        """ Tells if a program is running. """
+        info = self.get_process_info(name)
+        return info is not None and info['state'] == SupervisorClient.RUNNING
+
+    @staticmethod
+    def _check(calls, results, ignored=()):
+        for (method, params), result in zip(calls, results):
+            if isinstance(result, dict) and 'faultCode' in result and result['faultCode'] not in ignored:
+                raise SupervisorError('%s(%s) failed: %s' % (method, ', '.join(str(param) for param in params),
+                                                            result['faultString']))
+
+    def update(self, groups, then=()):
+        """ Reloads the supervisord config and applies the changes of some process groups, like
+            `supervisorctl update`, then executes more calls.
+
+        The config is reloaded in a first round trip. The changes of the groups, if any, and the other calls
+        are executed in a second one, so the other calls always see the new config.
+
+        Args:
+            groups (list): The process groups whose changes are applied, the others being left untouched.
+            then (Optional[list]): More (method name, params list) calls. Defaults to none.
+
+        Returns:
+            list: The process groups that were added or changed.
+
+        Raises:
+            SupervisorError: If the config could not be reloaded, a change not applied, or a call failed.
+
+        """
+        added, changed, removed = self.call('supervisor.reloadConfig')[0]
+
+        changes = []
+        for group in [group for group in removed + changed if group in groups]:
+            changes.extend([('supervisor.stopProcessGroup', [group, True]),
+                            ('supervisor.removeProcessGroup', [group])])
+        for group in [group for group in added + changed if group in groups]:
+            changes.append(('supervisor.addProcessGroup', [group]))
+
+        # An added group starts its programs on its own, so starting them again is not an error
+        ignored = (SupervisorClient.NOT_RUNNING, SupervisorClient.ALREADY_STARTED) if changes \
+            else (SupervisorClient.NOT_RUNNING,)
+        calls = changes + list(then)
+        SupervisorClient._check(calls, self.multicall(calls), ignored=ignored)
+        return [group for group in added + changed if group in groups]
+
+    @staticmethod
+    def get_restart_calls(name):
+        """ Gets the calls stopping a program if it runs, then starting it and waiting for it to be running. """
+        return [('supervisor.stopProcess', [name, True]), ('supervisor.startProcess', [name, True])]
+
+    def restart(self, name):
+        """ Restarts a program, waiting for it to be running.
+
+        Raises:
+            SupervisorError: If the program could not be restarted.
+
+        """
+        calls = SupervisorClient.get_restart_calls(name)
+        SupervisorClient._check(calls, self.multicall(calls), ignored=(SupervisorClient.NOT_RUNNING,))
+
+    def stop(self, names):
+        """ Stops programs, ignoring those that are not running.
+
+        Raises:
+            SupervisorError: If a program could not be stopped.
+
+        """
+        calls = [('supervisor.stopProcess', [name, True]) for name in names]
+        SupervisorClient._check(calls, self.multicall(calls), ignored=(SupervisorClient.NOT_RUNNING,
+                                                                      SupervisorClient.BAD_NAME))
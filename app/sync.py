@@ -0,0 +1,301 @@
+import hashlib
+import json
+import os
+import pipes
+import stat
+
+from preflight import Preflight
+
+from server import ServerError
+
+
+class SyncError(Exception):
+    """ Base error class for DeltaSync """
+
+    def __init__(self, message, base=None):
+        super(SyncError, self).__init__(message)
+        self.base_exception = base
+
+
+class SyncStats(object):
+    """ What a synchronization did, and how many bytes it avoided sending """
+
+    def __init__(self):
+        self.files = 0
+        self.changed = 0
+        self.removed = 0
+        self.bytes_changed = 0
+        self.bytes_sent = 0
+
+    @property
+    def bytes_saved(self):
+        return self.bytes_changed - self.bytes_sent
+
+
+def get_file_signature(path, block_size):
+    """ Computes the whole file hash and the hash of every block of a file, reading it as a stream.
+
+    Args:
+        path (string): The local file path.
+        block_size (int): The block size, in bytes.
+
+    Returns:
+        tuple: The file sha1 and the list of block md5 (Strings).
+
+    """
+    digest = hashlib.sha1()
+    blocks = []
+
+    with open(path, 'rb') as file_handle:
+        while True:
+            block = file_handle.read(block_size)
+            if not block:
+                break
+            digest.update(block)
+            blocks.append(hashlib.md5(block).hexdigest())
+
+    return digest.hexdigest(), blocks
+
+
+def get_directory_digest(path):
+    """ Computes a digest of the path, size, modification time and mode of every file of a directory,
+        without reading them.
+
+    Args:
+        path (string): The local directory.
+
+    Returns:
+        string: The directory digest, the same as long as no file was added, removed or modified.
+
+    """
+    digest = hashlib.sha1()
+
+    for root, dirs, names in os.walk(path):
+        dirs.sort()
+        for name in sorted(names):
+            file_path = os.path.join(root, name)
+            if not os.path.isfile(file_path):
+                continue
+            file_stat = os.stat(file_path)
+            digest.update('%s\0%d\0%d\0%o\0' % (os.path.relpath(file_path, path), file_stat.st_size,
+                                                   int(file_stat.st_mtime), stat.S_IMODE(file_stat.st_mode)))
+
+    return digest.hexdigest()
+
+
+class DeltaSync(object):
+    """ Synchronizes a local directory with a remote one, only sending the blocks that changed.
+
+    The remote side keeps a manifest of the block hashes of every file it received. Each local file
+    is compared block by block against it: blocks found at the same offset are kept in place, blocks
+    found elsewhere in the previous version are copied remotely with dd, and only the remaining blocks
+    are written through SFTP. Files are rebuilt in a temporary file and renamed over the previous
+    version, so a failed synchronization never leaves a half written file behind.
+
+    """
+    BLOCK_SIZE = 128 * 1024
+    TMP_SUFFIX = '.deploy-tmp'
+
+    def __init__(self, server, local_dir, remote_dir, block_size=BLOCK_SIZE):
+        self.server = server
+        self.local_dir = local_dir
+        self.remote_dir = remote_dir.rstrip('/')
+        self.block_size = block_size
+        self.manifest = {}
+
+    @property
+    def manifest_path(self):
+        return '%s.manifest' % self.remote_dir
+
+    def _remote_path(self, rel_path):
+        return '%s/%s' % (self.remote_dir, rel_path)
+
+    def _sftp_path(self, path):
+        return self.server.get_sftp_path(path)
+
+    def _read_manifest(self):
+        try:
+            with self.server.sftp.open(self._sftp_path(self.manifest_path), 'r') as file_handle:
+                manifest = json.loads(file_handle.read())
+        except (IOError, ValueError):
+            return {}
+
+        if manifest.get('block_size') != self.block_size:
+            return {}
+
+        return manifest.get('files', {})
+
+    def _write_manifest(self, files):
+        tmp_path = self._sftp_path(self.manifest_path + DeltaSync.TMP_SUFFIX)
+        with self.server.sftp.open(tmp_path, 'w') as file_handle:
+            file_handle.write(json.dumps({'block_size': self.block_size, 'files': files}))
+        self.server.sftp.posix_rename(tmp_path, self._sftp_path(self.manifest_path))
+
+    def _list_local_files(self):
+        files = {}
+
+        for root, dirs, names in os.walk(self.local_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                if os.path.isfile(path):
+                    files[os.path.relpath(path, self.local_dir)] = path
+
+        return files
+
+    def _plan(self, rel_path, local_path, remote_entry):
+        """ Compares a local file with its remote version.
+
+        Returns:
+            tuple: The new manifest entry, the (source, destination) block copies and the literal blocks,
+                or None if the file did not change.
+
+        """
+        local_stat = os.stat(local_path)
+        entry = {
+            'size': local_stat.st_size,
+            'mtime': int(local_stat.st_mtime),
+            'mode': stat.S_IMODE(local_stat.st_mode),
+        }
+
+        if remote_entry is not None and remote_entry['size'] == entry['size'] \
+                and remote_entry['mtime'] == entry['mtime'] and remote_entry['mode'] == entry['mode']:
+            return None
+
+        entry['sha1'], entry['blocks'] = get_file_signature(local_path, self.block_size)
+
+        if remote_entry is None:
+            return entry, None, range(len(entry['blocks']))
+
+        if remote_entry['sha1'] == entry['sha1'] and remote_entry['mode'] == entry['mode']:
+            return entry, [], []
+
+        old_blocks = remote_entry['blocks']
+        old_index = {}
+        for index, block in enumerate(old_blocks):
+            old_index.setdefault(block, index)
+
+        copies = []
+        literals = []
+        for index, block in enumerate(entry['blocks']):
+            if index < len(old_blocks) and old_blocks[index] == block:
+                continue
+            elif block in old_index:
+                copies.append((old_index[block], index))
+            else:
+                literals.append(index)
+
+        return entry, copies, literals
+
+    def _prepare_remote(self, directories, plans, removed):
+        """ Creates the directories, seeds the temporary files from the previous versions and removes the
+            deleted files, in a single remote program.
+
+        Returns:
+            list: The files whose previous version was missing remotely.
+
+        """
+        lines = ['_missing() { echo "missing:$1"; }']
+
+        for directory in sorted(directories):
+            lines.append('mkdir -p %s' % Preflight.quote_path(self._remote_path(directory)))
+
+        for rel_path, (entry, copies, literals) in sorted(plans.items()):
+            if copies is None:
+                continue
+
+            path = Preflight.quote_path(self._remote_path(rel_path))
+            tmp_path = Preflight.quote_path(self._remote_path(rel_path + DeltaSync.TMP_SUFFIX))
+            commands = ['cp -p %s %s' % (path, tmp_path)]
+            commands.extend('dd if=%s of=%s bs=%d skip=%d seek=%d count=1 conv=notrunc status=none'
+                            % (path, tmp_path, self.block_size, source, destination)
+                            for source, destination in copies)
+            lines.append('{ %s; } 2>/dev/null || _missing %s' % (' && '.join(commands), pipes.quote(rel_path)))
+
+        for rel_path in sorted(removed):
+            lines.append('rm -f %s' % Preflight.quote_path(self._remote_path(rel_path)))
+
+        status, out, err = self.server.run_script('\n'.join(lines), label='sync prepare')
+        if status != 0:
+            raise SyncError('Could not prepare the remote directory "%s".\n\t> %s' % (self.remote_dir, err.rstrip()))
+
+        return [line[len('missing:'):] for line in out.splitlines() if line.startswith('missing:')]
+
+    def _upload(self, rel_path, local_path, entry, literals, stats):
+        sftp = self.server.sftp
+        tmp_path = self._sftp_path(self._remote_path(rel_path + DeltaSync.TMP_SUFFIX))
+
+        with open(local_path, 'rb') as local_file:
+            with sftp.open(tmp_path, 'r+' if literals is not None else 'w') as remote_file:
+                remote_file.set_pipelined(True)
+
+                if literals is None:
+                    while True:
+                        block = local_file.read(self.block_size)
+                        if not block:
+                            break
+                        remote_file.write(block)
+                        stats.bytes_sent += len(block)
+                else:
+                    for index in literals:
+                        local_file.seek(index * self.block_size)
+                        block = local_file.read(self.block_size)
+                        remote_file.seek(index * self.block_size)
+                        remote_file.write(block)
+                        stats.bytes_sent += len(block)
+
+                remote_file.truncate(entry['size'])
+
+        sftp.chmod(tmp_path, entry['mode'])
+        sftp.utime(tmp_path, (entry['mtime'], entry['mtime']))
+        sftp.posix_rename(tmp_path, self._sftp_path(self._remote_path(rel_path)))
+
+    def run(self):
+        """ Synchronizes the local directory with the remote one.
+
+        The manifest of the synchronized files is then available through the `manifest` attribute.
+
+        Returns:
+            SyncStats: What the synchronization did.
+
+        Raises:
+            SyncError: If the synchronization failed.
+
+        """
+        stats = SyncStats()
+
+        try:
+            remote_files = self._read_manifest()
+            local_files = self._list_local_files()
+            stats.files = len(local_files)
+
+            plans = {}
+            manifest = {}
+            for rel_path, local_path in local_files.items():
+                plan = self._plan(rel_path, local_path, remote_files.get(rel_path))
+                if plan is None:
+                    manifest[rel_path] = remote_files[rel_path]
+                else:
+                    plans[rel_path] = plan
+                    manifest[rel_path] = plan[0]
+
+            removed = [rel_path for rel_path in remote_files if rel_path not in local_files]
+            directories = set(os.path.dirname(rel_path) for rel_path in plans if os.path.dirname(rel_path))
+            directories.add('')
+
+            for rel_path in self._prepare_remote(directories, plans, removed):
+                entry, copies, literals = plans[rel_path]
+                plans[rel_path] = entry, None, range(len(entry['blocks']))
+
+            for rel_path, (entry, copies, literals) in plans.items():
+                stats.changed += 1
+                stats.bytes_changed += entry['size']
+                self._upload(rel_path, local_files[rel_path], entry, None if copies is None else literals, stats)
+
+            stats.removed = len(removed)
+            self._write_manifest(manifest)
+            self.manifest = manifest
+        except (IOError, OSError, ServerError), e:
+            raise SyncError('Could not synchronize "%s" to "%s".\n\t> %s' % (self.local_dir, self.remote_dir, e),
+                            base=e)
+
+        return stats
@@ -1,4 +1,10 @@
 # coding=utf-8
+import threading
+
+_local = threading.local()
+_print_lock = threading.Lock()
+
+
 class Terminal:
     def __init__(self):
         pass
@@ -12,14 +18,81 @@ class Terminal:
     BOLD = '\033[1m'
     UNDERLINE = '\033[4m'
 
+    @classmethod
+    def set_host(cls, host):
+        """ Prefixes every line printed by the current thread with the host it works on. """
+        _local.host = None if host is None else str(host)
+
+    @classmethod
+    def get_host(cls):
+        """ Gets the host the current thread works on, if any. """
+        return getattr(_local, 'host', None)
+
+    @classmethod
+    def _print(cls, line):
+        host = cls.get_host()
+        if host is not None:
+            line = '%s[%s]%s %s' % (cls.BOLD, host, cls.ENDC, line)
+
+        with _print_lock:
+            print line
+
     @classmethod
     def print_error(cls, msg, *args):
-        print cls.FAIL + "[ERROR]: " + cls.ENDC + msg % args
+        cls._print(cls.FAIL + "[ERROR]: " + cls.ENDC + msg % args)
 
     @classmethod
     def print_warn(cls, msg, *args):
-        print cls.WARNING + "[WARN]: " + cls.ENDC + msg % args
+        cls._print(cls.WARNING + "[WARN]: " + cls.ENDC + msg % args)
+
+    @classmethod
+    def format_duration(cls, duration):
+        return '%s(%.2fs)%s' % (cls.HEADER, duration, cls.ENDC)
 
     @classmethod
-    def print_assert_valid(cls, msg, *args):
-        print "%s[√]%s %s" % (cls.OKBLUE, cls.ENDC, (msg % args))
+    def print_assert_valid(cls, msg, *args, **kwargs):
+        """ Prints a passed step, followed by how long it took when a `duration` keyword is given. """
+        line = "%s[√]%s %s" % (cls.OKBLUE, cls.ENDC, (msg % args))
+        if kwargs.get('duration') is not None:
+            line = '%s %s' % (line, cls.format_duration(kwargs['duration']))
+        cls._print(line)
+
+    @classmethod
+    def print_info(cls, msg, *args):
+        cls._print(cls.OKGREEN + "[INFO]: " + cls.ENDC + msg % args)
+
+    @classmethod
+    def print_output(cls, stream, line):
+        """ Prints a line of output of a remote command, the standard error being highlighted. """
+        color = cls.WARNING if stream == 'stderr' else cls.HEADER
+        cls._print('%s  |%s %s' % (color, cls.ENDC, line))
+
+    @classmethod
+    def print_host_results(cls, results):
+        """ Prints a one line summary per host of a multi-host run. """
+        width = max(len(str(result.host)) for result in results)
+
+        for result in results:
+            if result.skipped:
+                status = '%s[-]%s' % (cls.WARNING, cls.ENDC)
+                detail = 'skipped'
+            elif result.ok:
+                status = '%s[√]%s' % (cls.OKBLUE, cls.ENDC)
+                detail = '%.1fs' % result.duration
+            else:
+                status = '%s[X]%s' % (cls.FAIL, cls.ENDC)
+                detail = '%.1fs %s' % (result.duration, str(result.error).split('\n')[0])
+
+            cls._print('%s %s %s' % (status, str(result.host).ljust(width), detail))
+
+    @classmethod
+    def print_table(cls, header, rows):
+        """ Prints rows of cells as aligned columns, below a bold header. """
+        widths = [max(len(str(row[index])) for row in [header] + rows) for index in range(len(header))]
+
+        def format_row(row):
+            return '  '.join(str(cell).ljust(width) for cell, width in zip(row, widths)).rstrip()
+
+        cls._print('%s%s%s' % (cls.BOLD, format_row(header), cls.ENDC))
+        for row in rows:
+            cls._print(format_row(row))
@@ -0,0 +1,123 @@
+import json
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+class Span(object):
+    """ A timed operation, either a deploy phase or a remote command """
+
+    def __init__(self, name, category, host=None, args=None):
+        self.name = name
+        self.category = category
+        self.host = host
+        self.args = args if args is not None else {}
+        self.start = time.time()
+        self.end = None
+
+    @property
+    def duration(self):
+        return (self.end if self.end is not None else time.time()) - self.start
+
+
+class Tracer(object):
+    """ Records the spans of a deploy run, and exports them in the Chrome trace event format.
+
+    The exported file can be opened with chrome://tracing or https://ui.perfetto.dev, where every host gets
+    its own track, so slow hosts and slow steps stand out. Spans are only kept while the tracer is enabled,
+    so a long `watch` session does not pile them up when no trace was asked for.
+
+    """
+
+    def __init__(self, enabled=True):
+        self.spans = []
+        self.enabled = enabled
+        self._lock = threading.Lock()
+
+    def record(self, span):
+        """ Records a finished span, if the tracer is enabled.
+
+        Args:
+            span (Span): The span.
+
+        """
+        if span.end is None:
+            span.end = time.time()
+        if not self.enabled:
+            return
+        with self._lock:
+            self.spans.append(span)
+
+    @contextmanager
+    def span(self, name, category='phase', host=None, **args):
+        """ Times the enclosed block as a span, which is recorded even if the block raises.
+
+        Args:
+            name (string): The span name.
+            category (Optional[str]): The span category. Defaults to 'phase'.
+            host (Optional[str]): The host the span relates to. Defaults to None.
+            **args: Extra values attached to the span.
+
+        Yields:
+            Span: The span, whose args may be completed by the block.
+
+        """
+        span = Span(name, category, host, args)
+        try:
+            yield span
+        finally:
+            self.record(span)
+
+    def get_chrome_trace(self):
+        """ Exports the spans in the Chrome trace event format.
+
+        Returns:
+            dict: The trace.
+
+        """
+        with self._lock:
+            spans = sorted(self.spans, key=lambda item: item.start)
+
+        if not spans:
+            return {'traceEvents': []}
+
+        origin = spans[0].start
+        tracks = {}
+        events = []
+        for span in spans:
+            host = str(span.host) if span.host is not None else 'local'
+            if host not in tracks:
+                tracks[host] = len(tracks) + 1
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tracks[host],
+                               'args': {'name': host}})
+
+            events.append({
+                'name': span.name,
+                'cat': span.category,
+                'ph': 'X',
+                'pid': 1,
+                'tid': tracks[host],
+                'ts': int((span.start - origin) * 1e6),
+                'dur': int(span.duration * 1e6),
+                'args': span.args,
+            })
+
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write(self, path):
+        """ Writes the spans to a Chrome trace event file.
+
+        Args:
+            path (string): The file path.
+
+        Raises:
+            IOError: If the file cannot be written.
+
+        """
+        with open(path, 'w') as file_handle:
+            json.dump(self.get_chrome_trace(), file_handle)
+
+
+# The tracer shared by every component of a deploy run
+tracer = Tracer()
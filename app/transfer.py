@@ -0,0 +1,226 @@
+import hashlib
+import json
+import os
+import time
+
+from preflight import Preflight
+
+from server import ServerError
+
+
+class TransferError(Exception):
+    """ Base error class for ChunkedUpload """
+
+    def __init__(self, message, base=None):
+        super(TransferError, self).__init__(message)
+        self.base_exception = base
+
+
+class TransferStats(object):
+    """ What an upload did """
+
+    def __init__(self):
+        self.size = 0
+        self.bytes_sent = 0
+        self.bytes_resumed = 0
+        self.resumes = 0
+        self.duration = 0.0
+
+    @property
+    def throughput(self):
+        """ The bytes sent per second. """
+        return self.bytes_sent / self.duration if self.duration > 0 else 0
+
+
+class ChunkedUpload(object):
+    """ Uploads a file through SFTP in fixed size chunks, resuming from the last good chunk when it fails.
+
+    The file is written next to its destination with a `.partial` suffix, then renamed in place once
+    complete, only if its sha1 matches the local file. Writes are pipelined, so up to `window` chunks are
+    outstanding before waiting for the server to acknowledge them, which keeps a long link busy instead of
+    paying a round trip per write. Every time a window is acknowledged, a `.state` file records the hashes of
+    the chunks written so far, along with a digest of the whole local file.
+
+    When the connection drops, the upload reconnects and resumes from the last recorded chunk, up to
+    `MAX_RESUMES` times. An upload interrupted by a failed deploy resumes on the next one, as long as the
+    local file did not change: the chunks listed by the state file are hashed remotely first, and the upload
+    restarts from the first one that does not match.
+
+    """
+    CHUNK_SIZE = 1024 * 1024
+    WINDOW = 8
+    MAX_RESUMES = 3
+    PARTIAL_SUFFIX = '.partial'
+    STATE_SUFFIX = '.state'
+
+    def __init__(self, server, local_path, remote_path, chunk_size=CHUNK_SIZE, window=WINDOW):
+        self.server = server
+        self.local_path = local_path
+        self.remote_path = remote_path
+        self.chunk_size = chunk_size
+        self.window = window
+        self.chunks = []
+        self.digest = None
+        self.sha1 = None
+
+    @property
+    def partial_path(self):
+        return self.remote_path + ChunkedUpload.PARTIAL_SUFFIX
+
+    @property
+    def state_path(self):
+        return ChunkedUpload.get_state_path(self.remote_path)
+
+    @staticmethod
+    def get_state_path(remote_path):
+        """ Gets the remote file recording the progress of an upload to the given path, while it is incomplete. """
+        return remote_path + ChunkedUpload.PARTIAL_SUFFIX + ChunkedUpload.STATE_SUFFIX
+
+    def _hash_chunks(self):
+        """ Hashes every chunk of the local file, and the whole file. """
+        chunks = []
+        sha1 = hashlib.sha1()
+        with open(self.local_path, 'rb') as file_handle:
+            for chunk in iter(lambda: file_handle.read(self.chunk_size), ''):
+                chunks.append(hashlib.sha1(chunk).hexdigest())
+                sha1.update(chunk)
+
+        self.chunks = chunks
+        self.sha1 = sha1.hexdigest()
+        self.digest = hashlib.sha1('%d\0%s' % (self.chunk_size, ''.join(chunks))).hexdigest()
+
+    def _read_state(self):
+        """ Gets the number of chunks the state file records for the same local file, 0 if there are none. """
+        try:
+            with self.server.sftp.open(self.server.get_sftp_path(self.state_path), 'r') as file_handle:
+                state = json.loads(file_handle.read())
+        except (IOError, ValueError):
+            return 0
+
+        if state.get('digest') != self.digest:
+            return 0
+
+        recorded = state.get('chunks', [])
+        count = 0
+        while count < len(recorded) and count < len(self.chunks) and recorded[count] == self.chunks[count]:
+            count += 1
+        return count
+
+    def get_verify_script(self, count):
+        """ Builds the remote program hashing the first chunks of the partial file. """
+        return '\n'.join([
+            '_i=0',
+            'while [ $_i -lt %d ]; do' % count,
+            '    dd if=%s bs=%d skip=$_i count=1 status=none 2>/dev/null | sha1sum | cut -c1-40'
+            % (Preflight.quote_path(self.partial_path), self.chunk_size),
+            '    _i=$((_i + 1))',
+            'done',
+        ])
+
+    def _verify(self, count):
+        """ Gets the number of leading chunks of the partial file that match the local ones. """
+        status, out, err = self.server.run_script(self.get_verify_script(count), label='verify chunks')
+        verified = 0
+        for remote, local in zip(out.split(), self.chunks[:count]):
+            if remote != local:
+                break
+            verified += 1
+        return verified
+
+    def _write_state(self, count):
+        sftp_path = self.server.get_sftp_path(self.state_path)
+        with self.server.sftp.open(sftp_path + '.tmp', 'w') as file_handle:
+            file_handle.write(json.dumps({'digest': self.digest, 'chunks': self.chunks[:count]}))
+        self.server.sftp.posix_rename(sftp_path + '.tmp', sftp_path)
+
+    def _get_resume_point(self):
+        """ Gets the number of chunks a previous upload of the same file durably wrote, 0 if there was none. """
+        recorded = self._read_state()
+        if not recorded:
+            return 0
+
+        return self._verify(recorded)
+
+    def _send(self, start, stats):
+        """ Sends the chunks from the given one, acknowledging them and recording the state window by window. """
+        sftp = self.server.sftp
+        with open(self.local_path, 'rb') as local_file:
+            local_file.seek(start * self.chunk_size)
+            with sftp.open(self.server.get_sftp_path(self.partial_path), 'r+' if start else 'w') as remote_file:
+                remote_file.set_pipelined(True)
+                if start:
+                    # Drops whatever follows the last good chunk
+                    remote_file.truncate(start * self.chunk_size)
+                    remote_file.seek(start * self.chunk_size)
+
+                for index in range(start, len(self.chunks)):
+                    chunk = local_file.read(self.chunk_size)
+                    remote_file.write(chunk)
+                    stats.bytes_sent += len(chunk)
+
+                    if (index + 1) % self.window == 0 and index + 1 < len(self.chunks):
+                        # The server handles requests in order, so once it answers, the writes are done
+                        if remote_file.stat().st_size < (index + 1) * self.chunk_size:
+                            raise IOError('The server did not write every chunk.')
+                        self._write_state(index + 1)
+
+    def get_finish_script(self):
+        """ Builds the remote program moving the partial file in place, only if its sha1 matches the local file.
+            A partial file that does not match is removed along with its state, so the upload starts over. """
+        partial_path = Preflight.quote_path(self.partial_path)
+        state_path = Preflight.quote_path(self.state_path)
+        return '\n'.join([
+            'if [ "$(sha1sum < %s | cut -c1-40)" != %s ]; then' % (partial_path, self.sha1),
+            '    rm -f %s %s' % (partial_path, state_path),
+            '    echo "The uploaded file does not match the local one." >&2',
+            '    exit 1',
+            'fi',
+            'mv -f %s %s' % (partial_path, Preflight.quote_path(self.remote_path)),
+            'rm -f %s' % state_path,
+        ])
+
+    def _finish(self):
+        status, out, err = self.server.run_script(self.get_finish_script(), label='verify upload')
+        if status != 0:
+            raise IOError(err.strip() or 'Could not move the uploaded file in place.')
+
+    def run(self):
+        """ Uploads the file, resuming an upload of the same file that did not complete.
+
+        Returns:
+            TransferStats: What the upload did.
+
+        Raises:
+            TransferError: If the file could not be read, or if the upload failed more than `MAX_RESUMES` times.
+
+        """
+        # The transport is connected by now, so importing paramiko costs nothing
+        from paramiko import SSHException
+
+        stats = TransferStats()
+        start_time = time.time()
+
+        try:
+            stats.size = os.path.getsize(self.local_path)
+            self._hash_chunks()
+        except (IOError, OSError), e:
+            raise TransferError('Could not read "%s".\n\t> %s' % (self.local_path, e), base=e)
+
+        while True:
+            try:
+                start = self._get_resume_point()
+                if stats.resumes == 0:
+                    stats.bytes_resumed = min(start * self.chunk_size, stats.size)
+
+                self._send(start, stats)
+                self._finish()
+                break
+            except (IOError, EOFError, SSHException, ServerError), e:
+                if stats.resumes >= ChunkedUpload.MAX_RESUMES:
+                    raise TransferError('Could not upload "%s" to "%s" after %d resumes.\n\t> %s'
+                                        % (self.local_path, self.remote_path, stats.resumes, e), base=e)
+                # The transport is reconnected if it dropped, and the state file tells where to resume
+                stats.resumes += 1
+
+        stats.duration = time.time() - start_time
+        return stats
@@ -1,6 +1,7 @@
-import jsonschema
+import json
 import re
 import getpass
+import hashlib
 import os
 import ConfigParser
 import StringIO
@@ -10,35 +11,91 @@ from sys import stdin
 
 from terminal import Terminal
 
+from presets import PRESETS
 
-# TODO(Olivier): remove this function and store the scripts in memory.
-def get_bash_script(script):
-    with open('bash/%s.sh' % script, 'r') as file_handle:
-        script = file_handle.read()
-        return script
+
+BASH_SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bash')
+
+
+def _load_bash_scripts():
+    """ Loads every packaged bash script in memory.
+
+    Returns:
+        dict: The scripts content, keyed by script name.
+
+    """
+    scripts = {}
+
+    for script_file in sorted(os.listdir(BASH_SCRIPTS_DIR)):
+        name, extension = os.path.splitext(script_file)
+        if extension == '.sh':
+            with open(os.path.join(BASH_SCRIPTS_DIR, script_file), 'r') as file_handle:
+                scripts[name] = file_handle.read()
+
+    return scripts
+
+
+BASH_SCRIPTS = _load_bash_scripts()
+
+# Every script only defines functions, so they are shipped to the servers as a single helpers file
+# whose remote location is versioned by its content hash.
+BASH_HELPERS = '\n'.join(BASH_SCRIPTS[name].rstrip('\n') for name in sorted(BASH_SCRIPTS)) + '\n'
+BASH_HELPERS_HASH = hashlib.sha1(BASH_HELPERS).hexdigest()[:16]
+
+
+BLUE_GREEN_SLOTS = ['blue', 'green']
+
+
+def get_program_names(config):
+    """ Gets the supervisor programs of the project, one per slot in blue/green mode.
+
+    Args:
+        config (dict): The config.
+
+    Returns:
+        list: The program names (Strings).
+
+    """
+    project = config['project']['name'].lower()
+    if config.get('restart', {}).get('strategy') == 'blue_green':
+        return ['%s-%s' % (project, slot) for slot in BLUE_GREEN_SLOTS]
+    return [project]
 
 
 def get_supervisor_config(config, preset):
     user = config['server']['user']
     project = config['project']['name']
+    port = config.get('restart', {}).get('port')
     supervisor_config = ConfigParser.RawConfigParser()
-    section = 'program:%s' % project.lower()
-
-    supervisor_config.add_section(section)
-    supervisor_config.set(section, 'command', preset.get_run_cmd())
-    supervisor_config.set(section, 'autostart', 'true')
-    supervisor_config.set(section, 'autorestart', 'true')
-    supervisor_config.set(section, 'startretries', '10')
-    supervisor_config.set(section, 'user', user)
-    supervisor_config.set(section, 'directory', '/home/%s/.deploy/%s' % (user, project))
-    supervisor_config.set(section, 'redirect_stderr', 'true')
-    supervisor_config.set(section, 'stdout_logfile', '/var/log/supervisor/%s.log' % project)
-    supervisor_config.set(section, 'stdout_logfile_maxbytes', '50MB')
-    supervisor_config.set(section, 'stdout_logfile_backups', '10')
-
-    env = preset.get_environment_vars()
-    if env != '':
-        supervisor_config.set(section, 'environment', env)
+
+    # In blue/green mode, every slot runs the release its symlink points at, on its own port
+    if config.get('restart', {}).get('strategy') == 'blue_green':
+        programs = [('%s-%s' % (project, slot), slot, port + offset if port else None)
+                    for offset, slot in enumerate(BLUE_GREEN_SLOTS)]
+    else:
+        programs = [(project, 'current', port)]
+
+    for program, directory, program_port in programs:
+        section = 'program:%s' % program.lower()
+
+        supervisor_config.add_section(section)
+        supervisor_config.set(section, 'command', preset.get_run_cmd())
+        supervisor_config.set(section, 'autostart', 'true')
+        supervisor_config.set(section, 'autorestart', 'true')
+        supervisor_config.set(section, 'startretries', '10')
+        supervisor_config.set(section, 'user', user)
+        supervisor_config.set(section, 'directory', '/home/%s/.deploy/%s/%s' % (user, project, directory))
+        supervisor_config.set(section, 'redirect_stderr', 'true')
+        supervisor_config.set(section, 'stdout_logfile', '/var/log/supervisor/%s.log' % program)
+        supervisor_config.set(section, 'stdout_logfile_maxbytes', '50MB')
+        supervisor_config.set(section, 'stdout_logfile_backups', '10')
+
+        env = [preset.get_environment_vars()]
+        if program_port:
+            env.append('PORT=%d' % program_port)
+        env = ','.join(var for var in env if var != '')
+        if env != '':
+            supervisor_config.set(section, 'environment', env)
 
     output = StringIO.StringIO()
     supervisor_config.write(output)
@@ -47,28 +104,28 @@ def get_supervisor_config(config, preset):
 
 
 def load_preset(preset):
-    language = preset.split(':')[0]
-    subset = preset.split(':')[1]
-    preset_class = '%s%sPreset' % (language.capitalize(), subset.capitalize())
-    py_module = import_module('.presets.%s.%s' % (language, subset), __package__)
+    """ Imports the class of a preset, from the preset registry.
+
+    Args:
+        preset (string): The preset name, e.g. "java:gradle".
+
+    Returns:
+        class: The preset class, or None if it is not installed.
+
+    """
+    if preset not in PRESETS:
+        return None
+
+    module, preset_class = PRESETS[preset]
+    py_module = import_module('.presets.%s' % module, __package__)
 
     if hasattr(py_module, preset_class):
         return getattr(py_module, preset_class)
 
 
 def get_installed_presets():
-    presets_path = 'app/presets'
-    presets = []
-
-    for language in os.listdir(presets_path):
-        if os.path.isdir('%s/%s' % (presets_path, language)):
-            for subset_file in os.listdir('%s/%s' % (presets_path, language)):
-                if os.path.isfile('%s/%s/%s' % (presets_path, language, subset_file)):
-                    subset = os.path.splitext(subset_file)[0]
-                    if not subset.startswith('_'):
-                        presets.append('%s:%s' % (language, subset))
-
-    return presets
+    """ Lists the installed presets, without importing them. """
+    return sorted(PRESETS)
 
 
 def valid_config(config_json):
@@ -81,6 +138,52 @@ def valid_config(config_json):
         bool: whether the config is valid
 
     """
+    # jsonschema is slow to import, and only needed by the commands reading the config
+    import jsonschema
+
+    # Scripts are either a bare remote command, or an object
+    script_schema = {
+        "anyOf": [
+            {
+                "type": "string"
+            },
+            {
+                "type": "object",
+                "properties": {
+                    "name": {
+                        "type": "string"
+                    },
+                    "command": {
+                        "type": "string"
+                    },
+                    "target": {
+                        "enum": ["local", "remote"]
+                    },
+                    "depends_on": {
+                        "type": "array",
+                        "items": {
+                            "type": "string"
+                        }
+                    },
+                    "timeout": {
+                        "type": "number",
+                        "minimum": 0,
+                        "exclusiveMinimum": True
+                    },
+                    "inputs": {
+                        "type": "array",
+                        "items": {
+                            "type": "string"
+                        }
+                    }
+                },
+                "required": [
+                    "command"
+                ]
+            }
+        ]
+    }
+
     schema = {
         "$schema": "http://json-schema.org/draft-04/schema#",
         "id": "/",
@@ -96,6 +199,117 @@ def valid_config(config_json):
                     "user": {
                         "id": "user",
                         "type": "string"
+                    },
+                    "port": {
+                        "id": "port",
+                        "type": "integer",
+                        "minimum": 1,
+                        "maximum": 65535
+                    },
+                    "agent": {
+                        "id": "agent",
+                        "type": "boolean"
+                    }
+                }
+            },
+            "servers": {
+                "id": "servers",
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "address": {
+                            "type": "string"
+                        },
+                        "user": {
+                            "type": "string"
+                        },
+                        "port": {
+                            "type": "integer",
+                            "minimum": 1,
+                            "maximum": 65535
+                        },
+                        "agent": {
+                            "type": "boolean"
+                        },
+                        "groups": {
+                            "type": "array",
+                            "items": {
+                                "type": "string"
+                            }
+                        }
+                    },
+                    "required": [
+                        "address",
+                        "user"
+                    ]
+                }
+            },
+            "groups": {
+                "id": "groups",
+                "type": "object",
+                "additionalProperties": {
+                    "type": "array",
+                    "items": {
+                        "type": "string"
+                    }
+                }
+            },
+            "rollout": {
+                "id": "rollout",
+                "type": "object",
+                "properties": {
+                    "parallel": {
+                        "type": "integer",
+                        "minimum": 1
+                    },
+                    "batch": {
+                        "type": "integer",
+                        "minimum": 1
+                    },
+                    "max_failure_ratio": {
+                        "type": "number",
+                        "minimum": 0,
+                        "maximum": 1
+                    }
+                }
+            },
+            "restart": {
+                "id": "restart",
+                "type": "object",
+                "properties": {
+                    "strategy": {
+                        "enum": ["restart", "blue_green"]
+                    },
+                    "port": {
+                        "type": "integer",
+                        "minimum": 1,
+                        "maximum": 65534
+                    },
+                    "health_check": {
+                        "type": "object",
+                        "properties": {
+                            "type": {
+                                "enum": ["tcp", "http", "command"]
+                            },
+                            "path": {
+                                "type": "string"
+                            },
+                            "command": {
+                                "type": "string"
+                            },
+                            "timeout": {
+                                "type": "number",
+                                "minimum": 0
+                            },
+                            "interval": {
+                                "type": "number",
+                                "minimum": 0
+                            }
+                        },
+                        "required": [
+                            "type"
+                        ]
                     }
                 }
             },
@@ -111,6 +325,20 @@ def valid_config(config_json):
                         "id": "preset",
                         "type": "string"
                     },
+                    "build_mode": {
+                        "id": "build_mode",
+                        "enum": ["remote", "local"]
+                    },
+                    "history_depth": {
+                        "id": "history_depth",
+                        "type": "integer",
+                        "minimum": 1
+                    },
+                    "keep_releases": {
+                        "id": "keep_releases",
+                        "type": "integer",
+                        "minimum": 1
+                    },
                     "directories": {
                         "id": "directories",
                         "type": "object",
@@ -134,32 +362,70 @@ def valid_config(config_json):
                     "before": {
                         "id": "before",
                         "type": "array",
-                        "items": {}
+                        "items": script_schema
                     },
                     "after": {
                         "id": "after",
                         "type": "array",
-                        "items": {}
+                        "items": script_schema
                     }
                 }
             }
         },
         "required": [
-            "server",
             "project",
             "scripts"
+        ],
+        "anyOf": [
+            {"required": ["server"]},
+            {"required": ["servers"]}
         ]
     }
     validator = jsonschema.Draft4Validator(schema=schema,
                                            types={"object": dict})
 
-    for error in sorted(validator.iter_errors(config_json.replace('\n', ' ')), key=str):
+    for error in sorted(validator.iter_errors(json.loads(config_json)), key=str):
         Terminal.print_error(error.message)
         return False
 
     return True
 
 
+def format_bytes(size):
+    """ Formats a number of bytes for humans.
+
+    Args:
+        size (int): The number of bytes.
+
+    Returns:
+        string: The formatted size, e.g. "1.5 MB".
+
+    """
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(size) < 1024 or unit == 'GB':
+            return ('%d %s' if unit == 'B' else '%.1f %s') % (size, unit)
+        size /= 1024.0
+
+
+def format_uptime(seconds):
+    """ Formats a duration for humans, with its two largest units.
+
+    Args:
+        seconds (int): The duration, in seconds.
+
+    Returns:
+        string: The formatted duration, e.g. "3d 4h" or "12m 5s".
+
+    """
+    seconds = int(seconds)
+    units = [('d', 24 * 60 * 60), ('h', 60 * 60), ('m', 60), ('s', 1)]
+    for index, (unit, size) in enumerate(units[:-1]):
+        if seconds >= size:
+            next_unit, next_size = units[index + 1]
+            return '%d%s %d%s' % (seconds // size, unit, seconds % size // next_size, next_unit)
+    return '%ds' % seconds
+
+
 def valid_address(address):
     """Validate whether an address is a valid hostname or IP address.
     
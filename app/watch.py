@@ -0,0 +1,294 @@
+import hashlib
+import os
+import pipes
+import stat
+import time
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+from preflight import Preflight
+from release import Release
+
+from server import ServerError
+
+
+class WatchError(Exception):
+    """ Base error class for the watch mode """
+
+    def __init__(self, message, base=None):
+        super(WatchError, self).__init__(message)
+        self.base_exception = base
+
+
+class PatchStats(object):
+    """ What applying a batch of changes did """
+
+    def __init__(self):
+        self.changed = 0
+        self.removed = 0
+        self.bytes_sent = 0
+        self.switched = False
+
+
+def _snapshot(directories):
+    """ Gets the size, modification time and mode of every file of the directories, keyed by path. """
+    files = {}
+    for directory in directories:
+        for root, dirs, names in os.walk(directory):
+            dirs[:] = [name for name in dirs if name != '.git']
+            for name in names:
+                path = os.path.normpath(os.path.join(root, name))
+                try:
+                    file_stat = os.lstat(path)
+                except OSError:
+                    continue
+                if stat.S_ISREG(file_stat.st_mode):
+                    files[path] = (file_stat.st_size, file_stat.st_mtime, file_stat.st_mode)
+    return files
+
+
+class PollingWatcher(object):
+    """ Finds the files that changed by comparing snapshots of the directories """
+    INTERVAL = 0.2
+
+    def __init__(self, directories):
+        self.directories = directories
+        self.files = _snapshot(directories)
+
+    def wait(self, timeout):
+        """ Waits for changes, at most `timeout` seconds, or forever if None.
+
+        Returns:
+            set: The paths that changed, empty if none did in time.
+
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            time.sleep(PollingWatcher.INTERVAL if timeout is None else min(PollingWatcher.INTERVAL, timeout))
+            files = _snapshot(self.directories)
+            changed = set(path for path in set(files) | set(self.files) if files.get(path) != self.files.get(path))
+            self.files = files
+            if changed or (deadline is not None and time.time() >= deadline):
+                return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """ Gets the files that changed from inotify, as they change """
+
+    def __init__(self, directories):
+        self.changed = set()
+        self.manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.manager, self._add)
+        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM | pyinotify.IN_DELETE \
+            | pyinotify.IN_CREATE | pyinotify.IN_ATTRIB
+        for directory in directories:
+            self.manager.add_watch(directory, mask, rec=True, auto_add=True,
+                                   exclude_filter=lambda path: os.path.basename(path) == '.git')
+
+    def _add(self, event):
+        if not event.dir:
+            self.changed.add(os.path.normpath(os.path.relpath(event.pathname)))
+
+    def wait(self, timeout):
+        """ Waits for changes, at most `timeout` seconds, or forever if None.
+
+        Returns:
+            set: The paths that changed, empty if none did in time.
+
+        """
+        if self.notifier.check_events(None if timeout is None else int(timeout * 1000)):
+            self.notifier.read_events()
+            self.notifier.process_events()
+
+        changed, self.changed = self.changed, set()
+        return changed
+
+    def close(self):
+        self.notifier.stop()
+
+
+class FileWatcher(object):
+    """ Watches directories for changed files, with inotify when the `pyinotify` module is installed, and by
+        polling them otherwise.
+
+    Changes come in bursts, such as an editor writing a file and its backup, or a build writing its outputs,
+    so they are only reported once no file changed for `DEBOUNCE` seconds, or at the latest `MAX_DELAY`
+    seconds after the first one.
+
+    """
+    DEBOUNCE = 0.1
+    MAX_DELAY = 1.0
+
+    def __init__(self, directories, ignore=None):
+        self.directories = directories
+        self.ignore = ignore
+        self.backend = 'inotify' if pyinotify is not None else 'polling'
+        self.watcher = InotifyWatcher(directories) if pyinotify is not None else PollingWatcher(directories)
+
+    def next_changes(self):
+        """ Waits for the next burst of changes.
+
+        Returns:
+            tuple: The changed files and the removed files, relative to the project root (Strings).
+
+        """
+        while True:
+            paths = self.watcher.wait(None)
+            deadline = time.time() + FileWatcher.MAX_DELAY
+            while paths:
+                more = self.watcher.wait(min(FileWatcher.DEBOUNCE, max(0, deadline - time.time())))
+                if not more or time.time() >= deadline:
+                    paths |= more
+                    break
+                paths |= more
+
+            if self.ignore is not None and paths:
+                paths -= self.ignore(sorted(paths))
+
+            changed = sorted(path for path in paths if os.path.isfile(path))
+            removed = sorted(path for path in paths if not os.path.lexists(path))
+            if changed or removed:
+                return changed, removed
+
+    def close(self):
+        self.watcher.close()
+
+
+class WatchSession(object):
+    """ Applies local changes to the release a server runs, without a commit nor a full deploy.
+
+    The first batch of changes derives a watch release from the current one, out of hardlinks, and makes it
+    current; the following batches patch it in place. Changed files are uploaded next to the object store,
+    then stored and linked into the release by a single remote program, each file being replaced atomically.
+    The fingerprint of the last deploy is removed, so the next `deploy now` ships the committed state again.
+
+    """
+    RELEASE_SUFFIX = Release.WATCH_SUFFIX
+    UPLOAD_SUFFIX = '.upload'
+
+    def __init__(self, server, app_directory, build_directory=None, links=()):
+        self.server = server
+        self.app_directory = app_directory.rstrip('/')
+        self.build_directory = os.path.normpath(build_directory).strip('/') if build_directory else None
+        self.links = list(links)
+        self.shipped = {}
+
+    def _is_build_file(self, path):
+        return self.build_directory is not None and (path + '/').startswith(self.build_directory + '/')
+
+    def get_key(self, path):
+        """ Gets the object key of a local file, the same a deploy of the file would give it. """
+        with open(path, 'rb') as file_handle:
+            data = file_handle.read()
+
+        # Build files are stored by sha1, tracked files by their git blob hash
+        if self._is_build_file(path):
+            digest = hashlib.sha1(data).hexdigest()
+        else:
+            digest = hashlib.sha1('blob %d\0%s' % (len(data), data)).hexdigest()
+        executable = bool(os.stat(path).st_mode & (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH))
+        return Release.get_object_key(digest, executable), len(data)
+
+    def _upload_path(self, key):
+        return '%s/%s/%s%s' % (self.app_directory, Release.OBJECTS_DIR, key, WatchSession.UPLOAD_SUFFIX)
+
+    def get_script(self, files, uploads, removed, fingerprint_path):
+        """ Builds the remote program applying the changes to the watch release, deriving it first if needed. """
+        objects = Release.OBJECTS_DIR
+        lines = [
+            'set -e -o pipefail',
+            'cd %s' % Preflight.quote_path(self.app_directory),
+        ]
+        lines.extend(Release.get_store_function())
+        lines.extend([
+            '_base=$(readlink %s)' % Release.CURRENT_LINK,
+            'case "$_base" in *%s) _rel=$_base ;; *) _rel=$_base%s ;; esac' % (WatchSession.RELEASE_SUFFIX,
+                                                                             WatchSession.RELEASE_SUFFIX),
+            'if [ "$_rel" != "$_base" ]; then',
+            '    rm -rf "$_rel.tmp.$$" && cp -al "$_base" "$_rel.tmp.$$"',
+            '    rm -rf "$_rel" && mv "$_rel.tmp.$$" "$_rel"',
+            '    echo switched',
+            'fi',
+        ])
+
+        for key in sorted(uploads):
+            upload = pipes.quote('%s/%s%s' % (objects, key, WatchSession.UPLOAD_SUFFIX))
+            lines.append('_store %s %s && rm -f %s' % (key, upload, upload))
+
+        directories = sorted(set(os.path.dirname(path) for path in files if os.path.dirname(path)))
+        if directories:
+            lines.append('mkdir -p %s' % ' '.join('"$_rel"/%s' % pipes.quote(directory)
+                                                  for directory in directories))
+        for path, key in sorted(files.items()):
+            lines.append('ln -f %s/%s "$_rel"/%s.tmp.$$ && mv -f "$_rel"/%s.tmp.$$ "$_rel"/%s'
+                         % (objects, key, pipes.quote(path), pipes.quote(path), pipes.quote(path)))
+        for path in sorted(removed):
+            lines.append('rm -f "$_rel"/%s' % pipes.quote(path))
+
+        lines.append('rm -f %s' % Preflight.quote_path(fingerprint_path))
+        lines.extend(Release.get_switch_lines('"$_rel"', self.links))
+
+        return '\n'.join(lines)
+
+    def _upload(self, path, key):
+        sftp = self.server.sftp
+        with open(path, 'rb') as local_file:
+            with sftp.open(self.server.get_sftp_path(self._upload_path(key)), 'w') as remote_file:
+                remote_file.set_pipelined(True)
+                for chunk in iter(lambda: local_file.read(32768), ''):
+                    remote_file.write(chunk)
+
+    def apply(self, changed, removed, fingerprint_path):
+        """ Applies a batch of changes to the watch release of the server.
+
+        Args:
+            changed (list): The changed files, relative to the project root (Strings).
+            removed (list): The removed files, relative to the project root (Strings).
+            fingerprint_path (string): The remote file recording what the last deploy shipped.
+
+        Returns:
+            PatchStats: What applying the changes did.
+
+        Raises:
+            WatchError: If the changes could not be applied.
+
+        """
+        stats = PatchStats()
+        files = {}
+        uploads = set()
+
+        try:
+            for path in changed:
+                key, size = self.get_key(path)
+                if self.shipped.get(path) == key:
+                    continue
+                files[path] = key
+                if key not in uploads:
+                    self._upload(path, key)
+                    uploads.add(key)
+                    stats.bytes_sent += size
+
+            removed = [path for path in removed if self.shipped.get(path, True) is not None]
+            if not files and not removed:
+                return stats
+
+            status, out, err = self.server.run_script(self.get_script(files, uploads, removed, fingerprint_path),
+                                                      label='apply changes')
+        except (IOError, OSError, ServerError), e:
+            raise WatchError('Could not apply the changes.\n\t> %s' % e, base=e)
+
+        if status != 0:
+            raise WatchError('Could not apply the changes.\n\t> %s' % err.rstrip())
+
+        self.shipped.update(files)
+        self.shipped.update((path, None) for path in removed)
+        stats.changed = len(files)
+        stats.removed = len(removed)
+        stats.switched = 'switched' in out.split()
+        return stats
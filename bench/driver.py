@@ -0,0 +1,21 @@
+""" Runs a deploy command against the benchmark stand-in.
+
+Usage: driver.py <supervisor config dir> <supervisord socket> <deploy arguments>...
+
+The stand-in runs commands as the local user, so the supervisor include directory and the supervisord
+socket are redirected to ones it can access. Everything else runs unmodified.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import server, supervisor_rpc
+
+server.Server.SUPERVISOR_CONFIG_DIRS = [sys.argv[1]]
+supervisor_rpc.SupervisorClient.SOCKET_PATHS = [sys.argv[2]]
+
+from app import main
+
+sys.argv = ['deploy'] + sys.argv[3:]
+main.run()
@@ -0,0 +1,239 @@
+""" Benchmarks deploy runs end to end against a local SSH stand-in.
+
+Every scenario runs the real `deploy` command in a subprocess, against a paramiko SSH server listening on
+localhost, with fake sudo and package manager tools, and a fake supervisord. The stand-in counts the
+handshakes, round trips and bytes it serves, and can inject latency and throttle the bandwidth.
+
+Usage:
+    python bench/run.py [--rtt SECONDS] [--bandwidth BYTES_PER_SECOND] [--save | --check] [--keep]
+
+--save records the results as the baseline, --check fails if a scenario needs more handshakes or round
+trips than the baseline, or noticeably more bytes.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import paramiko
+
+from standin import StandIn, FakeSupervisord
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+
+# Counters that must never grow, and the tolerance on the bytes, which depend on timestamps and paths
+STRICT_COUNTERS = ['handshakes', 'round_trips', 'execs']
+BYTES_TOLERANCE = 0.1
+BYTES_SLACK = 8 * 1024
+
+BUILD_SIZE = 3 * 1024 * 1024
+BLOCK_SIZE = 128 * 1024
+
+
+class Bench(object):
+    """ Prepares a local project and a stand-in server, then runs the deploy scenarios against them """
+
+    def __init__(self, root_dir, rtt=0.0, bandwidth=0):
+        self.root_dir = root_dir
+        self.project_dir = os.path.join(root_dir, 'project')
+        self.local_home = os.path.join(root_dir, 'local-home')
+        self.supervisor_dir = os.path.join(root_dir, 'remote', 'etc', 'supervisor', 'conf.d')
+        self.supervisor_socket = os.path.join(root_dir, 'remote', 'supervisor.sock')
+        self.standin = StandIn(os.path.join(root_dir, 'remote'), os.path.join(BENCH_DIR, 'fakebin'), rtt, bandwidth)
+        self.supervisord = None
+        self.env = None
+
+    def setup(self):
+        os.makedirs(self.supervisor_dir)
+        os.makedirs(os.path.join(self.local_home, '.ssh'))
+        key_path = os.path.join(self.local_home, '.ssh', 'id_rsa')
+        paramiko.RSAKey.generate(2048).write_private_key_file(key_path)
+
+        self.env = dict(os.environ)
+        self.env.update({
+            'HOME': self.local_home,
+            'XDG_CACHE_HOME': os.path.join(self.local_home, '.cache'),
+            'GIT_SSH_COMMAND': 'ssh -F /dev/null -i %s -o BatchMode=yes -o StrictHostKeyChecking=no '
+                               '-o UserKnownHostsFile=/dev/null -o LogLevel=ERROR' % key_path,
+            'GIT_AUTHOR_NAME': 'bench', 'GIT_AUTHOR_EMAIL': 'bench@localhost',
+            'GIT_COMMITTER_NAME': 'bench', 'GIT_COMMITTER_EMAIL': 'bench@localhost',
+        })
+
+        os.makedirs(os.path.join(self.project_dir, 'src'))
+        self._write('src/Main.java', 'class Main { public static void main(String[] args) {} }\n')
+        self._write('run.sh', '#!/bin/bash\nexec java -jar build/app.jar\n')
+        self._write('.gitignore', 'build/\n')
+
+        rng = random.Random(0)
+        self._write('build/app.jar', ''.join(chr(rng.getrandbits(8)) for _ in xrange(BUILD_SIZE)))
+        self._write('build/lib/config.properties', 'port=8080\n')
+
+        self._git('init', '-q')
+        self._git('add', '-A')
+        self._git('commit', '-q', '-m', 'Initial commit')
+        self._git('branch', '-M', 'master')
+
+        self.standin.start()
+        self.supervisord = FakeSupervisord(self.supervisor_socket, self.supervisor_dir)
+        self.supervisord.start()
+
+    def _write(self, rel_path, content):
+        path = os.path.join(self.project_dir, rel_path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as file_handle:
+            file_handle.write(content)
+
+    def _git(self, *args):
+        subprocess.check_call(['git'] + list(args), cwd=self.project_dir, env=self.env)
+
+    def _deploy(self, name, args, stdin=''):
+        trace_path = os.path.join(self.root_dir, 'trace-%s.json' % name)
+        command = [sys.executable, os.path.join(BENCH_DIR, 'driver.py'), self.supervisor_dir,
+                   self.supervisor_socket] + args + \
+                  ['--trace', trace_path]
+
+        self.standin.stats.reset()
+        start = time.time()
+        process = subprocess.Popen(command, cwd=self.project_dir, env=self.env,
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate(stdin)[0]
+        wall_time = time.time() - start
+
+        if process.returncode != 0 or '[ERROR]' in output:
+            raise RuntimeError('Scenario "%s" failed:\n%s' % (name, output))
+
+        result = self.standin.stats.snapshot()
+        result['wall_time'] = wall_time
+        result['phases'] = {}
+        if os.path.exists(trace_path):
+            with open(trace_path) as file_handle:
+                for event in json.load(file_handle)['traceEvents']:
+                    if event.get('cat') == 'phase' and event['name'] != 'Deploy':
+                        result['phases'][event['name']] = result['phases'].get(event['name'], 0) + event['dur'] / 1e6
+
+        return result
+
+    def run(self):
+        """ Runs every scenario, in order, as each one depends on the state left by the previous one.
+
+        Returns:
+            list: The (scenario name, result) tuples.
+
+        """
+        results = []
+
+        answers = '\n'.join(['bench', 'java:gradle', '', 'build', '127.0.0.1', str(self.standin.port), 'root'])
+        results.append(('init', self._deploy('init', ['init'], answers + '\n')))
+        self._git('add', '.deploy')
+        self._git('commit', '-q', '-m', 'Add deploy config')
+
+        results.append(('cold', self._deploy('cold', ['now'])))
+        results.append(('warm', self._deploy('warm', ['now'])))
+
+        self._write('src/Main.java', 'class Main { public static void main(String[] args) { run(); } }\n')
+        self._git('commit', '-q', '-a', '-m', 'Change the sources')
+        with open(os.path.join(self.project_dir, 'build', 'app.jar'), 'r+b') as file_handle:
+            file_handle.seek(BLOCK_SIZE * 5)
+            file_handle.write('changed')
+        results.append(('incremental', self._deploy('incremental', ['now'])))
+
+        results.append(('forced', self._deploy('forced', ['now', '--force'])))
+
+        return results
+
+    def close(self):
+        self.standin.stop()
+        if self.supervisord is not None:
+            self.supervisord.stop()
+
+
+def print_results(results):
+    print '%-12s %10s %11s %6s %8s %10s %10s %9s' % (
+        'scenario', 'handshakes', 'round trips', 'execs', 'sftp ops', 'KB in', 'KB out', 'wall (s)')
+    for name, result in results:
+        print '%-12s %10d %11d %6d %8d %10.1f %10.1f %9.2f' % (
+            name, result['handshakes'], result['round_trips'], result['execs'], result['sftp_ops'],
+            result['bytes_in'] / 1024.0, result['bytes_out'] / 1024.0, result['wall_time'])
+
+    print
+    for name, result in results:
+        phases = sorted(result['phases'].items(), key=lambda item: -item[1])
+        print '%-12s %s' % (name, ', '.join('%s %.2fs' % phase for phase in phases) or '-')
+
+
+def check_results(results, baseline):
+    """ Compares the results with the baseline.
+
+    Returns:
+        list: The regressions (Strings).
+
+    """
+    regressions = []
+
+    for name, result in results:
+        expected = baseline['scenarios'].get(name)
+        if expected is None:
+            continue
+
+        for counter in STRICT_COUNTERS:
+            if result[counter] > expected[counter]:
+                regressions.append('%s: %s went from %d to %d' % (name, counter, expected[counter], result[counter]))
+
+        for counter in ('bytes_in', 'bytes_out'):
+            if result[counter] > expected[counter] * (1 + BYTES_TOLERANCE) + BYTES_SLACK:
+                regressions.append('%s: %s went from %d to %d' % (name, counter, expected[counter], result[counter]))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks deploy runs against a local SSH stand-in.')
+    parser.add_argument('--rtt', type=float, default=0.0, help='Latency added to every round trip, in seconds.')
+    parser.add_argument('--bandwidth', type=int, default=0, help='Bandwidth limit, in bytes per second.')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='The baseline file.')
+    parser.add_argument('--save', action='store_true', help='Save the results as the baseline.')
+    parser.add_argument('--check', action='store_true', help='Fail if the results regressed from the baseline.')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary directory.')
+    args = parser.parse_args()
+
+    root_dir = tempfile.mkdtemp(prefix='deploy-bench-')
+    bench = Bench(root_dir, args.rtt, args.bandwidth)
+    try:
+        bench.setup()
+        results = bench.run()
+    finally:
+        bench.close()
+        if args.keep:
+            print 'Kept "%s".' % root_dir
+        else:
+            shutil.rmtree(root_dir, ignore_errors=True)
+
+    print_results(results)
+
+    if args.save:
+        scenarios = {}
+        for name, result in results:
+            scenarios[name] = dict((key, value) for key, value in result.items() if key != 'commands')
+        with open(args.baseline, 'w') as file_handle:
+            json.dump({'rtt': args.rtt, 'bandwidth': args.bandwidth, 'scenarios': scenarios}, file_handle,
+                      sort_keys=True, indent=4, separators=(',', ': '))
+        print '\nSaved baseline to "%s".' % args.baseline
+
+    if args.check:
+        with open(args.baseline) as file_handle:
+            regressions = check_results(results, json.load(file_handle))
+        if regressions:
+            print '\nRegressions:\n\t%s' % '\n\t'.join(regressions)
+            sys.exit(1)
+        print '\nNo regression.'
+
+
+if __name__ == '__main__':
+    main()
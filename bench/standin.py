@@ -0,0 +1,571 @@
+import ConfigParser
+import glob
+import os
+import socket
+import SocketServer
+import subprocess
+import threading
+import time
+import xmlrpclib
+
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+
+import paramiko
+from paramiko import SFTPServerInterface, SFTPServer, SFTPAttributes, SFTPHandle, SFTP_OK, ServerInterface, \
+    AUTH_SUCCESSFUL, OPEN_SUCCEEDED
+
+
+class Stats(object):
+    """ What the clients of the stand-in cost it """
+    COUNTERS = ['handshakes', 'execs', 'sftp_ops', 'sftp_io', 'bytes_in', 'bytes_out']
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            for counter in Stats.COUNTERS:
+                setattr(self, counter, 0)
+            self.commands = []
+
+    def add(self, counter, value=1):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + value)
+
+    def add_command(self, command):
+        with self._lock:
+            self.commands.append(command)
+
+    def snapshot(self):
+        """ Gets the counters, along with the round trips: every exec and SFTP request waits for an answer,
+            except the pipelined SFTP reads and writes. """
+        with self._lock:
+            values = dict((counter, getattr(self, counter)) for counter in Stats.COUNTERS)
+            values['round_trips'] = values['execs'] + values['sftp_ops']
+            values['commands'] = list(self.commands)
+            return values
+
+
+class Shim(object):
+    """ Injects latency on every round trip, and throttles the bandwidth of every connection """
+
+    def __init__(self, rtt=0.0, bandwidth=0):
+        self.rtt = rtt
+        self.bandwidth = bandwidth
+
+    def round_trip(self, count=1):
+        if self.rtt:
+            time.sleep(self.rtt * count)
+
+    def transfer(self, size):
+        if self.bandwidth:
+            time.sleep(float(size) / self.bandwidth)
+
+
+class MeteredSocket(object):
+    """ Counts, and throttles, the bytes going through a connection socket """
+
+    def __init__(self, sock, stats, shim):
+        self._sock = sock
+        self._stats = stats
+        self._shim = shim
+
+    def recv(self, size):
+        data = self._sock.recv(size)
+        self._stats.add('bytes_in', len(data))
+        self._shim.transfer(len(data))
+        return data
+
+    def send(self, data):
+        sent = self._sock.send(data)
+        self._stats.add('bytes_out', sent)
+        self._shim.transfer(sent)
+        return sent
+
+    def sendall(self, data):
+        while data:
+            data = data[self.send(data):]
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+def set_file_attr(filename, attr):
+    """ Applies SFTP attributes, without truncating the file like SFTPServer.set_file_attr does """
+    if attr._flags & attr.FLAG_PERMISSIONS:
+        os.chmod(filename, attr.st_mode)
+    if attr._flags & attr.FLAG_AMTIME:
+        os.utime(filename, (attr.st_atime, attr.st_mtime))
+    if attr._flags & attr.FLAG_SIZE:
+        with open(filename, 'r+') as file_handle:
+            file_handle.truncate(attr.st_size)
+
+
+class Handle(SFTPHandle):
+    def __init__(self, flags, stats):
+        super(Handle, self).__init__(flags)
+        self.stats = stats
+
+    def read(self, offset, length):
+        self.stats.add('sftp_io')
+        return super(Handle, self).read(offset, length)
+
+    def write(self, offset, data):
+        self.stats.add('sftp_io')
+        return super(Handle, self).write(offset, data)
+
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError, e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        try:
+            set_file_attr(self.filename, attr)
+            return SFTP_OK
+        except OSError, e:
+            return SFTPServer.convert_errno(e.errno)
+
+
+class Sftp(SFTPServerInterface):
+    """ An SFTP server rooted at the stand-in home directory """
+
+    def __init__(self, server, *args, **kwargs):
+        super(Sftp, self).__init__(server, *args, **kwargs)
+        self.standin = server.standin
+
+    def _path(self, path):
+        self.standin.stats.add('sftp_ops')
+        self.standin.shim.round_trip()
+        if not path.startswith('/'):
+            path = os.path.join(self.standin.home, path)
+        return path
+
+    def list_folder(self, path):
+        path = self._path(path)
+        try:
+            attributes = []
+            for name in os.listdir(path):
+                attr = SFTPAttributes.from_stat(os.lstat(os.path.join(path, name)))
+                attr.filename = name
+                attributes.append(attr)
+            return attributes
+        except OSError, e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError, e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.lstat(self._path(path)))
+        except OSError, e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        path = self._path(path)
+        try:
+            mode = getattr(attr, 'st_mode', None) or 0666
+            fd = os.open(path, flags, mode)
+        except OSError, e:
+            return SFTPServer.convert_errno(e.errno)
+
+        if flags & os.O_WRONLY:
+            file_mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            file_mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            file_mode = 'rb'
+
+        handle = Handle(flags, self.standin.stats)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, file_mode)
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(self._path(path))
+        except OSError, e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(self._path(oldpath), self._path(newpath))
+        except OSError, e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    posix_rename = rename
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self._path(path))
+        except OSError, e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(self._path(path))
+        except OSError, e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def chattr(self, path, attr):
+        try:
+            set_file_attr(self._path(path), attr)
+        except OSError, e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def symlink(self, target_path, path):
+        try:
+            os.symlink(target_path, self._path(path))
+        except OSError, e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def readlink(self, path):
+        try:
+            return os.readlink(self._path(path))
+        except OSError, e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def canonicalize(self, path):
+        if not path.startswith('/'):
+            path = os.path.join(self.standin.home, path)
+        return os.path.normpath(path)
+
+
+class Interface(ServerInterface):
+    """ Accepts any user and key, and runs the commands in the stand-in home directory """
+
+    def __init__(self, standin):
+        self.standin = standin
+        self.user = None
+        self.forwards = {}
+
+    def get_allowed_auths(self, username):
+        return 'publickey,password,none'
+
+    def check_auth_none(self, username):
+        self.user = username
+        return AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        self.user = username
+        return AUTH_SUCCESSFUL
+
+    def check_auth_password(self, username, password):
+        self.user = username
+        return AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return OPEN_SUCCEEDED
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        self.forwards[chanid] = destination
+        return OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        self.standin.stats.add('execs')
+        self.standin.stats.add_command(command)
+
+        thread = threading.Thread(target=self.standin.run_command, args=(channel, command, self.user))
+        thread.daemon = True
+        thread.start()
+        return True
+
+
+class StandIn(object):
+    """ A local SSH server standing in for a deploy target.
+
+    Commands run as the current local user, in a temporary home directory, with the fake system tools of
+    `bin_dir` first in the PATH. The absolute `/home/<user>` paths git receives are mapped to that home.
+
+    """
+
+    def __init__(self, root_dir, bin_dir, rtt=0.0, bandwidth=0):
+        self.home = os.path.join(root_dir, 'home')
+        self.state_dir = os.path.join(root_dir, 'state')
+        self.bin_dir = bin_dir
+        self.shim = Shim(rtt, bandwidth)
+        self.stats = Stats()
+        self.host_key = paramiko.RSAKey.generate(2048)
+
+        for directory in (self.home, self.state_dir):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(('127.0.0.1', 0))
+        self._sock.listen(100)
+        self.port = self._sock.getsockname()[1]
+        self._transports = []
+
+    def start(self):
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._sock.close()
+        for transport in self._transports:
+            transport.close()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, address = self._sock.accept()
+            except socket.error:
+                return
+            thread = threading.Thread(target=self._handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _handle(self, conn):
+        self.stats.add('handshakes')
+        # The key exchange and the authentication take about two round trips
+        self.shim.round_trip(2)
+
+        transport = paramiko.Transport(MeteredSocket(conn, self.stats, self.shim))
+        transport.add_server_key(self.host_key)
+        transport.set_subsystem_handler('sftp', SFTPServer, Sftp)
+        transport.standin = self
+        self._transports.append(transport)
+
+        transport.start_server(server=Interface(self))
+        # The transport only keeps weak references to its channels, so a channel whose exec request did not
+        # arrive yet would be closed once garbage collected
+        channels = []
+        while transport.is_active():
+            channel = transport.accept(1)
+            channels = [other for other in channels if not other.closed]
+            if channel is None:
+                continue
+            channels.append(channel)
+            destination = transport.server_object.forwards.pop(channel.get_id(), None)
+            if destination is not None:
+                thread = threading.Thread(target=self._forward, args=(channel, destination))
+                thread.daemon = True
+                thread.start()
+
+    def _forward(self, channel, destination):
+        sock = socket.create_connection(destination)
+
+        def upstream():
+            while True:
+                data = channel.recv(32768)
+                if not data:
+                    break
+                sock.sendall(data)
+            try:
+                sock.shutdown(socket.SHUT_WR)
+            except socket.error:
+                pass
+
+        thread = threading.Thread(target=upstream)
+        thread.daemon = True
+        thread.start()
+        while True:
+            data = sock.recv(32768)
+            if not data:
+                break
+            channel.sendall(data)
+        thread.join()
+        channel.close()
+        sock.close()
+
+    def run_command(self, channel, command, user):
+        self.shim.round_trip()
+
+        if command.startswith('git-'):
+            command = command.replace("'/home/%s/" % user, "'%s/" % self.home)
+
+        env = dict(os.environ)
+        env['HOME'] = self.home
+        env['PATH'] = '%s:%s' % (self.bin_dir, env.get('PATH', ''))
+        env['BENCH_STATE'] = self.state_dir
+        process = subprocess.Popen(['bash', '-c', command], cwd=self.home, env=env,
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        def feed():
+            while True:
+                data = channel.recv(32768)
+                if not data:
+                    break
+                try:
+                    process.stdin.write(data)
+                    process.stdin.flush()
+                except IOError:
+                    break
+            try:
+                process.stdin.close()
+            except IOError:
+                pass
+
+        def drain(stream, send):
+            while True:
+                data = os.read(stream.fileno(), 32768)
+                if not data:
+                    break
+                send(data)
+
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+        stderr = threading.Thread(target=drain, args=(process.stderr, channel.sendall_stderr))
+        stderr.start()
+        drain(process.stdout, channel.sendall)
+        stderr.join()
+
+        channel.send_exit_status(process.wait())
+        channel.close()
+
+
+class UnixXMLRPCRequestHandler(SimpleXMLRPCRequestHandler):
+    # TCP_NODELAY does not apply to unix sockets
+    disable_nagle_algorithm = False
+
+
+class UnixXMLRPCServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer):
+    address_family = socket.AF_UNIX
+    daemon_threads = True
+
+
+class FakeSupervisord(object):
+    """ A supervisord XML-RPC interface on a unix socket, whose programs only pretend to run.
+
+    Programs are read from the `[program:x]` sections of the include directory, and keep the state the
+    deploy client gives them.
+
+    """
+    STOPPED, RUNNING = 0, 20
+    STATE_NAMES = {STOPPED: 'STOPPED', RUNNING: 'RUNNING'}
+    BAD_NAME, ALREADY_STARTED, NOT_RUNNING, ALREADY_ADDED, STILL_RUNNING = 10, 60, 70, 90, 91
+
+    def __init__(self, socket_path, config_dir):
+        self.socket_path = socket_path
+        self.config_dir = config_dir
+        self.loaded = {}
+        self.states = {}
+        self.started = {}
+        self._lock = threading.Lock()
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self._server = UnixXMLRPCServer(socket_path, requestHandler=UnixXMLRPCRequestHandler, logRequests=False,
+                                        allow_none=True)
+        self._server.register_function(self.multicall, 'system.multicall')
+        for name in ['reloadConfig', 'addProcessGroup', 'removeProcessGroup', 'stopProcessGroup', 'startProcess',
+                     'stopProcess', 'getProcessInfo', 'getAllProcessInfo']:
+            self._server.register_function(self._locked(getattr(self, name)), 'supervisor.%s' % name)
+
+    def _locked(self, function):
+        def call(*args):
+            with self._lock:
+                return function(*args)
+        return call
+
+    def multicall(self, calls):
+        """ Executes calls like supervisord does, returning their values as they are rather than wrapped in a
+            single value list like the standard multicall. """
+        results = []
+        for call in calls:
+            try:
+                results.append(self._server.funcs[call['methodName']](*call['params']))
+            except xmlrpclib.Fault, fault:
+                results.append({'faultCode': fault.faultCode, 'faultString': fault.faultString})
+        return results
+
+    def start(self):
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _read_config(self):
+        programs = {}
+        for path in glob.glob(os.path.join(self.config_dir, '*.conf')):
+            config = ConfigParser.RawConfigParser()
+            config.read(path)
+            for section in config.sections():
+                if section.startswith('program:'):
+                    programs[section[len('program:'):]] = sorted(config.items(section))
+        return programs
+
+    def _get_name(self, name):
+        name = name.split(':')[-1]
+        if name not in self.loaded:
+            raise xmlrpclib.Fault(FakeSupervisord.BAD_NAME, 'BAD_NAME: %s' % name)
+        return name
+
+    def reloadConfig(self):
+        programs = self._read_config()
+        added = [name for name in programs if name not in self.loaded]
+        changed = [name for name in programs if name in self.loaded and programs[name] != self.loaded[name]]
+        removed = [name for name in self.loaded if name not in programs]
+        return [[added, changed, removed]]
+
+    def addProcessGroup(self, name):
+        if name in self.loaded:
+            raise xmlrpclib.Fault(FakeSupervisord.ALREADY_ADDED, 'ALREADY_ADDED: %s' % name)
+        programs = self._read_config()
+        if name not in programs:
+            raise xmlrpclib.Fault(FakeSupervisord.BAD_NAME, 'BAD_NAME: %s' % name)
+        self.loaded[name] = programs[name]
+        autostart = dict(programs[name]).get('autostart') == 'true'
+        self.states[name] = FakeSupervisord.RUNNING if autostart else FakeSupervisord.STOPPED
+        self.started[name] = int(time.time())
+        return True
+
+    def removeProcessGroup(self, name):
+        name = self._get_name(name)
+        if self.states[name] == FakeSupervisord.RUNNING:
+            raise xmlrpclib.Fault(FakeSupervisord.STILL_RUNNING, 'STILL_RUNNING: %s' % name)
+        del self.loaded[name]
+        del self.states[name]
+        return True
+
+    def stopProcessGroup(self, name, wait=True):
+        name = self._get_name(name)
+        self.states[name] = FakeSupervisord.STOPPED
+        return [{'name': name, 'group': name, 'status': 80, 'description': 'OK'}]
+
+    def startProcess(self, name, wait=True):
+        name = self._get_name(name)
+        if self.states[name] == FakeSupervisord.RUNNING:
+            raise xmlrpclib.Fault(FakeSupervisord.ALREADY_STARTED, 'ALREADY_STARTED: %s' % name)
+        self.states[name] = FakeSupervisord.RUNNING
+        self.started[name] = int(time.time())
+        return True
+
+    def stopProcess(self, name, wait=True):
+        name = self._get_name(name)
+        if self.states[name] != FakeSupervisord.RUNNING:
+            raise xmlrpclib.Fault(FakeSupervisord.NOT_RUNNING, 'NOT_RUNNING: %s' % name)
+        self.states[name] = FakeSupervisord.STOPPED
+        return True
+
+    def getProcessInfo(self, name):
+        name = self._get_name(name)
+        state = self.states[name]
+        return {'name': name, 'group': name, 'state': state, 'statename': FakeSupervisord.STATE_NAMES[state],
+                'pid': 0, 'start': self.started.get(name, 0), 'stop': 0, 'now': int(time.time()), 'description': '',
+                'exitstatus': 0, 'spawnerr': '', 'logfile': '', 'stdout_logfile': '', 'stderr_logfile': ''}
+
+    def getAllProcessInfo(self):
+        return [self.getProcessInfo(name) for name in sorted(self.loaded)]
@@ -12,7 +12,10 @@ setup(
     author_email="info@olivierboucher.com",
 
     # Packages
-    packages=["app"],
+    packages=["app", "app.presets", "app.presets.java", "app.presets.javascript"],
+
+    # Bash helpers and the remote agent, loaded from the package at runtime
+    package_data={"app": ["bash/*.sh", "python/*.py"]},
 
     # Include additional files into the package
     include_package_data=True,